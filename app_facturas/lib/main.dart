@@ -3,6 +3,8 @@ import 'dart:io';
 import 'package:flutter/material.dart';
 import 'package:image_picker/image_picker.dart';
 import 'package:http/http.dart' as http;
+import 'sesion.dart';
+import 'sincronizacion.dart';
 
 import 'screens/login_screen.dart';
 import 'screens/register_screen.dart';
@@ -13,7 +15,10 @@ import 'screens/records_screen.dart';
 import 'screens/reports_screen.dart';
 
 
-void main() {
+Future<void> main() async {
+  WidgetsFlutterBinding.ensureInitialized();
+  // Lo último sincronizado queda disponible desde el arranque, aunque no haya red
+  await Sincronizacion.cargar();
   runApp(const QontaApp());
 }
 
@@ -89,7 +94,7 @@ class _DashboardScreenState extends State<DashboardScreen> {
   Future<void> _cargarInfoUsuario() async {
     try {
       var uri = Uri.parse("http://$ipAddress:8000/usuario/${widget.userId}");
-      var response = await http.get(uri);
+      var response = await http.get(uri, headers: Sesion.cabeceras());
       if (response.statusCode == 200) {
         var data = json.decode(response.body);
         setState(() {
@@ -111,11 +116,11 @@ class _DashboardScreenState extends State<DashboardScreen> {
   Future<void> _cargarDatosDashboard() async {
     setState(() => _loadingDashboard = true);
     try {
-      var uriVentas = Uri.parse("http://$ipAddress:8000/obtener-registros/ventas?user_id=${widget.userId}");
-      var resVentas = await http.get(uriVentas);
+      var uriVentas = Uri.parse("http://$ipAddress:8000/obtener-registros/ventas?user_id=${widget.userId}&limit=2");
+      var resVentas = await http.get(uriVentas, headers: Sesion.cabeceras());
 
-      var uriCompras = Uri.parse("http://$ipAddress:8000/obtener-registros/compras?user_id=${widget.userId}");
-      var resCompras = await http.get(uriCompras);
+      var uriCompras = Uri.parse("http://$ipAddress:8000/obtener-registros/compras?user_id=${widget.userId}&limit=2");
+      var resCompras = await http.get(uriCompras, headers: Sesion.cabeceras());
 
       if (resVentas.statusCode == 200 && resCompras.statusCode == 200) {
         var dataVentas = json.decode(resVentas.body);
@@ -167,6 +172,7 @@ class _DashboardScreenState extends State<DashboardScreen> {
 
     try {
       var request = http.MultipartRequest('POST', uri);
+      request.headers.addAll(Sesion.cabeceras());
       request.files.add(await http.MultipartFile.fromPath('file', photo.path));
 
       request.fields['user_id'] = widget.userId.toString();
@@ -177,6 +183,10 @@ class _DashboardScreenState extends State<DashboardScreen> {
       if (response.statusCode == 200) {
         var data = json.decode(response.body);
         _mostrarResultadoDialog(data['datos'], esVenta);
+      } else if ([429, 503, 504].contains(response.statusCode)) {
+        // Gemini saturado o lento: no es un error de la foto, se puede reintentar
+        var espera = response.headers['retry-after'] ?? "unos";
+        _mostrarSnackBar("${json.decode(response.body)['error']} (reintenta en $espera s)", Colors.orange);
       } else {
         _mostrarSnackBar("Error del servidor: ${response.statusCode}", Colors.red);
       }
@@ -507,7 +517,7 @@ class _DashboardScreenState extends State<DashboardScreen> {
   Widget _buildHeader() {
     ImageProvider imagenPerfil;
     if (_rutaAvatar != null && _rutaAvatar!.isNotEmpty && !_rutaAvatar!.contains('default_avatar')) {
-      imagenPerfil = NetworkImage("http://$ipAddress:8000/static/$_rutaAvatar?v=$_avatarVersion");
+      imagenPerfil = NetworkImage("http://$ipAddress:8000/static/$_rutaAvatar?v=$_avatarVersion", headers: Sesion.cabeceras());
     } else {
       imagenPerfil = const AssetImage('assets/avatar_default.png');
     }
@@ -699,7 +709,7 @@ class _DashboardScreenState extends State<DashboardScreen> {
 
     ImageProvider logoImage;
     if (_rutaLogo != null && _rutaLogo!.isNotEmpty && !_rutaLogo!.contains('default')) {
-      logoImage = NetworkImage("http://$ipAddress:8000/static/$_rutaLogo?v=$_logoVersion");
+      logoImage = NetworkImage("http://$ipAddress:8000/static/$_rutaLogo?v=$_logoVersion", headers: Sesion.cabeceras());
     } else {
       logoImage = const AssetImage('assets/logo_placeholder.png');
     }
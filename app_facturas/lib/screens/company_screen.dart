@@ -1,6 +1,7 @@
 import 'dart:convert';
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
+import '../sesion.dart';
 import 'package:image_picker/image_picker.dart';
 import '../main.dart'; // Para QontaColors
 
@@ -51,6 +52,7 @@ class _CompanyScreenState extends State<CompanyScreen> {
     setState(() => _isUploading = true);
     try {
       var request = http.MultipartRequest('POST', Uri.parse("http://${widget.ipAddress}:8000/subir-logo-empresa/"));
+      request.headers.addAll(Sesion.cabeceras());
       request.fields['user_id'] = widget.userId.toString();
       request.files.add(await http.MultipartFile.fromPath('file', image.path));
       var res = await http.Response.fromStream(await request.send());
@@ -71,7 +73,7 @@ class _CompanyScreenState extends State<CompanyScreen> {
     try {
       var res = await http.post(
         Uri.parse("http://${widget.ipAddress}:8000/editar-empresa/"),
-        headers: {"Content-Type": "application/json"},
+        headers: Sesion.cabeceras({"Content-Type": "application/json"}),
         body: json.encode({
           "user_id": widget.userId,
           "ruc": _rucController.text,
@@ -121,7 +123,7 @@ class _CompanyScreenState extends State<CompanyScreen> {
                         color: Colors.grey[200],
                         borderRadius: BorderRadius.circular(15),
                         border: Border.all(color: QontaColors.accentYellow, width: 2),
-                        image: logoUrl != null ? DecorationImage(image: NetworkImage(logoUrl), fit: BoxFit.cover) : null,
+                        image: logoUrl != null ? DecorationImage(image: NetworkImage(logoUrl, headers: Sesion.cabeceras()), fit: BoxFit.cover) : null,
                       ),
                       child: _isUploading
                           ? const Center(child: CircularProgressIndicator())
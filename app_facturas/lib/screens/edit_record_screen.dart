@@ -1,6 +1,7 @@
 import 'dart:convert';
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
+import '../sesion.dart';
 import '../main.dart';
 
 class EditarDatosScreen extends StatefulWidget {
@@ -65,11 +66,11 @@ class _EditarDatosScreenState extends State<EditarDatosScreen> {
 
     _dirEmisorController = TextEditingController(text: widget.esVenta
         ? ""
-        : (widget.datos['proveedor_direccion'] ?? ""));
+        : (widget.datos['proveedor_direccion'] ?? widget.datos['direccion_proveedor'] ?? ""));
 
     _telEmisorController = TextEditingController(text: widget.esVenta
         ? ""
-        : (widget.datos['proveedor_telefono'] ?? ""));
+        : (widget.datos['proveedor_telefono'] ?? widget.datos['telefono_proveedor'] ?? ""));
 
     _rucClienteController = TextEditingController(text: widget.esVenta
         ? (widget.datos['cliente_nro_doc']?.toString() ?? "")
@@ -83,7 +84,10 @@ class _EditarDatosScreenState extends State<EditarDatosScreen> {
     _montoController = TextEditingController(text: monto?.toString() ?? "0.0");
 
     _fechaController = TextEditingController(text: widget.datos['fecha_emision'] ?? "");
-    _codigoController = TextEditingController(text: "${widget.datos['serie'] ?? ''}-${widget.datos['numero'] ?? ''}");
+    // Un registro guardado de ventas trae serie_comprobante / nro_comprobante
+    var serie = widget.datos['serie'] ?? widget.datos['serie_comprobante'] ?? '';
+    var numero = widget.datos['numero'] ?? widget.datos['nro_comprobante'] ?? '';
+    _codigoController = TextEditingController(text: numero.toString().isEmpty ? "$serie" : "$serie-$numero");
   }
 
   @override
@@ -105,14 +109,21 @@ class _EditarDatosScreenState extends State<EditarDatosScreen> {
 
     setState(() => _isSaving = true);
 
+    // Un registro ya guardado se actualiza en su lugar; lo recién escaneado se inserta
+    var idRegistro = widget.datos[widget.esVenta ? 'id_transaccion' : 'id_gasto'];
+    var codigo = _codigoController.text.trim();
+    var guion = codigo.indexOf("-");
+
     Map<String, dynamic> body = {
       "user_id": widget.userId,
       "tipo": widget.esVenta ? "venta" : "compra",
       "datos": {
         "fecha_emision": _fechaController.text,
         "monto_total": double.tryParse(_montoController.text) ?? 0.0,
-        "serie": _codigoController.text,
+        "serie": guion < 0 ? codigo : codigo.substring(0, guion),
+        if (guion >= 0) "numero": codigo.substring(guion + 1),
         "tipo_comprobante": _selectedDocType,
+        "ruta_imagen": widget.datos['ruta_imagen'] ?? "",
 
         if (widget.esVenta) ...{
           "cliente_nro_doc": _rucClienteController.text,
@@ -129,10 +140,13 @@ class _EditarDatosScreenState extends State<EditarDatosScreen> {
     };
 
     try {
-      var response = await http.post(
-        Uri.parse("http://${widget.ipAddress}:8000/guardar-confirmado/"),
-        headers: {"Content-Type": "application/json"},
-        body: json.encode(body),
+      var headers = Sesion.cabeceras({"Content-Type": "application/json"});
+      var response = await (idRegistro == null
+          ? http.post(Uri.parse("http://${widget.ipAddress}:8000/guardar-confirmado/"),
+              headers: headers, body: json.encode(body))
+          : http.put(
+              Uri.parse("http://${widget.ipAddress}:8000/actualizar-registro/${widget.esVenta ? 'ventas' : 'compras'}/$idRegistro"),
+              headers: headers, body: json.encode(body))
       ).timeout(const Duration(seconds: 10));
 
       if (response.statusCode == 200) {
@@ -141,6 +155,9 @@ class _EditarDatosScreenState extends State<EditarDatosScreen> {
         ScaffoldMessenger.of(context).showSnackBar(
           const SnackBar(content: Text("¡Datos guardados con éxito!"), backgroundColor: Colors.green),
         );
+      } else if (response.statusCode == 409 || response.statusCode == 422) {
+        // Duplicado o no pasó la validación: el servidor dice qué corregir
+        throw Exception(json.decode(response.body)['error']);
       } else {
         throw Exception("Error del servidor: ${response.statusCode}");
       }
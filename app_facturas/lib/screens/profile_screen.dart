@@ -1,6 +1,7 @@
 import 'dart:io';
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
+import '../sesion.dart';
 import 'dart:convert';
 import 'package:image_picker/image_picker.dart';
 import '../main.dart';
@@ -78,6 +79,7 @@ class _ProfileScreenState extends State<ProfileScreen> {
     try {
       var uri = Uri.parse("http://${widget.ipAddress}:8000/subir-avatar/");
       var request = http.MultipartRequest('POST', uri);
+      request.headers.addAll(Sesion.cabeceras());
       request.fields['user_id'] = widget.userId.toString();
       request.files.add(await http.MultipartFile.fromPath('file', pickedFile.path));
 
@@ -108,7 +110,7 @@ class _ProfileScreenState extends State<ProfileScreen> {
       final uri = Uri.parse("http://${widget.ipAddress}:8000/editar-perfil/");
       final response = await http.post(
         uri,
-        headers: {"Content-Type": "application/json"},
+        headers: Sesion.cabeceras({"Content-Type": "application/json"}),
         body: json.encode({
           "user_id": widget.userId,
           "nombre_completo": _nameController.text,
@@ -251,7 +253,7 @@ class _ProfileScreenState extends State<ProfileScreen> {
                   radius: 45,
                   backgroundColor: Colors.grey[300],
                   backgroundImage: fullAvatarUrl != null
-                      ? NetworkImage(fullAvatarUrl) as ImageProvider
+                      ? NetworkImage(fullAvatarUrl, headers: Sesion.cabeceras()) as ImageProvider
                       : const AssetImage('assets/avatar_default.png'),
                   child: _isUploadingImage
                       ? const CircularProgressIndicator(color: QontaColors.primaryBlue)
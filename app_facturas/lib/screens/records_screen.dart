@@ -1,6 +1,8 @@
 import 'dart:convert';
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
+import '../sesion.dart';
+import '../sincronizacion.dart';
 import '../main.dart';
 import 'edit_record_screen.dart';
 
@@ -27,27 +29,26 @@ class _RecordsScreenState extends State<RecordsScreen> {
   Future<void> _cargarRegistros() async {
     setState(() => _loading = true);
     try {
-      var uri = Uri.parse("http://${widget.ipAddress}:8000/obtener-registros/$_filtroTipo?user_id=${widget.userId}");
-      var response = await http.get(uri);
-
-      if (response.statusCode == 200) {
-        var data = json.decode(response.body);
-        setState(() {
-          _registros = data['datos'];
-          _loading = false;
-        });
-      } else {
-        setState(() => _loading = false);
-      }
+      // Solo baja lo que cambió desde el último refresco
+      await Sincronizacion.sincronizar(widget.ipAddress, widget.userId);
     } catch (e) {
-      setState(() => _loading = false);
+      if (mounted && Sincronizacion.tieneDatos) {
+        ScaffoldMessenger.of(context).showSnackBar(
+            const SnackBar(content: Text("Sin conexión: mostrando lo último sincronizado"))
+        );
+      }
     }
+    if (!mounted) return;
+    setState(() {
+      _registros = Sincronizacion.lista(_filtroTipo);
+      _loading = false;
+    });
   }
 
   Future<void> _eliminarRegistro(int id) async {
     try {
       var uri = Uri.parse("http://${widget.ipAddress}:8000/eliminar-registro/$_filtroTipo/$id");
-      var response = await http.delete(uri);
+      var response = await http.delete(uri, headers: Sesion.cabeceras());
 
       if (response.statusCode == 200) {
         ScaffoldMessenger.of(context).showSnackBar(
@@ -55,6 +56,7 @@ class _RecordsScreenState extends State<RecordsScreen> {
         );
         // No necesitamos recargar todo, el Dismissible ya lo quitó visualmente,
         // pero actualizamos la lista interna para evitar errores.
+        Sincronizacion.olvidar(_filtroTipo, id);
         setState(() {
           _registros.removeWhere((item) => item['id'] == id);
         });
@@ -73,6 +75,12 @@ class _RecordsScreenState extends State<RecordsScreen> {
   }
 
   Future<void> _editarRegistro(int id, bool esGasto) async {
+    // Lo sincronizado ya trae cabecera e items: se abre sin red
+    var enCache = Sincronizacion.detalle(_filtroTipo, id);
+    if (enCache != null) {
+      await _abrirEdicion(enCache, esGasto);
+      return;
+    }
     showDialog(
       context: context,
       barrierDismissible: false,
@@ -81,25 +89,12 @@ class _RecordsScreenState extends State<RecordsScreen> {
 
     try {
       var uri = Uri.parse("http://${widget.ipAddress}:8000/obtener-detalle/$_filtroTipo/$id");
-      var response = await http.get(uri);
+      var response = await http.get(uri, headers: Sesion.cabeceras());
 
       Navigator.pop(context);
 
       if (response.statusCode == 200) {
-        var datosCompletos = json.decode(response.body);
-
-        await Navigator.push(
-          context,
-          MaterialPageRoute(
-            builder: (context) => EditarDatosScreen(
-              datos: datosCompletos,
-              esVenta: !esGasto,
-              ipAddress: widget.ipAddress,
-              userId: widget.userId,
-            ),
-          ),
-        );
-        _cargarRegistros();
+        await _abrirEdicion(json.decode(response.body), esGasto);
       } else {
         ScaffoldMessenger.of(context).showSnackBar(const SnackBar(content: Text("Error al cargar detalles")));
       }
@@ -109,6 +104,21 @@ class _RecordsScreenState extends State<RecordsScreen> {
     }
   }
 
+  Future<void> _abrirEdicion(Map<String, dynamic> datosCompletos, bool esGasto) async {
+    await Navigator.push(
+      context,
+      MaterialPageRoute(
+        builder: (context) => EditarDatosScreen(
+          datos: datosCompletos,
+          esVenta: !esGasto,
+          ipAddress: widget.ipAddress,
+          userId: widget.userId,
+        ),
+      ),
+    );
+    _cargarRegistros();
+  }
+
   @override
   Widget build(BuildContext context) {
     return Scaffold(
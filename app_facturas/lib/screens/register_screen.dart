@@ -1,6 +1,7 @@
 import 'dart:convert';
 import 'package:flutter/material.dart';
 import 'package:http/http.dart' as http;
+import '../sesion.dart';
 import 'package:flutter_svg/flutter_svg.dart';
 import '../main.dart'; // Para colores y Dashboard
 
@@ -40,6 +41,7 @@ class _RegisterScreenState extends State<RegisterScreen> {
 
       if (response.statusCode == 200) {
         var data = json.decode(response.body);
+        Sesion.token = data['token'];
         if (!mounted) return;
         Navigator.pushAndRemoveUntil(
           context,
@@ -0,0 +1,10 @@
+/// Token de la sesión actual. Lo guardan el login y el registro; todas las
+/// llamadas a la API lo mandan en la cabecera Authorization.
+class Sesion {
+  static String? token;
+
+  static Map<String, String> cabeceras([Map<String, String> extra = const {}]) => {
+        if (token != null) 'Authorization': 'Bearer $token',
+        ...extra,
+      };
+}
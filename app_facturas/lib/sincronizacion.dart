@@ -0,0 +1,116 @@
+import 'dart:convert';
+import 'package:http/http.dart' as http;
+import 'package:shared_preferences/shared_preferences.dart';
+import 'sesion.dart';
+
+/// Caché local de los comprobantes del usuario, al día con /sync: cada
+/// refresco baja solo lo que cambió desde el último token. Se guarda en
+/// SharedPreferences, así al abrir la app (y sin red) las pantallas siguen
+/// mostrando lo último que se sincronizó.
+class Sincronizacion {
+  static const String _clave = "sync_cache";
+
+  static int? _userId;
+  static String? _token;
+  static bool _cargado = false;
+  static final Map<String, Map<int, Map<String, dynamic>>> _registros = {"compras": {}, "ventas": {}};
+
+  static const Map<String, String> _columnaId = {"compras": "id_gasto", "ventas": "id_transaccion"};
+
+  static bool get tieneDatos => _token != null;
+
+  /// Lee la caché guardada; se llama al arrancar y antes de cada sincronización (solo lee una vez).
+  static Future<void> cargar() async {
+    if (_cargado) return;
+    _cargado = true;
+    final prefs = await SharedPreferences.getInstance();
+    final guardado = prefs.getString(_clave);
+    if (guardado == null) return;
+    try {
+      var cache = json.decode(guardado);
+      _registros.forEach((tipo, registros) {
+        for (var registro in cache['registros'][tipo]) {
+          registros[registro[_columnaId[tipo]]] = Map<String, dynamic>.from(registro);
+        }
+      });
+      _userId = cache['user_id'];
+      _token = cache['token'];
+    } catch (e) {
+      // Caché de otra versión o corrupta: se vuelve a bajar entera
+      limpiar();
+    }
+  }
+
+  static Future<void> _guardar() async {
+    final prefs = await SharedPreferences.getInstance();
+    await prefs.setString(_clave, json.encode({
+      "user_id": _userId,
+      "token": _token,
+      "registros": _registros.map((tipo, registros) => MapEntry(tipo, registros.values.toList())),
+    }));
+  }
+
+  static Future<void> sincronizar(String ipAddress, int userId) async {
+    await cargar();
+    if (_userId != userId) {
+      // Otra cuenta en el mismo teléfono: no mezclamos sus comprobantes
+      limpiar();
+      _userId = userId;
+    }
+    bool pendientes = true;
+    while (pendientes) {
+      var uri = Uri.parse("http://$ipAddress:8000/sync")
+          .replace(queryParameters: _token == null ? null : {"since": _token});
+      // El cliente http ya pide gzip y descomprime solo
+      var response = await http.get(uri, headers: Sesion.cabeceras()).timeout(const Duration(seconds: 15));
+      if (response.statusCode != 200) {
+        throw Exception("Error del servidor: ${response.statusCode}");
+      }
+      var cambios = json.decode(response.body);
+      if (cambios['completo'] == true) {
+        _registros.forEach((_, registros) => registros.clear());
+      }
+      _registros.forEach((tipo, registros) {
+        for (var id in cambios['eliminados'][tipo]) {
+          registros.remove(id);
+        }
+        for (var registro in cambios[tipo]) {
+          registros[registro[_columnaId[tipo]]] = Map<String, dynamic>.from(registro);
+        }
+      });
+      _token = cambios['token'];
+      pendientes = cambios['pendientes'] == true;
+    }
+    await _guardar();
+  }
+
+  /// Filas para la lista, con las mismas claves que /obtener-registros (más nuevas primero).
+  static List<Map<String, dynamic>> lista(String tipo) {
+    var esCompra = tipo == "compras";
+    var filas = _registros[tipo]!.values.map((r) => <String, dynamic>{
+          "id": r[_columnaId[tipo]],
+          "titulo": (esCompra ? r['proveedor_razon_social'] : r['cliente_razon_social']) ??
+              (esCompra ? "Proveedor Desconocido" : "Cliente Varios"),
+          "fecha": r['fecha_emision'],
+          "monto": esCompra ? r['monto_total'] : r['total_cp'],
+          "categoria": esCompra ? r['clasificacion_bien_servicio'] : r['tipo_comprobante'],
+          "foto": r['ruta_miniatura'],
+        }).toList();
+    filas.sort((a, b) => (b['id'] as int).compareTo(a['id'] as int));
+    return filas;
+  }
+
+  /// El comprobante completo (cabecera e items), o null si no está en la caché.
+  static Map<String, dynamic>? detalle(String tipo, int id) => _registros[tipo]![id];
+
+  static void olvidar(String tipo, int id) {
+    _registros[tipo]!.remove(id);
+    _guardar();
+  }
+
+  static void limpiar() {
+    _token = null;
+    _registros.forEach((_, registros) => registros.clear());
+    _guardar();
+  }
+}
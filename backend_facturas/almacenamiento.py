@@ -0,0 +1,194 @@
+import asyncio
+import io
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime
+from PIL import Image, ImageOps
+from starlette.staticfiles import StaticFiles
+from db import obtener_conexion, transaccion
+
+# Imágenes de comprobantes en uploads/{usuario}/{AAAA}/{MM}/{uuid}.{ext}, con dos
+# derivadas al lado: {uuid}.thumb.jpg para la lista y {uuid}.preview.jpg para el detalle.
+# Avatares y logos en static/avatars/{usuario}/.
+DIR_UPLOADS = "uploads"
+DIR_STATIC = "static"
+TAMANOS_DERIVADAS = {"thumb": 256, "preview": 1024}
+CALIDAD_DERIVADAS = 70
+CHUNK_BYTES = 1024 * 1024
+
+# Los nombres nunca se reutilizan (uuid o timestamp): lo que hay en una URL no cambia.
+# "private": se sirven con token, ningún proxy intermedio debe guardarlos
+CACHE_CONTROL_UPLOADS = "private, max-age=31536000, immutable"
+CACHE_CONTROL_STATIC = "private, max-age=86400"
+
+
+class ArchivosEstaticos(StaticFiles):
+    """StaticFiles ya responde ETag/Last-Modified (con 304) y Range; acá se
+    agrega el Cache-Control para que la app no vuelva a bajar lo mismo."""
+
+    def __init__(self, *args, cache_control: str = CACHE_CONTROL_UPLOADS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    def file_response(self, *args, **kwargs):
+        respuesta = super().file_response(*args, **kwargs)
+        respuesta.headers["Cache-Control"] = self.cache_control
+        return respuesta
+
+
+def carpeta_usuario(base: str, user_id, fecha: datetime = None) -> str:
+    fecha = fecha or datetime.now()
+    return f"{base}/{user_id if user_id is not None else 'sin_usuario'}/{fecha:%Y}/{fecha:%m}"
+
+
+def es_de_usuario(ruta: str, user_id, base: str = DIR_UPLOADS) -> bool:
+    """¿La ruta está en la carpeta de `user_id` dentro de `base`? Un ".." la descarta:
+    uploads/1/../2/x.jpg empieza igual pero es de otro usuario."""
+    ruta = ruta or ""
+    return ruta.startswith(f"{base}/{user_id}/") and ".." not in ruta.split("/")
+
+
+def ruta_derivada(ruta: str, tamano: str) -> str:
+    """uploads/1/2025/03/abc.jpg -> uploads/1/2025/03/abc.thumb.jpg (los PDF no tienen)."""
+    if not ruta or ruta.lower().endswith(".pdf"):
+        return ruta
+    return f"{ruta.rsplit('.', 1)[0]}.{tamano}.jpg"
+
+
+def _escribir_atomico(ruta: str, contents: bytes):
+    # Se escribe a .part y se renombra: nadie (ni el GC) ve un archivo a medias
+    temporal = f"{ruta}.part"
+    with open(temporal, "wb") as destino:
+        destino.write(contents)
+    os.replace(temporal, ruta)
+
+
+def generar_derivadas(ruta: str, contents: bytes = None):
+    try:
+        img = Image.open(io.BytesIO(contents) if contents is not None else ruta)
+        img.draft("RGB", (max(TAMANOS_DERIVADAS.values()),) * 2)
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        return
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGB")
+    for tamano, lado in TAMANOS_DERIVADAS.items():
+        copia = img.copy()
+        copia.thumbnail((lado, lado), Image.LANCZOS)
+        salida = io.BytesIO()
+        copia.save(salida, "JPEG", quality=CALIDAD_DERIVADAS, optimize=True)
+        _escribir_atomico(ruta_derivada(ruta, tamano), salida.getvalue())
+
+
+def guardar_imagen(contents: bytes, extension: str, user_id) -> str:
+    """Guarda la imagen de un comprobante en la carpeta del usuario y del mes,
+    con su miniatura y su preview. Es disco y CPU: llamarla con asyncio.to_thread."""
+    carpeta = carpeta_usuario(DIR_UPLOADS, user_id)
+    os.makedirs(carpeta, exist_ok=True)
+    ruta = f"{carpeta}/{uuid.uuid4()}.{extension}"
+    _escribir_atomico(ruta, contents)
+    if extension != "pdf":
+        generar_derivadas(ruta, contents)
+    return ruta
+
+
+async def guardar_upload(archivo, ruta_disco: str):
+    """Copia un UploadFile a disco de a CHUNK_BYTES, sin tenerlo entero en memoria."""
+    os.makedirs(os.path.dirname(ruta_disco), exist_ok=True)
+    temporal = f"{ruta_disco}.part"
+    try:
+        with open(temporal, "wb") as destino:
+            while chunk := await archivo.read(CHUNK_BYTES):
+                await asyncio.to_thread(destino.write, chunk)
+        os.replace(temporal, ruta_disco)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+
+
+def _enlazar(origen: str, destino: str):
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copy2(origen, destino)
+
+
+def _columnas(conn, tabla: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({tabla})")}
+
+
+def migrar_archivos() -> int:
+    """Pasa los archivos del layout plano viejo (uploads/x.jpg, avatars/x.jpg) a
+    las carpetas por usuario y mes, genera las derivadas y actualiza las rutas.
+
+    Cada archivo se enlaza en su lugar nuevo, se actualiza la base y recién ahí
+    se borra el viejo: si se corta a la mitad, ninguna fila apunta a la nada.
+    Se puede correr de nuevo sin problema; solo toca lo que sigue en el layout viejo.
+    """
+    conn = obtener_conexion()
+    # extracciones va en la misma transacción: si no, confirmar un comprobante migrado
+    # ya no encuentra lo que leyó el extractor y su precisión deja de medirse
+    tablas = [(t, "ruta_imagen") for t in ("compras_sire", "ventas_sire", "trabajos_escaneo", "extracciones")
+              if "ruta_imagen" in _columnas(conn, t)]
+    movidos = 0
+
+    # Una misma imagen puede estar en varias filas (caché de extracción): se mueve una vez
+    viejas = {}
+    for tabla, columna in tablas:
+        for user_id, ruta in conn.execute(
+            f"SELECT user_id, {columna} FROM {tabla} WHERE {columna} LIKE 'uploads/%' AND {columna} NOT LIKE 'uploads/%/%'"
+        ):
+            if viejas.get(ruta) is None:
+                viejas[ruta] = user_id
+
+    for ruta, user_id in viejas.items():
+        if not os.path.exists(ruta):
+            continue
+        fecha = datetime.fromtimestamp(os.path.getmtime(ruta))
+        nueva = f"{carpeta_usuario(DIR_UPLOADS, user_id, fecha)}/{os.path.basename(ruta)}"
+        _enlazar(ruta, nueva)
+        generar_derivadas(nueva)
+        with transaccion() as conn:
+            for tabla, columna in tablas:
+                conn.execute(f"UPDATE {tabla} SET {columna} = ? WHERE {columna} = ?", (nueva, ruta))
+            if ("extracciones", "ruta_imagen") in tablas:
+                # Cada página de un PDF del lote se registra como ruta#página
+                conn.execute("UPDATE extracciones SET ruta_imagen = ? || substr(ruta_imagen, ?) "
+                             "WHERE ruta_imagen > ? || '#' AND ruta_imagen < ? || '$'",
+                             (nueva, len(ruta) + 1, ruta, ruta))
+        os.remove(ruta)
+        movidos += 1
+
+    # Avatares y logos: la ruta guardada es relativa a static/
+    for columna in ("foto_perfil", "logo_empresa"):
+        filas = conn.execute(
+            f"SELECT id_usuario, {columna} FROM usuarios WHERE {columna} LIKE 'avatars/%' AND {columna} NOT LIKE 'avatars/%/%'"
+        ).fetchall()
+        for user_id, ruta in filas:
+            origen = f"{DIR_STATIC}/{ruta}"
+            if not os.path.exists(origen):
+                continue
+            nueva = f"avatars/{user_id}/{os.path.basename(ruta)}"
+            _enlazar(origen, f"{DIR_STATIC}/{nueva}")
+            with transaccion() as conn:
+                conn.execute(f"UPDATE usuarios SET {columna} = ? WHERE id_usuario = ?", (nueva, user_id))
+            os.remove(origen)
+            movidos += 1
+
+    # Imágenes que ya estaban en carpetas pero sin derivadas
+    for carpeta, _, archivos in os.walk(DIR_UPLOADS):
+        for nombre in archivos:
+            ruta = f"{carpeta}/{nombre}".replace(os.sep, "/")
+            if nombre.count(".") == 1 and not nombre.endswith((".pdf", ".part")) and ruta != f"{DIR_UPLOADS}/{nombre}":
+                if not os.path.exists(ruta_derivada(ruta, "thumb")):
+                    generar_derivadas(ruta)
+    return movidos
+
+
+if __name__ == "__main__":
+    inicio = time.time()
+    print(f"Archivos migrados: {migrar_archivos()} en {time.time() - inicio:.1f}s")
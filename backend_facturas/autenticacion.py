@@ -0,0 +1,221 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from fastapi import Depends, Header, HTTPException
+from db import DB_PATH
+
+# Contraseñas con scrypt y sesiones con tokens firmados (JWT HS256). Verificar
+# un token no toca la base: la firma se comprueba con el secreto y los tokens
+# ya verificados quedan en un LRU, así cada request autenticado cuesta
+# microsegundos.
+AUTH_SECRETO = os.getenv("AUTH_SECRETO", "")
+AUTH_TOKEN_HORAS = float(os.getenv("AUTH_TOKEN_HORAS", "720"))
+# Costo de scrypt: N=2**14, r=8 usa 16 MB y ~50 ms por hash; subirlo encarece el login, no cada request
+AUTH_SCRYPT_N = int(os.getenv("AUTH_SCRYPT_N", str(2 ** 14)))
+AUTH_SCRYPT_R = int(os.getenv("AUTH_SCRYPT_R", "8"))
+AUTH_SCRYPT_P = int(os.getenv("AUTH_SCRYPT_P", "1"))
+# Hilos para hashear: acotan la memoria de scrypt cuando llegan muchos logins juntos
+AUTH_HILOS = int(os.getenv("AUTH_HILOS", "2"))
+AUTH_LRU_MAX = int(os.getenv("AUTH_LRU_MAX", "10000"))
+AUTH_LRU_TTL = float(os.getenv("AUTH_LRU_TTL", "300"))
+# Ids de usuario (separados por coma) que ven las estadísticas globales del servidor; vacío = nadie
+AUTH_ADMINS = {int(u) for u in os.getenv("AUTH_ADMINS", "").split(",") if u.strip()}
+
+PREFIJO_SCRYPT = "scrypt"
+
+_executor = ThreadPoolExecutor(max_workers=AUTH_HILOS, thread_name_prefix="hash")
+_secreto = None
+_hash_falso = None
+
+
+def _b64(datos: bytes) -> str:
+    return base64.urlsafe_b64encode(datos).rstrip(b"=").decode("ascii")
+
+
+def _desde_b64(texto: str) -> bytes:
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _scrypt(password: str, sal: bytes, n: int, r: int, p: int) -> bytes:
+    return hashlib.scrypt(password.encode("utf-8"), salt=sal, n=n, r=r, p=p,
+                          maxmem=256 * n * r + 1024 * 1024, dklen=32)
+
+
+def hashear_password(password: str) -> str:
+    """Formato: scrypt$N$r$p$sal$hash; los parámetros viajan con el hash para poder subirlos después."""
+    sal = secrets.token_bytes(16)
+    derivado = _scrypt(password, sal, AUTH_SCRYPT_N, AUTH_SCRYPT_R, AUTH_SCRYPT_P)
+    return f"{PREFIJO_SCRYPT}${AUTH_SCRYPT_N}${AUTH_SCRYPT_R}${AUTH_SCRYPT_P}${_b64(sal)}${_b64(derivado)}"
+
+
+def verificar_password(password: str, guardado: Optional[str]) -> tuple:
+    """Devuelve (correcta, hay_que_rehashear).
+
+    Las cuentas anteriores a este módulo tienen la contraseña en texto plano:
+    se aceptan una vez y el login las rehashea. También se rehashea si el hash
+    se hizo con un costo distinto al configurado.
+    """
+    if guardado is None:
+        # Email desconocido: hasheamos igual para no delatar por tiempo qué correos existen
+        global _hash_falso
+        if _hash_falso is None:
+            _hash_falso = hashear_password(secrets.token_hex(8))
+        verificar_password(password, _hash_falso)
+        return False, False
+    partes = guardado.split("$")
+    if len(partes) != 6 or partes[0] != PREFIJO_SCRYPT:
+        return hmac.compare_digest(password.encode("utf-8"), guardado.encode("utf-8")), True
+    n, r, p = int(partes[1]), int(partes[2]), int(partes[3])
+    derivado = _scrypt(password, _desde_b64(partes[4]), n, r, p)
+    correcta = hmac.compare_digest(derivado, _desde_b64(partes[5]))
+    return correcta, correcta and (n, r, p) != (AUTH_SCRYPT_N, AUTH_SCRYPT_R, AUTH_SCRYPT_P)
+
+
+async def hashear(password: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(_executor, hashear_password, password)
+
+
+async def comprobar(password: str, guardado: Optional[str]) -> tuple:
+    return await asyncio.get_running_loop().run_in_executor(_executor, verificar_password, password, guardado)
+
+
+def _leer_secreto() -> bytes:
+    """AUTH_SECRETO o, si no está, uno aleatorio guardado junto a la base.
+
+    Todos los workers tienen que firmar con el mismo: el primero que arranca
+    lo crea (link atómico, falla si ya existe) y los demás lo leen.
+    """
+    global _secreto
+    if _secreto is not None:
+        return _secreto
+    if AUTH_SECRETO:
+        _secreto = AUTH_SECRETO.encode("utf-8")
+        return _secreto
+    ruta = f"{DB_PATH}.secreto"
+    if not os.path.exists(ruta):
+        temporal = f"{ruta}.{os.getpid()}.part"
+        with open(temporal, "w", encoding="ascii") as archivo:
+            archivo.write(secrets.token_hex(32))
+        try:
+            os.link(temporal, ruta)
+        except FileExistsError:
+            pass  # otro worker llegó primero; usamos el suyo
+        finally:
+            os.remove(temporal)
+    with open(ruta, encoding="ascii") as archivo:
+        _secreto = archivo.read().strip().encode("ascii")
+    return _secreto
+
+
+def _firmar(contenido: str) -> str:
+    return _b64(hmac.new(_leer_secreto(), contenido.encode("ascii"), hashlib.sha256).digest())
+
+
+_CABECERA_JWT = _b64(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode())
+
+
+def emitir_token(user_id: int) -> tuple:
+    """Devuelve (token, expira) con expira en epoch."""
+    ahora = int(time.time())
+    expira = ahora + int(AUTH_TOKEN_HORAS * 3600)
+    carga = _b64(json.dumps({"sub": str(user_id), "iat": ahora, "exp": expira}, separators=(",", ":")).encode())
+    contenido = f"{_CABECERA_JWT}.{carga}"
+    return f"{contenido}.{_firmar(contenido)}", expira
+
+
+def verificar_token(token: str) -> Optional[tuple]:
+    """(user_id, expira) si la firma es válida y no venció; si no, None."""
+    try:
+        cabecera, carga, firma = token.split(".")
+    except ValueError:
+        return None
+    # Solo aceptamos nuestra propia cabecera: nada de alg "none" ni de cambiar de algoritmo.
+    # La carga y la firma son base64url; la firma se compara en bytes porque
+    # compare_digest con str lanza TypeError ante caracteres fuera de ASCII
+    if cabecera != _CABECERA_JWT or not carga.isascii():
+        return None
+    if not hmac.compare_digest(firma.encode("utf-8"), _firmar(f"{cabecera}.{carga}").encode("ascii")):
+        return None
+    try:
+        datos = json.loads(_desde_b64(carga))
+        if datos["exp"] <= time.time():
+            return None
+        return int(datos["sub"]), datos["exp"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+class CacheTokens:
+    """LRU de tokens ya verificados: token -> (user_id, expira). Ahorra el
+    HMAC y el parseo en cada request; la entrada nunca dura más que el token."""
+
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, token: str) -> Optional[int]:
+        with self._lock:
+            entrada = self._entradas.get(token)
+            if entrada is None:
+                return None
+            user_id, vence = entrada
+            if time.time() >= vence:
+                del self._entradas[token]
+                return None
+            self._entradas.move_to_end(token)
+            return user_id
+
+    def guardar(self, token: str, user_id: int, expira: float):
+        with self._lock:
+            self._entradas[token] = (user_id, min(expira, time.time() + self.ttl))
+            self._entradas.move_to_end(token)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+
+cache_tokens = CacheTokens(AUTH_LRU_MAX, AUTH_LRU_TTL)
+
+
+async def usuario_actual(authorization: Optional[str] = Header(None)) -> int:
+    """Dependencia de las rutas protegidas: id del usuario del token Bearer o 401."""
+    if not authorization or not authorization.startswith("Bearer "):
+        raise HTTPException(status_code=401, detail="Falta el token de sesión",
+                            headers={"WWW-Authenticate": "Bearer"})
+    token = authorization[7:].strip()
+    user_id = cache_tokens.obtener(token)
+    if user_id is None:
+        verificado = verificar_token(token)
+        if verificado is None:
+            raise HTTPException(status_code=401, detail="Sesión inválida o vencida",
+                                headers={"WWW-Authenticate": "Bearer"})
+        user_id, expira = verificado
+        cache_tokens.guardar(token, user_id, expira)
+    return user_id
+
+
+async def usuario_admin(usuario: int = Depends(usuario_actual)) -> int:
+    """Dependencia de las rutas con datos de todos los usuarios: 403 si no está en AUTH_ADMINS."""
+    if usuario not in AUTH_ADMINS:
+        raise HTTPException(status_code=403, detail="Solo para administradores")
+    return usuario
+
+
+def exigir_dueno(user_id, usuario: int):
+    """403 si el request habla de otro usuario que el del token."""
+    if user_id is not None and str(user_id) != str(usuario):
+        raise HTTPException(status_code=403, detail="No autorizado para este usuario")
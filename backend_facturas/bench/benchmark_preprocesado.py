@@ -0,0 +1,104 @@
+"""Compara la extracción con la foto original contra la foto preprocesada.
+
+Uso (desde backend_facturas/, con la API key configurada):
+
+    py bench/benchmark_preprocesado.py --carpeta uploads --esperado esperado.json
+
+`esperado.json` es opcional y tiene la forma {"archivo.jpg": {"proveedor_ruc": "...",
+"monto_total": 118.0, ...}}. Con él se mide la precisión por campo; sin él solo se
+comparan bytes y latencias.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from extraccion import extraer_datos, PROMPTS  # noqa: E402
+from imagenes import preprocesar_imagen  # noqa: E402
+
+EXTENSIONES = (".jpg", ".jpeg", ".png", ".webp")
+
+
+def _igual(esperado, obtenido) -> bool:
+    if isinstance(esperado, (int, float)):
+        try:
+            return abs(float(obtenido) - float(esperado)) < 0.01
+        except (TypeError, ValueError):
+            return False
+    return str(esperado).strip().upper() == str(obtenido or "").strip().upper()
+
+
+def _percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+async def _medir(prompt, contents, esperado):
+    inicio = time.perf_counter()
+    datos = await extraer_datos(prompt, contents)
+    latencia = time.perf_counter() - inicio
+    aciertos = sum(_igual(v, datos.get(k)) for k, v in esperado.items())
+    return latencia, aciertos
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--carpeta", default="uploads")
+    parser.add_argument("--tipo", default="compra", choices=list(PROMPTS))
+    parser.add_argument("--esperado", help="JSON con los valores correctos por archivo")
+    parser.add_argument("--salida", help="Guardar el reporte en este archivo JSON")
+    args = parser.parse_args()
+
+    esperados = {}
+    if args.esperado:
+        with open(args.esperado, encoding="utf-8") as f:
+            esperados = json.load(f)
+
+    prompt, _ = PROMPTS[args.tipo]
+    archivos = sorted(a for a in os.listdir(args.carpeta) if a.lower().endswith(EXTENSIONES))
+    variantes = {"original": {"bytes": [], "latencia": [], "aciertos": 0, "campos": 0},
+                 "preprocesado": {"bytes": [], "latencia": [], "aciertos": 0, "campos": 0, "preprocesado_s": []}}
+
+    for nombre in archivos:
+        with open(os.path.join(args.carpeta, nombre), "rb") as f:
+            original = f.read()
+        inicio = time.perf_counter()
+        procesado, _ = preprocesar_imagen(original)
+        variantes["preprocesado"]["preprocesado_s"].append(time.perf_counter() - inicio)
+
+        esperado = esperados.get(nombre, {})
+        for variante, contents in (("original", original), ("preprocesado", procesado)):
+            latencia, aciertos = await _medir(prompt, contents, esperado)
+            v = variantes[variante]
+            v["bytes"].append(len(contents))
+            v["latencia"].append(latencia)
+            v["aciertos"] += aciertos
+            v["campos"] += len(esperado)
+        print(f"{nombre}: {len(original)} -> {len(procesado)} bytes")
+
+    reporte = {"archivos": len(archivos)}
+    for variante, v in variantes.items():
+        reporte[variante] = {
+            "bytes_promedio": statistics.mean(v["bytes"]) if v["bytes"] else 0,
+            "latencia_p50_s": _percentil(v["latencia"], 50),
+            "latencia_p95_s": _percentil(v["latencia"], 95),
+            "precision": round(v["aciertos"] / v["campos"], 4) if v["campos"] else None
+        }
+        if "preprocesado_s" in v:
+            reporte[variante]["preprocesado_p50_s"] = _percentil(v["preprocesado_s"], 50)
+
+    print(json.dumps(reporte, indent=2))
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(reporte, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,499 @@
+"""Prueba de carga reproducible de la API con un Gemini falso.
+
+Levanta la app en un proceso aparte (uvicorn, en una carpeta temporal con su
+propio contabilidad.db), siembra usuarios y comprobantes, y la golpea con
+usuarios virtuales concurrentes que escanean, confirman, listan, abren el
+detalle y eliminan. El Gemini falso responde con la latencia y la tasa de
+errores que se le pidan, así los números no dependen de la red ni de la cuota.
+
+Uso (desde backend_facturas/):
+
+    py bench/carga.py correr --usuarios 20 --documentos 2000 --concurrencia 16 --duracion 60 --salida antes.json
+    py bench/carga.py correr --latencia-ms 800 --errores 0.05 --mezcla escanear=1,confirmar=1,listar=6,detalle=6,eliminar=1
+    py bench/carga.py correr --mezcla escanear=2,confirmar=2,sincronizar=6,detalle=6,eliminar=1
+    py bench/carga.py correr --workers 4 --salida cuatro_workers.json
+    py bench/carga.py comparar antes.json despues.json
+
+El reporte JSON trae, por endpoint, peticiones, estados, throughput y latencias
+p50/p95/p99; además las etapas medidas por el servidor (sacadas de /metrics).
+Con la misma --semilla cada usuario virtual repite la misma secuencia de
+operaciones y el Gemini falso las mismas respuestas.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+DIR_BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEZCLA_DEFECTO = "escanear=2,confirmar=2,listar=6,detalle=6,eliminar=1"
+OPERACIONES = ("escanear", "confirmar", "listar", "sincronizar", "detalle", "eliminar")
+DOCUMENTOS_POR_TRANSACCION = 500
+PASSWORD_CARGA = "bench"
+PRODUCTOS = ("cemento", "fierro 1/2", "arena gruesa", "pintura latex", "ladrillo king kong", "clavos 3\"",
+             "tubo pvc", "cable thw", "servicio de flete", "alquiler de mezcladora", "gasolina 90", "útiles de oficina")
+
+
+# --- Servidor -------------------------------------------------------------
+
+class GeminiFalso:
+    """Reemplaza a client.aio.models: misma firma de generate_content, con
+    latencia log-normal y errores 429/503 según las tasas configuradas."""
+
+    def __init__(self, latencia_ms: float, dispersion: float, errores: float, semilla: int):
+        self.latencia_ms = latencia_ms
+        self.dispersion = dispersion
+        self.errores = errores
+        self.azar = random.Random(semilla)
+
+    async def generate_content(self, model, contents, config=None):
+        from google.genai import errors as genai_errors
+        # mu tal que la media de la log-normal sea latencia_ms
+        mu = -self.dispersion ** 2 / 2
+        await asyncio.sleep(self.latencia_ms / 1000 * self.azar.lognormvariate(mu, self.dispersion))
+        if self.azar.random() < self.errores:
+            codigo = self.azar.choice((429, 503))
+            cuerpo = {"error": {"code": codigo, "message": "falla simulada", "status": "SIMULADO"}}
+            raise (genai_errors.ClientError if codigo < 500 else genai_errors.ServerError)(codigo, cuerpo)
+
+        imagen = next(c for c in contents if not isinstance(c, str))
+        texto = json.dumps(_comprobante_falso(hashlib.sha1(imagen.inline_data.data).digest()))
+        uso = SimpleNamespace(prompt_token_count=1200, candidates_token_count=len(texto) // 4)
+        return SimpleNamespace(text=texto, usage_metadata=uso)
+
+
+def _comprobante_falso(semilla: bytes) -> dict:
+    """Comprobante verosímil y estable para una misma semilla (el hash de la imagen).
+    Pasa la validación: RUC con dígito verificador, serie acorde al tipo y montos que cuadran."""
+    from validacion import digito_ruc, TASA_IGV
+    azar = random.Random(semilla)
+    items = []
+    for _ in range(azar.randint(1, 6)):
+        cantidad = azar.randint(1, 20)
+        precio = round(azar.uniform(1, 300), 2)
+        items.append({"descripcion": azar.choice(PRODUCTOS), "cantidad": cantidad,
+                      "precio_unitario": precio, "total": round(cantidad * precio, 2)})
+    tipo_comprobante = azar.choice(("Factura", "Boleta"))
+    total = round(sum(i["total"] for i in items), 2)
+    base = round(total / (1 + TASA_IGV), 2)
+    datos = {
+        "fecha_emision": f"{azar.randint(1, 28):02d}/{azar.randint(1, 12):02d}/{azar.choice((2024, 2025))}",
+        "tipo_comprobante": tipo_comprobante,
+        "serie": f"{tipo_comprobante[0]}{azar.randint(1, 20):03d}",
+        "numero": str(int.from_bytes(semilla[:4], "big") % 10 ** 8),
+        "base_imponible": base,
+        "igv": round(total - base, 2),
+        "monto_total": total,
+        "items": items,
+    }
+    proveedor = azar.randint(1, 300)
+    ruc = f"20{proveedor:08d}"
+    datos.update(proveedor_ruc=f"{ruc}{digito_ruc(ruc)}", proveedor_razon_social=f"PROVEEDOR {proveedor} S.A.C.",
+                 proveedor_direccion=f"AV. LOS OLIVOS {proveedor}", proveedor_telefono="")
+    return datos
+
+
+def _sembrar(main, usuarios: int, documentos: int, semilla: int):
+    """Usuarios con volúmenes desparejos (unos pocos con muchos comprobantes,
+    como en producción), insertados con el mismo SQL que usa la app."""
+    from db import obtener_conexion, transaccion
+    if obtener_conexion().execute("SELECT COUNT(*) FROM usuarios WHERE email LIKE 'carga%@bench'").fetchone()[0]:
+        return
+    from autenticacion import hashear_password
+    azar = random.Random(semilla)
+    password_hash = hashear_password(PASSWORD_CARGA)  # un solo scrypt para todos
+    pesos = [1 / (i + 1) for i in range(usuarios)]
+    escala = documentos * usuarios / sum(pesos)
+    for indice, peso in enumerate(pesos):
+        with transaccion() as conn:
+            user_id = conn.execute(
+                "INSERT INTO usuarios (email, password, nombre_completo) VALUES (?, ?, ?)",
+                (f"carga{indice}@bench", password_hash, f"Usuario carga {indice}")
+            ).lastrowid
+        restantes = max(1, int(peso * escala))
+        while restantes:
+            cantidad = min(restantes, DOCUMENTOS_POR_TRANSACCION)
+            with transaccion() as conn:
+                for _ in range(cantidad):
+                    datos = _comprobante_falso(azar.randbytes(16))
+                    id_padre = conn.execute(main.SQL_INSERTAR_CABECERA["compra"],
+                                            main._fila_cabecera("compra", user_id, datos)).lastrowid
+                    conn.executemany(main.SQL_INSERTAR_ITEM, main._filas_items("compra", id_padre, datos["items"]))
+            restantes -= cantidad
+
+
+def crear_app_falsa():
+    """Factory para uvicorn: cada worker arma su app con su propio Gemini falso."""
+    import extraccion
+    import main
+    falso = GeminiFalso(float(os.environ["CARGA_LATENCIA_MS"]), float(os.environ["CARGA_DISPERSION"]),
+                        float(os.environ["CARGA_ERRORES"]), int(os.environ["CARGA_SEMILLA"]))
+    extraccion.client = SimpleNamespace(aio=SimpleNamespace(models=falso))
+    return main.crear_app()
+
+
+def servidor(args):
+    os.chdir(args.dir)
+    sys.path.insert(0, DIR_BACKEND)
+    os.environ.setdefault("GOOGLE_API_KEY", "bench")
+    os.environ.update(CARGA_LATENCIA_MS=str(args.latencia_ms), CARGA_DISPERSION=str(args.dispersion),
+                      CARGA_ERRORES=str(args.errores), CARGA_SEMILLA=str(args.semilla))
+    import main
+    import uvicorn
+    from observabilidad import preparar_metricas_multiproceso
+    from migraciones import aplicar_migraciones
+    aplicar_migraciones()
+    _sembrar(main, args.usuarios, args.documentos, args.semilla)
+    if args.workers > 1:
+        preparar_metricas_multiproceso()
+    uvicorn.run("carga:crear_app_falsa", factory=True, host="127.0.0.1", port=args.puerto,
+                workers=args.workers, log_level="warning", access_log=False)
+
+
+# --- Cliente --------------------------------------------------------------
+
+def _imagen_unica(numero: int, azar: random.Random) -> bytes:
+    # Cada escaneo es una foto distinta: si se repitieran, solo se mediría la caché
+    from PIL import Image, ImageDraw
+    img = Image.new("RGB", (900, 1300), "white")
+    dibujo = ImageDraw.Draw(img)
+    dibujo.text((60, 60), f"FACTURA ELECTRONICA N {numero}", fill="black")
+    for fila in range(azar.randint(8, 25)):
+        y = 160 + fila * 40
+        dibujo.text((60, y), f"{azar.choice(PRODUCTOS)}  x{azar.randint(1, 9)}  {azar.uniform(1, 500):.2f}", fill="black")
+        dibujo.line((60, y + 30, 840, y + 30), fill=(200, 200, 200))
+    salida = io.BytesIO()
+    img.save(salida, "JPEG", quality=85)
+    return salida.getvalue()
+
+
+def _leer_mezcla(texto: str) -> dict:
+    mezcla = {}
+    for parte in texto.split(","):
+        nombre, _, peso = parte.partition("=")
+        if nombre.strip() not in OPERACIONES:
+            raise SystemExit(f"Operación desconocida en --mezcla: {nombre}")
+        mezcla[nombre.strip()] = float(peso)
+    return mezcla
+
+
+class UsuarioVirtual:
+    """Un cliente de la app: trabaja siempre sobre el mismo usuario y recuerda
+    lo que escaneó (para confirmarlo) y los ids que vio (para abrirlos o borrarlos)."""
+
+    def __init__(self, http, user_id: int, token: str, mezcla: dict, semilla: int, contador: list, registrar):
+        self.http = http
+        self.user_id = user_id
+        self.cabeceras = {"Authorization": f"Bearer {token}"}
+        self.operaciones = list(mezcla)
+        self.pesos = list(mezcla.values())
+        self.azar = random.Random(semilla)
+        self.contador = contador
+        self.registrar = registrar
+        self.escaneados = []
+        self.ids = []
+        self.token_sync = None
+
+    async def _llamar(self, operacion: str, metodo: str, url: str, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            respuesta = await self.http.request(metodo, url, headers=self.cabeceras, **kwargs)
+            estado = respuesta.status_code
+        except Exception as e:
+            respuesta, estado = None, type(e).__name__
+        self.registrar(operacion, estado, time.perf_counter() - inicio)
+        return respuesta
+
+    async def paso(self):
+        operacion = self.azar.choices(self.operaciones, self.pesos)[0]
+        # Sin nada escaneado no hay qué confirmar; sin ids, nada que abrir ni borrar
+        if operacion == "confirmar" and not self.escaneados:
+            operacion = "escanear"
+        if operacion in ("detalle", "eliminar") and not self.ids:
+            operacion = "listar" if "listar" in self.operaciones else "sincronizar"
+
+        if operacion == "escanear":
+            self.contador[0] += 1
+            imagen = await asyncio.to_thread(_imagen_unica, self.contador[0], self.azar)
+            r = await self._llamar(operacion, "POST", "/escanear-compra/", data={"user_id": self.user_id},
+                                   files={"file": ("recibo.jpg", imagen, "image/jpeg")})
+            if r is not None and r.status_code == 200:
+                self.escaneados.append(r.json()["datos"])
+        elif operacion == "confirmar":
+            datos = self.escaneados.pop()
+            await self._llamar(operacion, "POST", "/guardar-confirmado/",
+                               json={"tipo": "compra", "user_id": self.user_id, "datos": datos})
+        elif operacion == "listar":
+            r = await self._llamar(operacion, "GET", "/obtener-registros/compras",
+                                   params={"user_id": self.user_id, "limit": 50})
+            if r is not None and r.status_code == 200:
+                self.ids = [fila["id"] for fila in r.json()["datos"]]
+        elif operacion == "sincronizar":
+            # Como la app: el primer sync baja todo y los siguientes solo lo que cambió
+            r = await self._llamar(operacion, "GET", "/sync", params={"since": self.token_sync} if self.token_sync else None)
+            if r is not None and r.status_code == 200:
+                cambios = r.json()
+                if cambios["completo"]:
+                    self.ids = []
+                nuevos = [c["id_gasto"] for c in cambios["compras"]]
+                fuera = set(cambios["eliminados"]["compras"]) | set(nuevos)
+                self.ids = [i for i in self.ids if i not in fuera] + nuevos
+                self.token_sync = cambios["token"]
+        elif operacion == "detalle":
+            await self._llamar(operacion, "GET", f"/obtener-detalle/compras/{self.azar.choice(self.ids)}")
+        else:
+            id_registro = self.ids.pop(self.azar.randrange(len(self.ids)))
+            await self._llamar(operacion, "DELETE", f"/eliminar-registro/compras/{id_registro}")
+
+
+def _percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def _resumir(latencias: list, estados: dict, segundos: float) -> dict:
+    ms = [l * 1000 for l in latencias]
+    return {
+        "peticiones": len(ms),
+        "errores": sum(n for estado, n in estados.items() if not str(estado).startswith("2")),
+        "estados": {str(k): v for k, v in sorted(estados.items(), key=lambda e: str(e[0]))},
+        "rps": round(len(ms) / segundos, 2) if segundos else 0,
+        "media_ms": round(statistics.mean(ms), 2) if ms else 0,
+        "p50_ms": round(_percentil(ms, 50), 2),
+        "p95_ms": round(_percentil(ms, 95), 2),
+        "p99_ms": round(_percentil(ms, 99), 2),
+        "max_ms": round(max(ms), 2) if ms else 0,
+    }
+
+
+def _histogramas(texto: str) -> dict:
+    """(grupo, etiqueta) -> [suma, cuenta] de los histogramas de etapas y de base en /metrics."""
+    from prometheus_client.parser import text_string_to_metric_families
+    grupos = {"qonta_etapa_duracion_segundos": ("etapas", "etapa"), "qonta_db_duracion_segundos": ("db", "operacion")}
+    valores = {}
+    for familia in text_string_to_metric_families(texto):
+        if familia.name not in grupos:
+            continue
+        grupo, etiqueta = grupos[familia.name]
+        for muestra in familia.samples:
+            clave = (grupo, muestra.labels.get(etiqueta))
+            if muestra.name.endswith("_sum"):
+                valores.setdefault(clave, [0, 0])[0] = muestra.value
+            elif muestra.name.endswith("_count"):
+                valores.setdefault(clave, [0, 0])[1] = muestra.value
+    return valores
+
+
+def _metricas_servidor(antes: str, despues: str) -> dict:
+    """Promedio por etapa y por operación de base durante la ventana medida."""
+    inicial = _histogramas(antes)
+    resumen = {"etapas": {}, "db": {}}
+    for (grupo, clave), (suma, cuenta) in sorted(_histogramas(despues).items()):
+        suma_antes, cuenta_antes = inicial.get((grupo, clave), (0, 0))
+        if cuenta > cuenta_antes:
+            resumen[grupo][clave] = {"veces": int(cuenta - cuenta_antes),
+                                     "media_ms": round((suma - suma_antes) / (cuenta - cuenta_antes) * 1000, 2)}
+    return resumen
+
+
+def _version() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=DIR_BACKEND,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "desconocida"
+
+
+async def _esperar_servidor(http, proceso, timeout: float):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        if proceso.poll() is not None:
+            raise SystemExit(f"El servidor terminó al arrancar (código {proceso.returncode}), ver servidor.log")
+        try:
+            if (await http.get("/metrics")).status_code == 200:
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit("El servidor no respondió a tiempo")
+
+
+async def correr_carga(args) -> dict:
+    import httpx
+    mezcla = _leer_mezcla(args.mezcla)
+    directorio = args.dir or tempfile.mkdtemp(prefix="qonta_carga_")
+    os.makedirs(directorio, exist_ok=True)
+    if args.base:
+        shutil.copy(args.base, os.path.join(directorio, "contabilidad.db"))
+
+    comando = [sys.executable, os.path.abspath(__file__), "servidor", "--dir", directorio, "--puerto", str(args.puerto),
+               "--usuarios", str(args.usuarios), "--documentos", str(args.documentos), "--semilla", str(args.semilla),
+               "--latencia-ms", str(args.latencia_ms), "--dispersion", str(args.dispersion), "--errores", str(args.errores),
+               "--workers", str(args.workers)]
+    log = open(os.path.join(directorio, "servidor.log"), "wb")
+    proceso = subprocess.Popen(comando, stdout=log, stderr=subprocess.STDOUT)
+    limites = httpx.Limits(max_connections=args.concurrencia, max_keepalive_connections=args.concurrencia)
+    try:
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.puerto}", timeout=120, limits=limites) as http:
+            await _esperar_servidor(http, proceso, args.espera_arranque)
+            # Si ya responde, la siembra terminó
+            sesiones = await _iniciar_sesiones(http, directorio)
+
+            latencias = {op: [] for op in OPERACIONES}
+            estados = {op: {} for op in OPERACIONES}
+            midiendo = [False]
+
+            def registrar(operacion, estado, duracion):
+                if midiendo[0]:
+                    latencias[operacion].append(duracion)
+                    estados[operacion][estado] = estados[operacion].get(estado, 0) + 1
+
+            contador = [0]
+            virtuales = [UsuarioVirtual(http, *sesiones[i % len(sesiones)], mezcla, args.semilla + i, contador, registrar)
+                         for i in range(args.concurrencia)]
+            fin = [False]
+
+            async def bucle(virtual):
+                while not fin[0]:
+                    await virtual.paso()
+
+            tareas = [asyncio.create_task(bucle(v)) for v in virtuales]
+            await asyncio.sleep(args.calentamiento)
+            metricas_inicio = (await http.get("/metrics")).text
+            midiendo[0] = True
+            inicio = time.perf_counter()
+            await asyncio.sleep(args.duracion)
+            midiendo[0] = False
+            segundos = time.perf_counter() - inicio
+            fin[0] = True
+            await asyncio.gather(*tareas, return_exceptions=True)
+            metricas_fin = (await http.get("/metrics")).text
+    finally:
+        proceso.terminate()
+        proceso.wait(timeout=30)
+        log.close()
+
+    todas = [l for op in OPERACIONES for l in latencias[op]]
+    todos_estados = {}
+    for op in OPERACIONES:
+        for estado, n in estados[op].items():
+            todos_estados[estado] = todos_estados.get(estado, 0) + n
+    reporte = {
+        "version": _version(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("comando", "salida", "funcion")},
+        "duracion_s": round(segundos, 2),
+        "total": _resumir(todas, todos_estados, segundos),
+        "endpoints": {op: _resumir(latencias[op], estados[op], segundos) for op in OPERACIONES if latencias[op]},
+        "servidor": _metricas_servidor(metricas_inicio, metricas_fin),
+        "carpeta": directorio,
+    }
+    if not args.dir and not args.conservar:
+        shutil.rmtree(directorio, ignore_errors=True)
+        reporte["carpeta"] = None
+    return reporte
+
+
+def _emails_sembrados(directorio: str) -> list:
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(directorio, "contabilidad.db"))
+    try:
+        return [row[0] for row in conn.execute("SELECT email FROM usuarios WHERE email LIKE 'carga%@bench' ORDER BY id_usuario")]
+    finally:
+        conn.close()
+
+
+async def _iniciar_sesiones(http, directorio: str) -> list:
+    """(user_id, token) de cada usuario sembrado; el login queda fuera de la medición."""
+    sesiones = []
+    for email in _emails_sembrados(directorio):
+        r = await http.post("/login/", json={"email": email, "password": PASSWORD_CARGA})
+        r.raise_for_status()
+        sesiones.append((r.json()["usuario"]["id"], r.json()["token"]))
+    return sesiones
+
+
+def correr(args):
+    reporte = asyncio.run(correr_carga(args))
+    texto = json.dumps(reporte, indent=2, ensure_ascii=False)
+    print(texto)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            f.write(texto)
+
+
+def comparar(args):
+    """Diferencia por endpoint entre dos reportes (negativo = mejoró la latencia)."""
+    with open(args.antes, encoding="utf-8") as f:
+        antes = json.load(f)
+    with open(args.despues, encoding="utf-8") as f:
+        despues = json.load(f)
+    print(f"{antes['version']} -> {despues['version']}")
+    campos = ("rps", "p50_ms", "p95_ms", "p99_ms", "errores")
+    print(f"{'endpoint':<12}" + "".join(f"{c:>22}" for c in campos))
+    for nombre in ["total"] + sorted(set(antes["endpoints"]) | set(despues["endpoints"])):
+        a = antes["total"] if nombre == "total" else antes["endpoints"].get(nombre, {})
+        d = despues["total"] if nombre == "total" else despues["endpoints"].get(nombre, {})
+        celdas = []
+        for campo in campos:
+            va, vd = a.get(campo, 0), d.get(campo, 0)
+            cambio = f"{(vd - va) / va * 100:+.0f}%" if va else "n/a"
+            celdas.append(f"{va:>8} -> {vd:<8} {cambio:>4}")
+        print(f"{nombre:<12}" + "".join(f"{c:>22}" for c in celdas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    comandos = parser.add_subparsers(dest="comando", required=True)
+
+    def opciones_servidor(p):
+        p.add_argument("--usuarios", type=int, default=20, help="Usuarios a sembrar")
+        p.add_argument("--documentos", type=int, default=1000, help="Comprobantes por usuario, en promedio")
+        p.add_argument("--semilla", type=int, default=42)
+        p.add_argument("--latencia-ms", type=float, default=1500, help="Latencia media del Gemini falso")
+        p.add_argument("--dispersion", type=float, default=0.4, help="Sigma de la log-normal de latencias")
+        p.add_argument("--errores", type=float, default=0.0, help="Fracción de llamadas a Gemini que fallan (429/503)")
+        p.add_argument("--puerto", type=int, default=8765)
+        p.add_argument("--workers", type=int, default=1, help="Procesos de uvicorn")
+
+    p = comandos.add_parser("correr", help="Siembra, levanta la app y mide")
+    opciones_servidor(p)
+    p.add_argument("--concurrencia", type=int, default=16, help="Usuarios virtuales en paralelo")
+    p.add_argument("--duracion", type=float, default=60, help="Segundos medidos")
+    p.add_argument("--calentamiento", type=float, default=5, help="Segundos iniciales que no se miden")
+    p.add_argument("--mezcla", default=MEZCLA_DEFECTO, help="Peso de cada operación")
+    p.add_argument("--base", help="Partir de una copia de este contabilidad.db (nunca se modifica el original)")
+    p.add_argument("--dir", help="Carpeta de trabajo (por defecto una temporal que se borra al final)")
+    p.add_argument("--conservar", action="store_true", help="No borrar la carpeta temporal")
+    p.add_argument("--espera-arranque", type=float, default=300, help="Segundos para sembrar y arrancar")
+    p.add_argument("--salida", help="Guardar el reporte en este archivo JSON")
+    p.set_defaults(funcion=correr)
+
+    p = comandos.add_parser("comparar", help="Diferencias entre dos reportes")
+    p.add_argument("antes")
+    p.add_argument("despues")
+    p.set_defaults(funcion=comparar)
+
+    p = comandos.add_parser("servidor", help=argparse.SUPPRESS)
+    opciones_servidor(p)
+    p.add_argument("--dir", required=True)
+    p.set_defaults(funcion=servidor)
+
+    args = parser.parse_args()
+    args.funcion(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import re
+from db import obtener_conexion
+
+# Índice FTS5 de búsqueda: una fila por comprobante con la contraparte, su
+# RUC/DNI y las descripciones de sus items. Los triggers (migración 4) lo
+# mantienen sincronizado. El rowid codifica el comprobante (id*2 compra,
+# id*2+1 venta) para que actualizar una fila sea por rowid y no un scan.
+# El usuario va como token indexado ("u12") para filtrar dentro del MATCH.
+
+BUSQUEDA_POR_PAGINA_MAX = 100
+
+SQL_TABLA_BUSQUEDA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS busqueda_fts USING fts5(
+        usuario, contraparte, documento, items,
+        tipo UNINDEXED, id_registro UNINDEXED, fecha UNINDEXED, monto UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+'''
+
+# tipo -> (tabla, columna id, contraparte, documento, monto, desplazamiento del rowid)
+FUENTES = {
+    "compra": ("compras_sire", "id_gasto", "proveedor_razon_social", "proveedor_ruc", "monto_total", 0),
+    "venta": ("ventas_sire", "id_transaccion", "cliente_razon_social", "cliente_nro_doc", "total_cp", 1),
+}
+
+# Más peso a un acierto en el nombre o RUC que en la descripción de un item
+PESOS_BM25 = "0.0, 10.0, 5.0, 1.0"
+
+
+def _valores(tipo: str, f: str) -> str:
+    _, columna_id, contraparte, documento, monto, desplazamiento = FUENTES[tipo]
+    return (f"{f}{columna_id} * 2 + {desplazamiento}, 'u' || {f}user_id, {f}{contraparte}, {f}{documento}, "
+            f"'{tipo}', {f}{columna_id}, {f}fecha_emision, {f}{monto}")
+
+
+def sql_triggers_busqueda() -> list:
+    sentencias = []
+    for tipo, (tabla, columna_id, contraparte, documento, monto, desplazamiento) in FUENTES.items():
+        rowid = f"{columna_id} * 2 + {desplazamiento}"
+        sentencias += [
+            f'''CREATE TRIGGER IF NOT EXISTS trg_busqueda_{tabla}_ins AFTER INSERT ON {tabla} BEGIN
+                INSERT INTO busqueda_fts (rowid, usuario, contraparte, documento, tipo, id_registro, fecha, monto, items)
+                VALUES ({_valores(tipo, "NEW.")}, '');
+            END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_busqueda_{tabla}_del AFTER DELETE ON {tabla} BEGIN
+                DELETE FROM busqueda_fts WHERE rowid = OLD.{rowid};
+            END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_busqueda_{tabla}_upd
+                AFTER UPDATE OF user_id, {contraparte}, {documento}, fecha_emision, {monto} ON {tabla} BEGIN
+                UPDATE busqueda_fts SET usuario = 'u' || NEW.user_id, contraparte = NEW.{contraparte},
+                    documento = NEW.{documento}, fecha = NEW.fecha_emision, monto = NEW.{monto}
+                WHERE rowid = NEW.{rowid};
+            END''',
+        ]
+    rowid_item = "{f}id_padre * 2 + ({f}tipo_registro = 'venta')"
+    sentencias += [
+        # Los items llegan después de la cabecera: se van concatenando
+        f'''CREATE TRIGGER IF NOT EXISTS trg_busqueda_items_ins AFTER INSERT ON detalle_items BEGIN
+            UPDATE busqueda_fts SET items = ltrim(items || ' ' || COALESCE(NEW.descripcion, ''))
+            WHERE rowid = {rowid_item.format(f="NEW.")};
+        END''',
+        f'''CREATE TRIGGER IF NOT EXISTS trg_busqueda_items_del AFTER DELETE ON detalle_items BEGIN
+            UPDATE busqueda_fts SET items = COALESCE((
+                SELECT group_concat(descripcion, ' ') FROM detalle_items
+                WHERE tipo_registro = OLD.tipo_registro AND id_padre = OLD.id_padre
+            ), '')
+            WHERE rowid = {rowid_item.format(f="OLD.")};
+        END''',
+    ]
+    return sentencias
+
+
+def sql_poblar_busqueda() -> list:
+    sentencias = ["DELETE FROM busqueda_fts"]
+    for tipo, (tabla, columna_id, *_) in FUENTES.items():
+        sentencias.append(f'''
+            INSERT INTO busqueda_fts (rowid, usuario, contraparte, documento, tipo, id_registro, fecha, monto, items)
+            SELECT {_valores(tipo, "")}, COALESCE((
+                SELECT group_concat(descripcion, ' ') FROM detalle_items
+                WHERE tipo_registro = '{tipo}' AND id_padre = {columna_id}
+            ), '')
+            FROM {tabla}
+        ''')
+    return sentencias
+
+
+def expresion_busqueda(user_id: int, texto: str):
+    """Arma el MATCH: cada palabra como prefijo y todas obligatorias, solo en las
+    columnas buscables y dentro de los documentos del usuario. None si no hay palabras."""
+    palabras = re.findall(r"\w+", texto)
+    if not palabras:
+        return None
+    terminos = " AND ".join(f'"{p}"*' for p in palabras)
+    return f'usuario : "u{int(user_id)}" AND {{contraparte documento items}} : ({terminos})'
+
+
+def buscar_documentos(user_id: int, texto: str, tipo: str = None, limit: int = 20, offset: int = 0):
+    """Hits ordenados por relevancia (bm25). Devuelve (resultados, siguiente offset o None)."""
+    expresion = expresion_busqueda(user_id, texto)
+    if expresion is None:
+        return [], None
+    sql = '''
+        SELECT tipo, id_registro, contraparte, documento, fecha, monto,
+               snippet(busqueda_fts, 3, '[', ']', '…', 8) AS fragmento
+        FROM busqueda_fts
+        WHERE busqueda_fts MATCH ?
+    '''
+    params = [expresion]
+    if tipo:
+        sql += " AND tipo = ?"
+        params.append(tipo)
+    sql += f" ORDER BY bm25(busqueda_fts, {PESOS_BM25}) LIMIT ? OFFSET ?"
+    params += [limit + 1, offset]
+
+    rows = obtener_conexion().execute(sql, params).fetchall()
+    siguiente = offset + limit if len(rows) > limit else None
+    resultados = [{
+        "tipo": r["tipo"],
+        "id": r["id_registro"],
+        "titulo": r["contraparte"],
+        "documento": r["documento"],
+        "fecha": r["fecha"],
+        "monto": r["monto"],
+        "fragmento": r["fragmento"] if r["fragmento"] and "[" in r["fragmento"] else None
+    } for r in rows[:limit]]
+    return resultados, siguiente
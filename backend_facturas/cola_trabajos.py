@@ -0,0 +1,266 @@
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from urllib.parse import urlsplit
+import httpx
+from google.genai import errors as genai_errors
+from db import obtener_conexion, transaccion, en_db
+from extraccion import cache_extraccion, PROMPTS
+from extractores import extraer_comprobante, registrar_extraccion
+from maestro import completar_datos
+from validacion import validar
+from observabilidad import logger, nuevo_trace_id
+
+# Workers que procesan la cola y política de reintentos ante 429/5xx de Gemini
+COLA_WORKERS = int(os.getenv("COLA_WORKERS", "2"))
+COLA_MAX_INTENTOS = int(os.getenv("COLA_MAX_INTENTOS", "5"))
+COLA_BACKOFF_BASE = float(os.getenv("COLA_BACKOFF_BASE", "2"))
+COLA_BACKOFF_MAX = float(os.getenv("COLA_BACKOFF_MAX", "300"))
+COLA_ESPERA_VACIA = 1.0
+# Un trabajo 'procesando' sin cambios por más de esto se da por abandonado (su worker murió)
+COLA_TRABAJO_VENCIDO = float(os.getenv("COLA_TRABAJO_VENCIDO", "300"))
+# Los trabajos terminados se guardan unos días (la app consulta el resultado) y después se purgan
+COLA_RETENCION_DIAS = float(os.getenv("COLA_RETENCION_DIAS", "7"))
+# Webhooks: solo https a hosts públicos; con COLA_WEBHOOK_HOSTS, además solo esos hosts
+COLA_WEBHOOK_HOSTS = {h.strip().lower() for h in os.getenv("COLA_WEBHOOK_HOSTS", "").split(",") if h.strip()}
+COLA_WEBHOOK_TIMEOUT = float(os.getenv("COLA_WEBHOOK_TIMEOUT", "5"))
+
+SQL_TABLA_TRABAJOS = '''
+    CREATE TABLE IF NOT EXISTS trabajos_escaneo (
+        id_trabajo TEXT PRIMARY KEY,
+        user_id INTEGER,
+        tipo TEXT,              -- 'compra' o 'venta'
+        ruta_imagen TEXT,
+        estado TEXT DEFAULT 'pendiente', -- pendiente, procesando, completado, error
+        intentos INTEGER DEFAULT 0,
+        proximo_intento REAL DEFAULT 0,
+        resultado TEXT,
+        error TEXT,
+        webhook_url TEXT,
+        creado REAL,
+        actualizado REAL
+    )
+'''
+SQL_INDICE_TRABAJOS = "CREATE INDEX IF NOT EXISTS idx_trabajos_pendientes ON trabajos_escaneo (estado, proximo_intento)"
+
+
+_hay_trabajo = asyncio.Event()
+_tareas_workers = []
+_notificaciones = set()
+
+
+def _insertar_trabajo(user_id: int, tipo: str, ruta_imagen: str, webhook_url: str = None, resultado=None) -> str:
+    """Con `resultado`, el trabajo nace completado (la extracción salió de la caché)."""
+    id_trabajo = str(uuid.uuid4())
+    ahora = time.time()
+    estado = "pendiente" if resultado is None else "completado"
+    with transaccion() as conn:
+        conn.execute('''
+            INSERT INTO trabajos_escaneo (id_trabajo, user_id, tipo, ruta_imagen, estado, resultado, webhook_url, creado, actualizado)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (id_trabajo, user_id, tipo, ruta_imagen, estado,
+              json.dumps(resultado) if resultado is not None else None, webhook_url, ahora, ahora))
+    return id_trabajo
+
+
+async def encolar_trabajo(user_id: int, tipo: str, ruta_imagen: str, webhook_url: str = None) -> str:
+    id_trabajo = await en_db(_insertar_trabajo, user_id, tipo, ruta_imagen, webhook_url)
+    # Une el trace del request que encola con el del trabajo (trabajo-{id})
+    logger.info("Trabajo encolado", extra={"id_trabajo": id_trabajo, "tipo": tipo, "user_id": user_id})
+    _hay_trabajo.set()
+    return id_trabajo
+
+
+async def trabajo_completado(user_id: int, tipo: str, datos: dict, webhook_url: str = None) -> str:
+    """Pidieron un trabajo pero el resultado ya estaba en la caché: se registra
+    terminado, con el mismo contrato (job_id, /jobs/{id} y webhook) que uno encolado."""
+    id_trabajo = await en_db(_insertar_trabajo, user_id, tipo, datos.get("ruta_imagen"), webhook_url, datos)
+    logger.info("Trabajo resuelto por caché", extra={"id_trabajo": id_trabajo, "tipo": tipo, "user_id": user_id})
+    if webhook_url:
+        tarea = asyncio.create_task(_notificar_webhook(webhook_url, await en_db(obtener_trabajo, id_trabajo)))
+        # create_task solo guarda una referencia débil
+        _notificaciones.add(tarea)
+        tarea.add_done_callback(_notificaciones.discard)
+    return id_trabajo
+
+
+def obtener_trabajo(id_trabajo: str, user_id: int = None):
+    """Estado del trabajo; con user_id, solo si es de ese usuario."""
+    sql = "SELECT * FROM trabajos_escaneo WHERE id_trabajo = ?"
+    params = [id_trabajo]
+    if user_id is not None:
+        sql += " AND user_id = ?"
+        params.append(user_id)
+    row = obtener_conexion().execute(sql, params).fetchone()
+    if not row:
+        return None
+    trabajo = {
+        "id": row["id_trabajo"],
+        "tipo": row["tipo"],
+        "estado": row["estado"],
+        "intentos": row["intentos"],
+        "ruta_imagen": row["ruta_imagen"]
+    }
+    if row["resultado"]:
+        trabajo["datos"] = json.loads(row["resultado"])
+    if row["error"]:
+        trabajo["error"] = row["error"]
+    return trabajo
+
+
+def _reclamar_trabajo():
+    # BEGIN IMMEDIATE toma el lock de escritura, así dos workers nunca agarran el mismo trabajo
+    with transaccion() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # Lo que quedó a medias de un worker caído vuelve a la cola. No se puede
+        # resetear todo 'procesando' al arrancar: con varios workers, otro proceso
+        # puede estar trabajando en eso ahora mismo.
+        conn.execute(
+            "UPDATE trabajos_escaneo SET estado = 'pendiente' WHERE estado = 'procesando' AND actualizado < ?",
+            (time.time() - COLA_TRABAJO_VENCIDO,)
+        )
+        row = conn.execute('''
+            SELECT * FROM trabajos_escaneo
+            WHERE estado = 'pendiente' AND proximo_intento <= ?
+            ORDER BY creado LIMIT 1
+        ''', (time.time(),)).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE trabajos_escaneo SET estado = 'procesando', intentos = intentos + 1, actualizado = ? WHERE id_trabajo = ?",
+                (time.time(), row["id_trabajo"])
+            )
+        return dict(row) if row else None
+
+
+def _finalizar_trabajo(id_trabajo: str, estado: str, resultado=None, error=None, proximo_intento=0):
+    with transaccion() as conn:
+        conn.execute('''
+            UPDATE trabajos_escaneo
+            SET estado = ?, resultado = ?, error = ?, proximo_intento = ?, actualizado = ?
+            WHERE id_trabajo = ?
+        ''', (estado, json.dumps(resultado) if resultado is not None else None, error, proximo_intento, time.time(), id_trabajo))
+
+
+def purgar_trabajos() -> int:
+    """Borra los trabajos terminados (completados o con error) más viejos que la retención."""
+    with transaccion() as conn:
+        return conn.execute("DELETE FROM trabajos_escaneo WHERE estado IN ('completado', 'error') AND actualizado < ?",
+                            (time.time() - COLA_RETENCION_DIAS * 86400,)).rowcount
+
+
+def es_error_reintentable(e: Exception) -> bool:
+    if isinstance(e, asyncio.TimeoutError):
+        return True
+    if isinstance(e, genai_errors.APIError):
+        return e.code == 429 or (e.code or 0) >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+def espera_sugerida(e: Exception):
+    """Segundos que Gemini pide esperar en un 429 (RetryInfo.retryDelay, p. ej. "17s"), o None."""
+    if not isinstance(e, genai_errors.APIError) or not isinstance(e.details, dict):
+        return None
+    for detalle in (e.details.get("error") or {}).get("details") or []:
+        demora = str(detalle.get("retryDelay", "")) if isinstance(detalle, dict) else ""
+        if demora.endswith("s"):
+            try:
+                return float(demora[:-1])
+            except ValueError:
+                pass
+    return None
+
+
+async def validar_webhook(url: str):
+    """ValueError si la URL no es https o resuelve a una dirección interna
+    (loopback, red privada, link-local...): el servidor no debe poder usarse
+    para pegarle a su propia red."""
+    partes = urlsplit(url)
+    if partes.scheme != "https" or not partes.hostname:
+        raise ValueError("El webhook debe ser una URL https")
+    host = partes.hostname.lower()
+    if COLA_WEBHOOK_HOSTS and host not in COLA_WEBHOOK_HOSTS:
+        raise ValueError("Host de webhook no permitido")
+    try:
+        direcciones = await asyncio.get_running_loop().getaddrinfo(host, partes.port or 443, type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError):
+        raise ValueError("No se pudo resolver el host del webhook")
+    for *_, sockaddr in direcciones:
+        if not ipaddress.ip_address(sockaddr[0].split("%")[0]).is_global:
+            raise ValueError("El webhook apunta a una dirección interna")
+
+
+async def _notificar_webhook(url: str, trabajo: dict):
+    try:
+        # Se vuelve a validar: el DNS pudo cambiar desde que se encoló
+        await validar_webhook(url)
+        async with httpx.AsyncClient(timeout=COLA_WEBHOOK_TIMEOUT, follow_redirects=False) as http:
+            await http.post(url, json=trabajo)
+    except Exception as e:
+        logger.warning("Webhook falló", extra={"url": url, "error": str(e)})
+
+
+async def _procesar(trabajo: dict):
+    id_trabajo = trabajo["id_trabajo"]
+    # Cada trabajo tiene su trace id: el mismo que se devolvió al encolarlo
+    nuevo_trace_id(f"trabajo-{id_trabajo}")
+    version = PROMPTS[trabajo["tipo"]][1]
+    try:
+        with open(trabajo["ruta_imagen"], "rb") as f:
+            contents = f.read()
+        datos = await extraer_comprobante(trabajo["tipo"], contents)
+        datos['ruta_imagen'] = trabajo["ruta_imagen"]
+        cache_extraccion.guardar(cache_extraccion.clave(contents, version), datos)
+        await en_db(registrar_extraccion, trabajo["user_id"], trabajo["tipo"], datos)
+        datos = validar(trabajo["tipo"], await en_db(completar_datos, trabajo["tipo"], datos, trabajo["user_id"]))
+        await en_db(_finalizar_trabajo, id_trabajo, "completado", resultado=datos)
+    except Exception as e:
+        if es_error_reintentable(e) and trabajo["intentos"] < COLA_MAX_INTENTOS:
+            espera = min(COLA_BACKOFF_BASE * (2 ** trabajo["intentos"]), COLA_BACKOFF_MAX)
+            logger.warning("Trabajo reintenta", extra={"id_trabajo": id_trabajo, "espera_s": espera, "error": str(e)})
+            await en_db(_finalizar_trabajo, id_trabajo, "pendiente", error=str(e), proximo_intento=time.time() + espera)
+            return
+        logger.error("Trabajo falló", extra={"id_trabajo": id_trabajo, "error": str(e)})
+        await en_db(_finalizar_trabajo, id_trabajo, "error", error=str(e))
+
+    if trabajo["webhook_url"]:
+        await _notificar_webhook(trabajo["webhook_url"], await en_db(obtener_trabajo, id_trabajo))
+
+
+async def _worker():
+    while True:
+        try:
+            trabajo = await en_db(_reclamar_trabajo)
+        except sqlite3.OperationalError as e:
+            logger.warning("Cola ocupada", extra={"error": str(e)})
+            trabajo = None
+        if trabajo is None:
+            _hay_trabajo.clear()
+            try:
+                await asyncio.wait_for(_hay_trabajo.wait(), timeout=COLA_ESPERA_VACIA)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        try:
+            await _procesar(trabajo)
+        except Exception as e:
+            # Falló la base o el webhook fuera del manejo de _procesar: el worker
+            # sigue con el próximo; si el trabajo quedó 'procesando', vuelve a
+            # la cola cuando pase COLA_TRABAJO_VENCIDO
+            logger.error("Worker: error inesperado", extra={"id_trabajo": trabajo["id_trabajo"], "error": str(e)})
+
+
+def arrancar_workers():
+    for _ in range(COLA_WORKERS):
+        _tareas_workers.append(asyncio.create_task(_worker()))
+
+
+async def detener_workers():
+    for tarea in _tareas_workers:
+        tarea.cancel()
+    await asyncio.gather(*_tareas_workers, return_exceptions=True)
+    _tareas_workers.clear()
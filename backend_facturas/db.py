@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import functools
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from observabilidad import DB_DURACION, medir
+
+DB_PATH = os.getenv("DB_PATH", "contabilidad.db")
+
+# Hilos dedicados a SQLite: cada uno mantiene su propia conexión abierta
+DB_HILOS = int(os.getenv("DB_HILOS", "8"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_BYTES = int(os.getenv("DB_MMAP_BYTES", str(256 * 1024 * 1024)))
+DB_CACHE_SENTENCIAS = int(os.getenv("DB_CACHE_SENTENCIAS", "256"))
+
+_local = threading.local()
+_executor = ThreadPoolExecutor(max_workers=DB_HILOS, thread_name_prefix="sqlite")
+
+
+def _abrir_conexion(check_same_thread: bool = True) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=check_same_thread,
+        cached_statements=DB_CACHE_SENTENCIAS  # sentencias preparadas reutilizadas por SQL idéntico
+    )
+    conn.row_factory = sqlite3.Row
+    # WAL deja leer mientras otro escribe; con NORMAL el fsync solo ocurre en los checkpoints
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+@contextmanager
+def bloqueo_exclusivo(ruta: str):
+    """Lock entre procesos sobre un archivo; lo usan los workers al preparar el esquema."""
+    with open(ruta, "a+b") as archivo:
+        if os.name == "nt":
+            import msvcrt
+            archivo.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(archivo.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK se rinde a los 10 s; seguimos esperando
+        else:
+            import fcntl
+            fcntl.flock(archivo, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                archivo.seek(0)
+                msvcrt.locking(archivo.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(archivo, fcntl.LOCK_UN)
+
+
+def obtener_conexion() -> sqlite3.Connection:
+    """Conexión del hilo actual; se abre la primera vez y luego se reutiliza."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _abrir_conexion()
+        _local.conn = conn
+    return conn
+
+
+def abrir_conexion_dedicada() -> sqlite3.Connection:
+    """Conexión propia para un cursor largo (exportaciones) que se va leyendo
+    desde distintos hilos del pool, siempre de a uno. Quien la abre la cierra."""
+    return _abrir_conexion(check_same_thread=False)
+
+
+@contextmanager
+def transaccion():
+    """Commit si el bloque termina bien, rollback si lanza una excepción."""
+    conn = obtener_conexion()
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def _medido(funcion, *args, **kwargs):
+    with medir("db"), DB_DURACION.labels(funcion.__name__).time():
+        return funcion(*args, **kwargs)
+
+
+async def en_db(funcion, *args, **kwargs):
+    """Ejecuta `funcion` en el pool de hilos de SQLite para no bloquear el event loop.
+
+    run_in_executor no copia los contextvars: se pasa el contexto a mano para
+    que el trace id y los tiempos por etapa sigan al request dentro del hilo.
+    """
+    loop = asyncio.get_running_loop()
+    contexto = contextvars.copy_context()
+    return await loop.run_in_executor(_executor, functools.partial(contexto.run, _medido, funcion, *args, **kwargs))
@@ -0,0 +1,78 @@
+from db import obtener_conexion
+from sire import CODIGO_COMPROBANTE
+
+# Detección de comprobantes repetidos. La clave normalizada (RUC|tipo|serie|número)
+# es una columna generada, así la calcula SQLite igual al insertar, al migrar y
+# al consultar. Un índice UNIQUE parcial por usuario impide guardarlo dos veces.
+# Los duplicados que ya existían antes se marcan con duplicado_de (id del
+# original) y quedan fuera del índice para revisarlos a mano.
+
+# tipo -> (tabla, columna id, RUC del emisor, serie, número)
+FUENTES = {
+    # En compras el emisor es el proveedor
+    "compra": ("compras_sire", "id_gasto", "proveedor_ruc", "serie", "numero"),
+    # En ventas el emisor es la propia empresa: la serie ya es única
+    "venta": ("ventas_sire", "id_transaccion", None, "serie_comprobante", "nro_comprobante"),
+}
+
+
+def sql_clave(ruc, tipo_comprobante, serie, numero) -> str:
+    """Expresión SQL de la clave. Recibe expresiones (columnas o parámetros).
+
+    Acepta la serie con el número pegado ("F001-123") como guarda la app, quita
+    ceros a la izquierda del número y pasa el tipo a código SUNAT (Factura -> 01),
+    o lo deduce de la letra de la serie. NULL si falta serie, número o RUC.
+    """
+    pegado = f"(COALESCE({numero}, '') = '' AND instr({serie}, '-') > 0)"
+    serie_sola = f"upper(trim(CASE WHEN {pegado} THEN substr({serie}, 1, instr({serie}, '-') - 1) ELSE COALESCE({serie}, '') END))"
+    numero_solo = f"ltrim(trim(CASE WHEN {pegado} THEN substr({serie}, instr({serie}, '-') + 1) ELSE COALESCE({numero}, '') END), '0')"
+    codigos = " ".join(f"WHEN '{nombre}' THEN '{codigo}'" for nombre, codigo in CODIGO_COMPROBANTE.items())
+    tipo = (f"COALESCE(CASE upper(trim({tipo_comprobante})) {codigos} ELSE NULLIF(trim({tipo_comprobante}), '') END, "
+            f"CASE substr({serie_sola}, 1, 1) WHEN 'F' THEN '01' WHEN 'B' THEN '03' ELSE '' END)")
+    ruc_limpio = f"trim(COALESCE({ruc}, ''))" if ruc else "''"
+    condicion = f"{serie_sola} <> '' AND {numero_solo} <> ''" + (f" AND {ruc_limpio} <> ''" if ruc else "")
+    return f"CASE WHEN {condicion} THEN {ruc_limpio} || '|' || {tipo} || '|' || {serie_sola} || '|' || {numero_solo} END"
+
+
+def sql_migracion_duplicados() -> list:
+    sentencias = []
+    for tipo, (tabla, columna_id, ruc, serie, numero) in FUENTES.items():
+        sentencias += [
+            f"ALTER TABLE {tabla} ADD COLUMN clave_comprobante TEXT "
+            f"GENERATED ALWAYS AS ({sql_clave(ruc, 'tipo_comprobante', serie, numero)}) VIRTUAL",
+            f"ALTER TABLE {tabla} ADD COLUMN duplicado_de INTEGER",
+            # Se conserva el más antiguo; los demás quedan marcados para el reporte
+            f'''UPDATE {tabla} SET duplicado_de = d.primero
+                FROM (SELECT {columna_id} AS id, MIN({columna_id}) OVER (PARTITION BY user_id, clave_comprobante) AS primero
+                      FROM {tabla} WHERE clave_comprobante IS NOT NULL) AS d
+                WHERE d.id = {tabla}.{columna_id} AND d.primero <> d.id''',
+            f'''CREATE UNIQUE INDEX IF NOT EXISTS idx_{tabla}_clave_unica ON {tabla} (user_id, clave_comprobante)
+                WHERE clave_comprobante IS NOT NULL AND duplicado_de IS NULL''',
+        ]
+    return sentencias
+
+
+def buscar_duplicado(user_id: int, tipo: str, ruc, tipo_comprobante, serie, numero):
+    """Comprobante ya guardado con la misma clave, o None."""
+    tabla, columna_id, columna_ruc, *_ = FUENTES[tipo]
+    columna_total = "monto_total" if tipo == "compra" else "total_cp"
+    clave = sql_clave(":ruc" if columna_ruc else None, ":tipo", ":serie", ":numero")
+    row = obtener_conexion().execute(f'''
+        SELECT {columna_id}, fecha_emision, {columna_total} FROM {tabla}
+        WHERE user_id = :user_id AND clave_comprobante = {clave} AND duplicado_de IS NULL
+    ''', {"user_id": user_id, "ruc": ruc, "tipo": tipo_comprobante, "serie": serie, "numero": numero}).fetchone()
+    if not row:
+        return None
+    return {"id": row[0], "fecha": row[1], "monto": row[2]}
+
+
+def reportar_duplicados() -> list:
+    """Duplicados históricos marcados por la migración que siguen en la base."""
+    duplicados = []
+    for tipo, (tabla, columna_id, *_) in FUENTES.items():
+        for row in obtener_conexion().execute(f'''
+            SELECT user_id, {columna_id}, duplicado_de, clave_comprobante FROM {tabla}
+            WHERE duplicado_de IS NOT NULL ORDER BY user_id, duplicado_de
+        '''):
+            duplicados.append({"tipo": tipo, "user_id": row[0], "id": row[1], "duplicado_de": row[2], "clave": row[3]})
+    return duplicados
@@ -0,0 +1,243 @@
+import asyncio
+import copy
+import hashlib
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+from PIL import Image
+from google import genai
+from google.genai import types
+from observabilidad import GEMINI_DURACION, GEMINI_ERRORES, medir, registrar_uso_gemini
+
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
+MODELO_GEMINI = "gemini-flash-latest"
+
+# Máximo de llamadas a Gemini en paralelo y tiempo límite por llamada (segundos)
+GEMINI_MAX_CONCURRENCIA = int(os.getenv("GEMINI_MAX_CONCURRENCIA", "4"))
+GEMINI_TIMEOUT = float(os.getenv("GEMINI_TIMEOUT", "60"))
+
+# Caché de extracciones: cuántos resultados guardar y por cuánto tiempo (segundos)
+CACHE_MAX_ENTRADAS = int(os.getenv("CACHE_MAX_ENTRADAS", "2000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", str(7 * 24 * 3600)))
+
+# Se crea al primer uso: importar el módulo no debe exigir la API key
+client = None
+semaforo_gemini = asyncio.Semaphore(GEMINI_MAX_CONCURRENCIA)
+
+# Cambiar la versión al editar un prompt invalida lo que haya en caché para él
+VERSION_PROMPT_COMPRA = "compra-v2"
+VERSION_PROMPT_VENTA = "venta-v2"
+
+PROMPT_COMPRA = """Analiza esta FACTURA/BOLETA DE COMPRA.
+        Extrae los datos, incluyendo dirección y teléfono si aparecen.
+        Devuelve JSON: {
+            "fecha_emision": "DD/MM/YYYY",
+            "proveedor_ruc": "...",
+            "proveedor_razon_social": "...",
+            "proveedor_direccion": "...",
+            "proveedor_telefono": "...",
+            "tipo_comprobante": "Factura/Boleta",
+            "serie": "...",
+            "numero": "...",
+            "base_imponible": 0.0,
+            "igv": 0.0,
+            "monto_total": 0.0,
+            "moneda": "PEN",
+            "items": [
+                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
+            ]
+        }"""
+
+PROMPT_VENTA = """Analiza VENTA. Extrae datos del cliente.
+        Devuelve JSON: {
+            "fecha_emision": "DD/MM/YYYY",
+            "tipo_comprobante": "Factura/Boleta",
+            "serie": "...",
+            "numero": "...",
+            "cliente_nro_doc": "...",
+            "cliente_razon_social": "...",
+            "cliente_direccion": "...",
+            "cliente_telefono": "...",
+            "base_imponible": 0.0,
+            "igv": 0.0,
+            "total_cp": 0.0,
+            "moneda": "PEN",
+            "items": [
+                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
+            ]
+        }"""
+
+# Con el maestro de contribuyentes cargado (padrón SUNAT) la dirección y el
+# teléfono salen de ahí: se puede usar un prompt más corto que no los pide.
+EXTRACCION_PROMPT_CORTO = os.getenv("EXTRACCION_PROMPT_CORTO", "0") == "1"
+
+if EXTRACCION_PROMPT_CORTO:
+    VERSION_PROMPT_COMPRA = "compra-corto-v2"
+    VERSION_PROMPT_VENTA = "venta-corto-v2"
+
+    PROMPT_COMPRA = """Analiza esta FACTURA/BOLETA DE COMPRA.
+        Devuelve JSON: {
+            "fecha_emision": "DD/MM/YYYY",
+            "proveedor_ruc": "...",
+            "proveedor_razon_social": "...",
+            "tipo_comprobante": "Factura/Boleta",
+            "serie": "...",
+            "numero": "...",
+            "base_imponible": 0.0,
+            "igv": 0.0,
+            "monto_total": 0.0,
+            "moneda": "PEN",
+            "items": [
+                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
+            ]
+        }"""
+
+    PROMPT_VENTA = """Analiza VENTA.
+        Devuelve JSON: {
+            "fecha_emision": "DD/MM/YYYY",
+            "tipo_comprobante": "Factura/Boleta",
+            "serie": "...",
+            "numero": "...",
+            "cliente_nro_doc": "...",
+            "cliente_razon_social": "...",
+            "base_imponible": 0.0,
+            "igv": 0.0,
+            "total_cp": 0.0,
+            "moneda": "PEN",
+            "items": [
+                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
+            ]
+        }"""
+
+PROMPTS = {
+    "compra": (PROMPT_COMPRA, VERSION_PROMPT_COMPRA),
+    "venta": (PROMPT_VENTA, VERSION_PROMPT_VENTA)
+}
+
+
+class CacheExtraccion:
+    """LRU en memoria de resultados de Gemini, indexado por SHA-256 de la imagen
+    y versión del prompt. Evita pagar otra llamada cuando suben el mismo recibo."""
+
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entradas = OrderedDict()
+
+    @staticmethod
+    def clave(contents: bytes, version_prompt: str) -> str:
+        return f"{version_prompt}:{hashlib.sha256(contents).hexdigest()}"
+
+    def obtener(self, clave: str):
+        entrada = self._entradas.get(clave)
+        if entrada is not None:
+            creado, datos = entrada
+            # Si expiró o alguien borró la imagen, se vuelve a extraer
+            if time.time() - creado <= self.ttl and os.path.exists(datos.get("ruta_imagen", "")):
+                self._entradas.move_to_end(clave)
+                self.hits += 1
+                return copy.deepcopy(datos)
+            del self._entradas[clave]
+        self.misses += 1
+        return None
+
+    def guardar(self, clave: str, datos: dict):
+        self._entradas[clave] = (time.time(), copy.deepcopy(datos))
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+
+    def estadisticas(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entradas": len(self._entradas),
+            "max_entradas": self.max_entradas,
+            "ttl_segundos": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+cache_extraccion = CacheExtraccion(CACHE_MAX_ENTRADAS, CACHE_TTL)
+
+
+def detectar_mime(contents: bytes) -> str:
+    if contents[:5] == b"%PDF-":
+        return "application/pdf"
+    # Solo lee la cabecera, no decodifica la imagen completa
+    formato = Image.open(io.BytesIO(contents)).format
+    return Image.MIME.get(formato, "image/jpeg")
+
+
+def _cliente():
+    global client
+    if client is None:
+        client = genai.Client(api_key=GOOGLE_API_KEY)
+    return client
+
+
+def _motivo_error(e: Exception) -> str:
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    codigo = getattr(e, "code", None)
+    return str(codigo) if codigo else type(e).__name__
+
+
+async def _llamar_gemini(contenido: list):
+    # La espera por el semáforo se mide aparte: si sube, falta concurrencia, no es Gemini
+    with medir("gemini_espera"):
+        await semaforo_gemini.acquire()
+    inicio = time.perf_counter()
+    try:
+        with medir("gemini"):
+            response = await asyncio.wait_for(
+                _cliente().aio.models.generate_content(
+                    model=MODELO_GEMINI, contents=contenido,
+                    config=types.GenerateContentConfig(response_mime_type='application/json')
+                ),
+                timeout=GEMINI_TIMEOUT
+            )
+    except Exception as e:
+        GEMINI_ERRORES.labels(_motivo_error(e)).inc()
+        GEMINI_DURACION.labels("error").observe(time.perf_counter() - inicio)
+        raise
+    finally:
+        semaforo_gemini.release()
+    GEMINI_DURACION.labels("ok").observe(time.perf_counter() - inicio)
+    registrar_uso_gemini(response)
+    try:
+        return json.loads(response.text.strip())
+    except ValueError:
+        GEMINI_ERRORES.labels("json_invalido").inc()
+        raise
+
+
+async def extraer_datos(prompt: str, contents: bytes) -> dict:
+    """Llama a Gemini con el cliente asíncrono, sin bloquear el event loop.
+
+    Como mucho GEMINI_MAX_CONCURRENCIA llamadas corren a la vez; el resto espera
+    su turno. Si Gemini tarda más de GEMINI_TIMEOUT se lanza asyncio.TimeoutError.
+    """
+    imagen = types.Part.from_bytes(data=contents, mime_type=detectar_mime(contents))
+    return await _llamar_gemini([prompt, imagen])
+
+
+async def extraer_lote(prompt: str, lista_contents: list) -> list:
+    """Extrae varios comprobantes en una sola llamada a Gemini.
+
+    Devuelve un dict por cada comprobante, en el orden de las imágenes. Un PDF
+    de varias páginas puede traer más de un comprobante por archivo.
+    """
+    partes = [types.Part.from_bytes(data=c, mime_type=detectar_mime(c)) for c in lista_contents]
+    instrucciones = (
+        f"{prompt}\n        Recibirás {len(partes)} archivo(s) y cada comprobante es distinto "
+        "(en un PDF, uno por página). Devuelve un ARRAY JSON con un objeto por comprobante, "
+        "en el mismo orden en que aparecen."
+    )
+    datos = await _llamar_gemini([instrucciones, *partes])
+    return datos if isinstance(datos, list) else [datos]
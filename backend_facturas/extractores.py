@@ -0,0 +1,413 @@
+import abc
+import asyncio
+import io
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from db import obtener_conexion, transaccion, en_db
+from almacenamiento import es_de_usuario
+from extraccion import extraer_datos, PROMPTS
+from validacion import (
+    ruc_valido, normalizar_fecha, normalizar_monto, normalizar_tipo_comprobante, separar_serie_numero,
+    TASA_IGV, TOLERANCIA_MONTO
+)
+from observabilidad import EXTRACCION_CAMPOS, EXTRACCION_DURACION, EXTRACCION_RUTA, logger, medir
+
+try:
+    import pytesseract
+except ImportError:  # el OCR local es opcional: sin pytesseract todo va a Gemini
+    pytesseract = None
+
+# Extractores intercambiables detrás de escanear-compra/venta y de la cola:
+# Gemini y un OCR local (Tesseract + expresiones regulares). El router manda al
+# local los comprobantes que lee con confianza alta y usa cada uno de respaldo
+# del otro cuando falla.
+#   auto:   primero el local; si no alcanza EXTRACCION_UMBRAL_LOCAL, Gemini
+#   gemini: Gemini; el local solo si Gemini falla (429, caído, timeout)
+#   local:  solo el OCR local
+EXTRACCION_MODO = os.getenv("EXTRACCION_MODO", "auto")
+EXTRACCION_UMBRAL_LOCAL = float(os.getenv("EXTRACCION_UMBRAL_LOCAL", "0.9"))
+# Un resultado local por debajo del umbral igual sirve de respaldo si Gemini no responde
+EXTRACCION_UMBRAL_RESPALDO = float(os.getenv("EXTRACCION_UMBRAL_RESPALDO", "0.5"))
+EXTRACCION_RETENCION_DIAS = float(os.getenv("EXTRACCION_RETENCION_DIAS", "180"))
+OCR_IDIOMA = os.getenv("OCR_IDIOMA", "spa")
+# Tesseract es CPU puro: más hilos que núcleos solo agregan espera
+OCR_HILOS = int(os.getenv("OCR_HILOS", str(os.cpu_count() or 1)))
+
+# Lo que se guarda de cada escaneo para compararlo con lo que confirma el usuario
+SQL_TABLA_EXTRACCIONES = '''
+    CREATE TABLE IF NOT EXISTS extracciones (
+        ruta_imagen TEXT PRIMARY KEY,
+        user_id INTEGER,
+        tipo TEXT,              -- 'compra' o 'venta'
+        extractor TEXT,         -- 'gemini' o 'local'
+        confianza REAL,
+        campos TEXT,            -- JSON con los campos comparables tal como salieron
+        campos_ok INTEGER,      -- NULL hasta que se confirma
+        campos_total INTEGER,
+        corregidos TEXT,        -- campos que el usuario cambió, separados por coma
+        creado REAL
+    ) WITHOUT ROWID
+'''
+SQL_INDICE_EXTRACCIONES = "CREATE INDEX IF NOT EXISTS idx_extracciones_creado ON extracciones (creado)"
+
+CAMPOS_COMPARADOS = ("documento", "razon_social", "fecha_emision", "tipo_comprobante", "serie_numero", "total")
+
+_executor_ocr = ThreadPoolExecutor(max_workers=OCR_HILOS, thread_name_prefix="ocr")
+
+
+class ExtractorNoDisponible(Exception):
+    """El extractor no puede con este archivo (p. ej. un PDF en el OCR local)."""
+
+
+class Extractor(abc.ABC):
+    """Interfaz: recibe el tipo ('compra'/'venta') y la imagen ya preprocesada y
+    devuelve el JSON del comprobante con la misma forma que los prompts de Gemini."""
+    nombre = ""
+
+    @abc.abstractmethod
+    def disponible(self) -> bool:
+        """¿Se puede usar en este servidor (dependencias, binarios)?"""
+
+    @abc.abstractmethod
+    async def extraer(self, tipo: str, contents: bytes) -> dict:
+        """El JSON del comprobante; ExtractorNoDisponible si no puede con este archivo."""
+
+
+class ExtractorGemini(Extractor):
+    nombre = "gemini"
+
+    def disponible(self) -> bool:
+        return True
+
+    async def extraer(self, tipo: str, contents: bytes) -> dict:
+        datos = await extraer_datos(PROMPTS[tipo][0], contents)
+        if not isinstance(datos, dict):
+            raise ValueError("Respuesta inválida de Gemini")
+        return datos
+
+
+# --- OCR local ------------------------------------------------------------
+
+RE_RUC = re.compile(r"\b(10|15|17|20)\d{9}\b")
+RE_DNI = re.compile(r"\bDNI\W{0,3}(\d{8})\b", re.IGNORECASE)
+RE_SERIE_NUMERO = re.compile(r"\b([FBE][A-Z0-9]{3})\s*[-–]\s*(\d{1,8})\b")
+RE_FECHA = re.compile(r"\b(\d{1,2})[/.-](\d{1,2})[/.-](\d{4})\b")
+RE_MONTO = re.compile(r"(\d{1,3}(?:[.,]\d{3})*[.,]\d{2}|\d+[.,]\d{2})\b")
+RE_CLIENTE = re.compile(r"(?:SE[ÑN]OR(?:\(?ES\)?)?|CLIENTE|ADQUIRIENTE)\s*:?\s*(.+)", re.IGNORECASE)
+RE_TOTAL = re.compile(r"\b(?:IMPORTE\s+)?TOTAL\b(?!\s*(?:GRAVAD|EXONERAD|INAFECT|DESCUENTO))", re.IGNORECASE)
+RE_NO_TOTAL = re.compile(r"SUB\s*-?\s*TOTAL|\bI\.?G\.?V\.?\b", re.IGNORECASE)
+RE_IGV = re.compile(r"\bI\.?G\.?V\.?\b", re.IGNORECASE)
+RE_BASE = re.compile(r"OP(?:ERACI[OÓ]N)?\.?\s*GRAVADA|VALOR\s+(?:DE\s+)?VENTA|SUB\s*-?\s*TOTAL", re.IGNORECASE)
+
+
+def _monto(texto: str) -> float:
+    """'1,234.50' o '1.234,50' -> 1234.5; el último separador es el decimal."""
+    entero, decimales = texto[:-3], texto[-2:]
+    return float(re.sub(r"[.,]", "", entero) + "." + decimales)
+
+
+def _montos_en(linea: str) -> list:
+    return [_monto(m) for m in RE_MONTO.findall(linea)]
+
+
+def _ultimo_monto(lineas: list, patron, excluir=None):
+    valor = None
+    for linea in lineas:
+        if patron.search(linea) and not (excluir and excluir.search(linea)):
+            montos = _montos_en(linea)
+            if montos:
+                valor = montos[-1]
+    return valor
+
+
+def interpretar_texto(tipo: str, texto: str) -> dict:
+    """Arma el JSON del comprobante a partir del texto del OCR. Devuelve también
+    `confianza` (0 a 1): cuántos campos clave encontró y si los montos cuadran."""
+    lineas = [l.strip() for l in texto.splitlines() if l.strip()]
+    plano = "\n".join(lineas)
+    datos = {"items": []}
+
+    rucs = [m.group(0) for m in RE_RUC.finditer(plano)]
+    if tipo == "compra":
+        # En una compra el emisor es el proveedor: el primer RUC y la primera línea del encabezado
+        documento = rucs[0] if rucs else None
+        datos["proveedor_ruc"] = documento
+        encabezado = next((l for l in lineas if re.search(r"[A-Za-z]{3}", l) and not RE_RUC.search(l)), None)
+        datos["proveedor_razon_social"] = encabezado
+    else:
+        # En una venta el emisor somos nosotros: el cliente es el segundo RUC o un DNI
+        dni = RE_DNI.search(plano)
+        documento = rucs[1] if len(rucs) > 1 else (dni.group(1) if dni else None)
+        datos["cliente_nro_doc"] = documento
+        cliente = RE_CLIENTE.search(plano)
+        datos["cliente_razon_social"] = re.split(r"\s+(?:DNI|RUC)\b", cliente.group(1))[0].strip() if cliente else None
+
+    serie_numero = RE_SERIE_NUMERO.search(plano)
+    if serie_numero:
+        datos["serie"], datos["numero"] = serie_numero.group(1), serie_numero.group(2)
+    serie = datos.get("serie") or ""
+    if serie.startswith("F") or re.search(r"FACTURA", plano, re.IGNORECASE):
+        datos["tipo_comprobante"] = "Factura"
+    elif serie.startswith("B") or re.search(r"BOLETA", plano, re.IGNORECASE):
+        datos["tipo_comprobante"] = "Boleta"
+
+    fecha = RE_FECHA.search(plano)
+    if fecha:
+        dia, mes, anio = fecha.groups()
+        datos["fecha_emision"] = f"{int(dia):02d}/{int(mes):02d}/{anio}"
+
+    total = _ultimo_monto(lineas, RE_TOTAL, excluir=RE_NO_TOTAL)
+    igv = _ultimo_monto(lineas, RE_IGV)
+    base = _ultimo_monto(lineas, RE_BASE)
+    datos["monto_total" if tipo == "compra" else "total_cp"] = total
+    datos["base_imponible"], datos["igv"] = base, igv
+    if tipo == "venta":
+        datos["moneda"] = "USD" if re.search(r"US\$|D[OÓ]LAR", plano, re.IGNORECASE) else "PEN"
+
+    # 0.15 por cada campo clave y el resto por las comprobaciones cruzadas
+    encontrados = [documento, datos.get("serie"), datos.get("numero"), datos.get("fecha_emision"), total]
+    confianza = 0.15 * sum(1 for c in encontrados if c)
+    if documento and (len(documento) == 8 or ruc_valido(documento)):
+        confianza += 0.1
+    if total is not None:
+        if igv is not None and base is not None:
+            cuadra = abs(base + igv - total) <= TOLERANCIA_MONTO and abs(base * TASA_IGV - igv) <= TOLERANCIA_MONTO
+        else:
+            # Boleta sin desglose: al menos que el IGV, si figura, sea el 18% incluido en el total
+            cuadra = igv is None or abs(total - total / (1 + TASA_IGV) - igv) <= TOLERANCIA_MONTO
+        if cuadra:
+            confianza += 0.15
+    datos["confianza"] = round(confianza, 2)
+    return datos
+
+
+def _leer_texto(contents: bytes) -> str:
+    imagen = ImageOps.exif_transpose(Image.open(io.BytesIO(contents))).convert("L")
+    return pytesseract.image_to_string(imagen, lang=OCR_IDIOMA)
+
+
+class ExtractorLocal(Extractor):
+    nombre = "local"
+    _instalado = None
+
+    def disponible(self) -> bool:
+        # pytesseract sin el binario de Tesseract tampoco sirve; se comprueba una vez
+        if ExtractorLocal._instalado is None:
+            try:
+                ExtractorLocal._instalado = pytesseract is not None and bool(pytesseract.get_tesseract_version())
+            except Exception:
+                ExtractorLocal._instalado = False
+        return ExtractorLocal._instalado
+
+    async def extraer(self, tipo: str, contents: bytes) -> dict:
+        if contents[:5] == b"%PDF-":
+            raise ExtractorNoDisponible("El OCR local no lee PDF")
+        texto = await asyncio.get_running_loop().run_in_executor(_executor_ocr, _leer_texto, contents)
+        return interpretar_texto(tipo, texto)
+
+
+EXTRACTORES = {e.nombre: e for e in (ExtractorGemini(), ExtractorLocal())}
+
+
+# --- Router ---------------------------------------------------------------
+
+async def _correr(extractor: Extractor, tipo: str, contents: bytes) -> dict:
+    inicio = time.perf_counter()
+    resultado = "error"
+    try:
+        with medir(f"extraccion_{extractor.nombre}"):
+            datos = await extractor.extraer(tipo, contents)
+        resultado = "ok"
+        return datos
+    finally:
+        EXTRACCION_DURACION.labels(extractor.nombre, resultado).observe(time.perf_counter() - inicio)
+
+
+def _elegido(datos: dict, extractor: str, motivo: str) -> dict:
+    EXTRACCION_RUTA.labels(extractor, motivo).inc()
+    datos["extractor"] = extractor
+    datos.setdefault("confianza", None)
+    return datos
+
+
+async def extraer_comprobante(tipo: str, contents: bytes) -> dict:
+    """Extrae con el extractor que corresponda según EXTRACCION_MODO.
+
+    Si ninguno da un resultado usable se relanza el error del principal (así
+    la cola sigue reintentando los 429/5xx de Gemini).
+    """
+    gemini, local = EXTRACTORES["gemini"], EXTRACTORES["local"]
+    hay_local = local.disponible()
+    if EXTRACCION_MODO == "local":
+        if not hay_local:
+            raise ExtractorNoDisponible("EXTRACCION_MODO=local requiere pytesseract y Tesseract instalados")
+        return _elegido(await _correr(local, tipo, contents), "local", "principal")
+
+    datos_local = None
+    if EXTRACCION_MODO == "auto" and hay_local:
+        try:
+            datos_local = await _correr(local, tipo, contents)
+        except ExtractorNoDisponible:
+            pass
+        except Exception as e:
+            logger.warning("OCR local falló", extra={"error": str(e)})
+        if datos_local and datos_local["confianza"] >= EXTRACCION_UMBRAL_LOCAL:
+            return _elegido(datos_local, "local", "confianza")
+
+    try:
+        return _elegido(await _correr(gemini, tipo, contents), "gemini", "principal")
+    except Exception as e:
+        if datos_local is None and hay_local and EXTRACCION_MODO == "gemini":
+            try:
+                datos_local = await _correr(local, tipo, contents)
+            except Exception:
+                datos_local = None
+        if datos_local and datos_local["confianza"] >= EXTRACCION_UMBRAL_RESPALDO:
+            logger.warning("Gemini falló, se usa el OCR local", extra={"error": str(e), "confianza": datos_local["confianza"]})
+            return _elegido(datos_local, "local", "respaldo")
+        raise
+
+
+# --- Precisión ------------------------------------------------------------
+
+def _comparables(tipo: str, datos: dict) -> dict:
+    """Campos normalizados para comparar lo extraído con lo confirmado. Pasan por
+    los mismos normalizadores que validar, que ya corrió sobre lo confirmado:
+    '5/3/2025' y '05/03/2025', o 'F001-00123' y F001 / 123, cuentan como iguales."""
+    def texto(valor):
+        return re.sub(r"\s+", " ", str(valor)).strip().upper() if valor not in (None, "") else None
+
+    # La app manda serie y número juntos en `serie` ("F001-123")
+    serie, numero = separar_serie_numero(datos.get("serie"), datos.get("numero"))
+    total = datos.get("monto_total")
+    if total is None:
+        total = datos.get("total_cp")
+    fecha = normalizar_fecha(datos.get("fecha_emision"))
+    prefijo = "proveedor" if tipo == "compra" else "cliente"
+    documento = re.sub(r"[\s.-]", "", str(datos.get("proveedor_ruc" if tipo == "compra" else "cliente_nro_doc") or ""))
+    return {
+        "documento": documento or None,
+        "razon_social": texto(datos.get(f"{prefijo}_razon_social")),
+        "fecha_emision": fecha.strftime("%d/%m/%Y") if fecha else texto(datos.get("fecha_emision")),
+        "tipo_comprobante": texto(normalizar_tipo_comprobante(datos.get("tipo_comprobante"), serie)),
+        "serie_numero": f"{serie}-{numero}" if serie or numero else None,
+        "total": normalizar_monto(total),
+    }
+
+
+def _como_datos(tipo: str, campos: dict) -> dict:
+    """Campos comparables guardados -> forma del JSON, para volver a normalizarlos
+    (las extracciones guardadas antes de normalizar siguen sirviendo)."""
+    prefijo = "proveedor" if tipo == "compra" else "cliente"
+    return {
+        "proveedor_ruc" if tipo == "compra" else "cliente_nro_doc": campos.get("documento"),
+        f"{prefijo}_razon_social": campos.get("razon_social"),
+        "fecha_emision": campos.get("fecha_emision"),
+        "tipo_comprobante": campos.get("tipo_comprobante"),
+        "serie": campos.get("serie_numero"),
+        "monto_total": campos.get("total"),
+    }
+
+
+def clave_extraccion(datos: dict):
+    """Clave en `extracciones`: la ruta de la imagen, o ruta#página para cada
+    comprobante de un PDF de varias páginas (comparten archivo)."""
+    ruta_imagen = datos.get("ruta_imagen")
+    if not ruta_imagen or not datos.get("pagina"):
+        return ruta_imagen
+    return f"{ruta_imagen}#{datos['pagina']}"
+
+
+def registrar_extraccion(user_id: int, tipo: str, datos: dict):
+    """Guarda lo que devolvió el extractor (antes de completar con el maestro)."""
+    if not datos.get("ruta_imagen"):
+        return
+    with transaccion() as conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO extracciones (ruta_imagen, user_id, tipo, extractor, confianza, campos, creado)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (clave_extraccion(datos), user_id, tipo, datos.get("extractor"), datos.get("confianza"),
+              json.dumps(_comparables(tipo, datos)), time.time()))
+
+
+async def reusar_extraccion(tipo: str, datos: dict, contents: bytes, extension: str, user_id: int, guardar_bytes) -> dict:
+    """Acierto de la caché de extracción: la caché es por contenido y la imagen
+    guardada puede ser de otro usuario. En ese caso se guarda una copia en la
+    carpeta de `user_id` (con `guardar_bytes(bytes, extension)`, en un hilo) y
+    se registra la extracción igual que un escaneo nuevo."""
+    if not es_de_usuario(datos.get("ruta_imagen"), user_id):
+        datos["ruta_imagen"] = await asyncio.to_thread(guardar_bytes, contents, extension)
+    await en_db(registrar_extraccion, user_id, tipo, datos)
+    return datos
+
+
+def comparar_confirmado(conn, user_id: int, tipo: str, datos: dict):
+    """Compara lo confirmado con lo que había extraído el escaneo de la misma
+    imagen. Se llama dentro de la transacción que inserta el comprobante."""
+    ruta_imagen = clave_extraccion(datos)
+    if not ruta_imagen:
+        return
+    row = conn.execute("SELECT extractor, campos FROM extracciones WHERE ruta_imagen = ? AND user_id = ? AND campos_ok IS NULL",
+                       (ruta_imagen, user_id)).fetchone()
+    if not row:
+        return
+    extraidos = _comparables(tipo, _como_datos(tipo, json.loads(row["campos"])))
+    confirmados = _comparables(tipo, datos)
+    corregidos = [c for c in CAMPOS_COMPARADOS if confirmados[c] is not None and extraidos.get(c) != confirmados[c]]
+    evaluados = [c for c in CAMPOS_COMPARADOS if confirmados[c] is not None]
+    for campo in evaluados:
+        EXTRACCION_CAMPOS.labels(row["extractor"], campo, "corregido" if campo in corregidos else "acierto").inc()
+    conn.execute("UPDATE extracciones SET campos_ok = ?, campos_total = ?, corregidos = ? WHERE ruta_imagen = ?",
+                 (len(evaluados) - len(corregidos), len(evaluados), ",".join(corregidos), ruta_imagen))
+
+
+def estadisticas_extractores(dias: float = 30) -> dict:
+    """Por extractor: escaneos, confianza media y qué parte de los campos el
+    usuario dejó como estaban al confirmar. La latencia está en /metrics."""
+    desde = time.time() - dias * 86400
+    conn = obtener_conexion()
+    resumen = {}
+    for row in conn.execute('''
+        SELECT extractor, COUNT(*) AS escaneos, AVG(confianza) AS confianza_media,
+               COUNT(campos_ok) AS confirmados, SUM(campos_ok) AS ok, SUM(campos_total) AS total
+        FROM extracciones WHERE creado >= ? GROUP BY extractor
+    ''', (desde,)):
+        resumen[row["extractor"]] = {
+            "escaneos": row["escaneos"],
+            "confianza_media": round(row["confianza_media"], 3) if row["confianza_media"] is not None else None,
+            "confirmados": row["confirmados"],
+            "precision_campos": round(row["ok"] / row["total"], 4) if row["total"] else None,
+            "corregidos": {},
+        }
+    for extractor, corregidos in conn.execute(
+            "SELECT extractor, corregidos FROM extracciones WHERE creado >= ? AND corregidos <> ''", (desde,)):
+        conteo = resumen[extractor]["corregidos"]
+        for campo in corregidos.split(","):
+            conteo[campo] = conteo.get(campo, 0) + 1
+    return {"dias": dias, "modo": EXTRACCION_MODO, "ocr_local": EXTRACTORES["local"].disponible(),
+            "extractores": resumen}
+
+
+def purgar_extracciones() -> int:
+    with transaccion() as conn:
+        return conn.execute("DELETE FROM extracciones WHERE creado < ?",
+                            (time.time() - EXTRACCION_RETENCION_DIAS * 86400,)).rowcount
+
+
+if __name__ == "__main__":
+    import sys
+    # python extractores.py [compra|venta] recibo.jpg ...  -> lo que lee el OCR local y su confianza
+    # python extractores.py                                -> precisión por extractor en la base
+    if len(sys.argv) > 2:
+        if not EXTRACTORES["local"].disponible():
+            raise SystemExit("Falta pytesseract o el binario de Tesseract")
+        for ruta in sys.argv[2:]:
+            with open(ruta, "rb") as f:
+                texto = _leer_texto(f.read())
+            print(ruta, json.dumps(interpretar_texto(sys.argv[1], texto), ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps(estadisticas_extractores(), ensure_ascii=False, indent=2))
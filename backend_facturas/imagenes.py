@@ -0,0 +1,81 @@
+import io
+import os
+from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+# Preprocesado antes de mandar la foto a Gemini y guardarla en uploads/
+IMAGEN_MAX_LADO = int(os.getenv("IMAGEN_MAX_LADO", "1600"))
+IMAGEN_FORMATO = os.getenv("IMAGEN_FORMATO", "jpeg").lower()  # jpeg o webp
+IMAGEN_CALIDAD = int(os.getenv("IMAGEN_CALIDAD", "80"))
+IMAGEN_ESCALA_GRISES = os.getenv("IMAGEN_ESCALA_GRISES", "1") == "1"
+IMAGEN_RECORTAR = os.getenv("IMAGEN_RECORTAR", "1") == "1"
+
+
+def _recortar_recibo(img: Image.Image) -> Image.Image:
+    """Recorta al papel: el recibo es la zona clara y sin color sobre la mesa.
+
+    Se usa la saturación y no solo el brillo porque una mesa de madera iluminada
+    puede ser más clara que un papel a la sombra. Trabaja sobre una miniatura
+    para que sea barato. Si la zona de papel es casi toda la foto (o muy poca)
+    no recorta, porque no hay un borde confiable.
+    """
+    muestra = img.copy()
+    muestra.thumbnail((400, 400))
+    escala_x = img.width / muestra.width
+    escala_y = img.height / muestra.height
+
+    _, saturacion, brillo = muestra.convert("HSV").split()
+    mascara = ImageChops.multiply(
+        saturacion.point(lambda p: 255 if p < 70 else 0),
+        brillo.point(lambda p: 255 if p > 80 else 0)
+    )
+    # Erosión para que brillos sueltos del fondo no agranden la caja
+    mascara = mascara.filter(ImageFilter.MinFilter(5))
+    caja = mascara.getbbox()
+    if not caja:
+        return img
+
+    area = (caja[2] - caja[0]) * (caja[3] - caja[1]) / (muestra.width * muestra.height)
+    if area < 0.2 or area > 0.95:
+        return img
+
+    margen = 6
+    return img.crop((
+        int(max(0, caja[0] - margen) * escala_x),
+        int(max(0, caja[1] - margen) * escala_y),
+        int(min(muestra.width, caja[2] + margen) * escala_x),
+        int(min(muestra.height, caja[3] + margen) * escala_y)
+    ))
+
+
+def preprocesar_imagen(contents: bytes):
+    """Normaliza la foto de un comprobante y devuelve (bytes, extension).
+
+    Corrige la orientación EXIF, recorta al recibo, reduce el lado mayor a
+    IMAGEN_MAX_LADO, pasa a grises con autocontraste (papel térmico) y vuelve a
+    codificar en JPEG/WebP. Si Pillow no puede abrir el archivo (p. ej. un PDF)
+    se devuelve tal cual. Es trabajo de CPU: llamarla con asyncio.to_thread.
+    """
+    try:
+        img = Image.open(io.BytesIO(contents))
+        # En JPEG decodifica directo a menor escala (1/2, 1/4...), mucho más rápido
+        img.draft("RGB", (IMAGEN_MAX_LADO, IMAGEN_MAX_LADO))
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        return contents, None
+
+    img = img.convert("RGB")
+    if IMAGEN_RECORTAR:
+        img = _recortar_recibo(img)
+    if max(img.size) > IMAGEN_MAX_LADO:
+        img.thumbnail((IMAGEN_MAX_LADO, IMAGEN_MAX_LADO), Image.LANCZOS)
+    if IMAGEN_ESCALA_GRISES:
+        img = ImageOps.autocontrast(img.convert("L"), cutoff=1)
+
+    salida = io.BytesIO()
+    if IMAGEN_FORMATO == "webp":
+        img.save(salida, "WEBP", quality=IMAGEN_CALIDAD, method=4)
+        extension = "webp"
+    else:
+        img.save(salida, "JPEG", quality=IMAGEN_CALIDAD, optimize=True)
+        extension = "jpg"
+    return salida.getvalue(), extension
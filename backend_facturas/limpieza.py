@@ -0,0 +1,201 @@
+import asyncio
+import os
+import time
+from db import obtener_conexion, transaccion
+from almacenamiento import DIR_UPLOADS, DIR_STATIC, TAMANOS_DERIVADAS
+from extractores import purgar_extracciones
+from sincronizacion import purgar_lapidas
+from cola_trabajos import purgar_trabajos
+from observabilidad import logger
+
+# Compactación de archivos: borra imágenes que ya no referencia ninguna fila
+# (escaneos nunca confirmados, registros eliminados, avatares/logos viejos) y
+# recalcula cuánto ocupa cada usuario.
+LIMPIEZA_GRACIA_HORAS = float(os.getenv("LIMPIEZA_GRACIA_HORAS", "48"))
+LIMPIEZA_INTERVALO_HORAS = float(os.getenv("LIMPIEZA_INTERVALO_HORAS", "6"))
+LIMPIEZA_LOTE = 500
+# Cuánto se recuerda una clave de idempotencia de guardar-confirmado-lote: un
+# reintento del mismo lote llega en minutos, no en semanas
+IDEMPOTENCIA_RETENCION_DIAS = float(os.getenv("IDEMPOTENCIA_RETENCION_DIAS", "7"))
+
+SQL_TABLA_USO = '''
+    CREATE TABLE IF NOT EXISTS uso_almacenamiento (
+        user_id TEXT PRIMARY KEY,   -- id de usuario o 'sin_usuario' (archivos del layout viejo)
+        archivos INTEGER,
+        bytes_comprobantes INTEGER,
+        bytes_perfil INTEGER,
+        actualizado REAL
+    )
+'''
+
+# Tablas que apuntan a imágenes subidas; el índice en ruta_imagen (migración 13)
+# permite volver a chequear cada candidato sin recorrer las tablas enteras
+TABLAS_CON_IMAGEN = ("compras_sire", "ventas_sire", "trabajos_escaneo")
+SQL_INDICES_RUTA_IMAGEN = [f"CREATE INDEX IF NOT EXISTS idx_{tabla}_ruta_imagen ON {tabla} (ruta_imagen)"
+                           for tabla in TABLAS_CON_IMAGEN]
+# ¿Alguna fila usa el original `base.*`? Cubre el original y sus derivadas ('/' va después de '.')
+SQL_USA_IMAGEN = " OR ".join(
+    f"EXISTS (SELECT 1 FROM {tabla} WHERE ruta_imagen > ?1 || '.' AND ruta_imagen < ?1 || '/')"
+    for tabla in TABLAS_CON_IMAGEN
+)
+
+SQL_INDICE_IDEMPOTENCIA = "CREATE INDEX IF NOT EXISTS idx_idempotencia_creado ON idempotencia (creado)"
+
+_tarea_limpieza = None
+
+
+def _rutas_referenciadas(conn) -> set:
+    """Todo lo que alguna fila usa, con las rutas tal como quedan en disco."""
+    referenciadas = set()
+    for tabla in TABLAS_CON_IMAGEN:
+        for (ruta,) in conn.execute(f"SELECT DISTINCT ruta_imagen FROM {tabla} WHERE ruta_imagen <> ''"):
+            referenciadas.add(ruta)
+            # Las derivadas viven y mueren con su original
+            base = ruta.rsplit(".", 1)[0]
+            referenciadas.update(f"{base}.{tamano}.jpg" for tamano in TAMANOS_DERIVADAS)
+    referenciadas.update(_rutas_perfil(conn))
+    return referenciadas
+
+
+def _rutas_perfil(conn) -> set:
+    return {f"{DIR_STATIC}/{ruta}" for foto, logo in conn.execute("SELECT foto_perfil, logo_empresa FROM usuarios")
+            for ruta in (foto, logo) if ruta}
+
+
+def _base_original(ruta: str) -> str:
+    """uploads/1/abc.jpg y uploads/1/abc.thumb.jpg -> uploads/1/abc"""
+    base = ruta.rsplit(".", 1)[0]
+    for tamano in TAMANOS_DERIVADAS:
+        if base.endswith(f".{tamano}"):
+            return base[:-len(tamano) - 1]
+    return base
+
+
+def _recorrer(base: str):
+    for carpeta, _, archivos in os.walk(base):
+        for nombre in archivos:
+            ruta = os.path.join(carpeta, nombre).replace(os.sep, "/")
+            try:
+                info = os.stat(ruta)
+            except FileNotFoundError:
+                continue  # lo borró otro proceso mientras recorríamos
+            yield ruta, info
+
+
+def _usuario_de(ruta: str) -> str:
+    # uploads/{usuario}/... y static/avatars/{usuario}/...; lo plano es del layout viejo
+    partes = ruta.split("/")
+    if partes[0] == DIR_UPLOADS:
+        return partes[1] if len(partes) > 2 else "sin_usuario"
+    return partes[2] if len(partes) > 3 else "sin_usuario"
+
+
+def purgar_idempotencia() -> int:
+    with transaccion() as conn:
+        return conn.execute("DELETE FROM idempotencia WHERE creado < ?",
+                            (time.time() - IDEMPOTENCIA_RETENCION_DIAS * 86400,)).rowcount
+
+
+def compactar(simular: bool = False) -> dict:
+    """Borra los archivos huérfanos más viejos que el periodo de gracia.
+
+    La gracia cubre el tiempo entre escanear y confirmar y los uploads en curso
+    (los .part también caen si quedaron abandonados). Antes de borrar se vuelve
+    a mirar la base con el lock de escritura tomado: mientras dure, ningún
+    guardar-confirmado puede empezar a apuntar a un archivo que vamos a borrar.
+    """
+    limite = time.time() - LIMPIEZA_GRACIA_HORAS * 3600
+    uso = {}
+    candidatos = []
+    if not simular:
+        # Sin esto, la imagen de un escaneo en cola que nunca se confirmó quedaba referenciada para siempre
+        purgar_trabajos()
+    # Una sola vez por corrida; bajo el lock solo se vuelve a mirar cada candidato por índice
+    referenciadas = _rutas_referenciadas(obtener_conexion())
+
+    def contar(ruta: str, tamano: int):
+        usuario = uso.setdefault(_usuario_de(ruta), {"archivos": 0, "bytes_comprobantes": 0, "bytes_perfil": 0})
+        usuario["archivos"] += 1
+        usuario["bytes_comprobantes" if ruta.startswith(f"{DIR_UPLOADS}/") else "bytes_perfil"] += tamano
+
+    for base in (DIR_UPLOADS, f"{DIR_STATIC}/avatars"):
+        for ruta, info in _recorrer(base):
+            if ruta not in referenciadas and info.st_mtime < limite:
+                candidatos.append((ruta, info.st_size))
+            else:
+                contar(ruta, info.st_size)
+
+    borrados, liberados = 0, 0
+    for i in range(0, len(candidatos), LIMPIEZA_LOTE):
+        lote = candidatos[i:i + LIMPIEZA_LOTE]
+        with transaccion() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            perfiles = _rutas_perfil(conn)
+            for ruta, tamano in lote:
+                if ruta in perfiles or conn.execute(f"SELECT {SQL_USA_IMAGEN}", (_base_original(ruta),)).fetchone()[0]:
+                    contar(ruta, tamano)
+                    continue
+                if not simular:
+                    try:
+                        os.remove(ruta)
+                    except FileNotFoundError:
+                        continue
+                borrados += 1
+                liberados += tamano
+
+    if not simular:
+        purgar_extracciones()
+        purgar_lapidas()
+        purgar_idempotencia()
+        ahora = time.time()
+        with transaccion() as conn:
+            conn.execute("DELETE FROM uso_almacenamiento")
+            conn.executemany(
+                "INSERT INTO uso_almacenamiento (user_id, archivos, bytes_comprobantes, bytes_perfil, actualizado) VALUES (?, ?, ?, ?, ?)",
+                [(u, d["archivos"], d["bytes_comprobantes"], d["bytes_perfil"], ahora) for u, d in uso.items()]
+            )
+    return {"borrados": borrados, "bytes_liberados": liberados, "usuarios": uso}
+
+
+def obtener_uso(user_id: int):
+    row = obtener_conexion().execute(
+        "SELECT archivos, bytes_comprobantes, bytes_perfil, actualizado FROM uso_almacenamiento WHERE user_id = ?",
+        (str(user_id),)
+    ).fetchone()
+    return dict(row) if row else None
+
+
+async def _bucle_limpieza():
+    while True:
+        await asyncio.sleep(LIMPIEZA_INTERVALO_HORAS * 3600)
+        try:
+            resultado = await asyncio.to_thread(compactar)
+            logger.info("Limpieza", extra={"borrados": resultado["borrados"], "bytes_liberados": resultado["bytes_liberados"]})
+        except Exception:
+            logger.exception("Limpieza falló")
+
+
+def arrancar_limpieza():
+    global _tarea_limpieza
+    _tarea_limpieza = asyncio.create_task(_bucle_limpieza())
+
+
+async def detener_limpieza():
+    global _tarea_limpieza
+    if _tarea_limpieza is not None:
+        _tarea_limpieza.cancel()
+        await asyncio.gather(_tarea_limpieza, return_exceptions=True)
+        _tarea_limpieza = None
+
+
+if __name__ == "__main__":
+    import sys
+    from migraciones import aplicar_migraciones
+    aplicar_migraciones()
+    simular = "--simular" in sys.argv
+    resultado = compactar(simular=simular)
+    print(f"{'Se borrarían' if simular else 'Borrados'}: {resultado['borrados']} archivo(s), "
+          f"{resultado['bytes_liberados'] / 1e6:.1f} MB")
+    for usuario, datos in sorted(resultado["usuarios"].items()):
+        print(f"  {usuario}: {datos['archivos']} archivo(s), "
+              f"{(datos['bytes_comprobantes'] + datos['bytes_perfil']) / 1e6:.1f} MB")
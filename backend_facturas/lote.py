@@ -0,0 +1,193 @@
+import asyncio
+import io
+import json
+import os
+import zipfile
+from imagenes import preprocesar_imagen
+from extraccion import extraer_lote, cache_extraccion, PROMPTS
+from extractores import extraer_comprobante, registrar_extraccion, reusar_extraccion
+from cola_trabajos import es_error_reintentable, espera_sugerida
+from db import en_db
+from maestro import completar_datos
+from validacion import validar
+from observabilidad import logger
+
+# Cuántas imágenes van juntas en una misma llamada a Gemini y tope de archivos por lote
+LOTE_RECIBOS_POR_LLAMADA = int(os.getenv("LOTE_RECIBOS_POR_LLAMADA", "5"))
+LOTE_MAX_ARCHIVOS = int(os.getenv("LOTE_MAX_ARCHIVOS", "200"))
+LOTE_MAX_BYTES_ARCHIVO = 25 * 1024 * 1024
+# Tope de todo el lote ya descomprimido: se lee entero en memoria antes de responder
+LOTE_MAX_BYTES = int(os.getenv("LOTE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+EXTENSIONES_LOTE = {"jpg", "jpeg", "png", "webp", "heic", "heif", "pdf"}
+
+
+def extension(nombre: str) -> str:
+    return nombre.rsplit(".", 1)[-1].lower() if "." in nombre else ""
+
+
+def expandir_archivo(nombre: str, contents: bytes, max_bytes: int = LOTE_MAX_BYTES) -> list:
+    """Devuelve [(nombre, bytes)]; un ZIP se abre y se toman sus imágenes/PDFs.
+
+    ValueError si lo que devolvería pasa de `max_bytes`; en un ZIP se corta
+    antes de descomprimir de más.
+    """
+    if not zipfile.is_zipfile(io.BytesIO(contents)):
+        if len(contents) > max_bytes:
+            raise ValueError(f"El lote supera {LOTE_MAX_BYTES // (1024 * 1024)} MB")
+        return [(nombre, contents)]
+    archivos = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(contents)) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or info.filename.startswith("__MACOSX/"):
+                continue
+            if extension(info.filename) not in EXTENSIONES_LOTE or info.file_size > LOTE_MAX_BYTES_ARCHIVO:
+                continue
+            # zipfile no lee más allá del tamaño declarado en el ZIP
+            total += info.file_size
+            if total > max_bytes:
+                raise ValueError(f"El lote supera {LOTE_MAX_BYTES // (1024 * 1024)} MB")
+            archivos.append((os.path.basename(info.filename), zf.read(info)))
+            if len(archivos) >= LOTE_MAX_ARCHIVOS:
+                break
+    return archivos
+
+
+def _linea(**campos) -> str:
+    return json.dumps(campos, ensure_ascii=False) + "\n"
+
+
+def _rechazados(grupo: list, e: Exception) -> list:
+    """Gemini está limitando o caído: un error reintentable por recibo, sin más llamadas."""
+    espera = espera_sugerida(e)
+    return [{"indice": r["indice"], "archivo": r["archivo"], "error": str(e), "reintentable": True,
+             **({"reintentar_en": espera} if espera is not None else {})} for r in grupo]
+
+
+async def _extraer_grupo(tipo: str, grupo: list) -> list:
+    """Extrae un grupo de recibos y devuelve el resultado de cada uno."""
+    prompt, version = PROMPTS[tipo]
+    if len(grupo) == 1 and grupo[0]["contents"][:5] == b"%PDF-":
+        recibo = grupo[0]
+        try:
+            resultados = await extraer_lote(prompt, [recibo["contents"]])
+        except Exception as e:
+            if es_error_reintentable(e):
+                return _rechazados(grupo, e)
+            return [{"indice": recibo["indice"], "archivo": recibo["archivo"], "error": str(e)}]
+        resultados_grupo = []
+        for pagina, datos in enumerate(resultados, start=1):
+            # Las páginas comparten archivo: la página va en los datos para que la
+            # extracción de cada una se registre (y se compare al confirmar) por separado
+            datos.update(ruta_imagen=recibo["ruta_imagen"], pagina=pagina, extractor="gemini")
+            resultados_grupo.append({"indice": recibo["indice"], "archivo": recibo["archivo"], "pagina": pagina, "datos": datos})
+        return resultados_grupo
+
+    try:
+        resultados = await extraer_lote(prompt, [r["contents"] for r in grupo]) if len(grupo) > 1 else None
+    except Exception as e:
+        # Con 429/5xx/timeout, pedir uno por uno multiplicaría las llamadas justo cuando Gemini pide bajar el ritmo
+        if es_error_reintentable(e):
+            logger.warning("Lote rechazado por Gemini", extra={"recibos": len(grupo), "error": str(e)})
+            return _rechazados(grupo, e)
+        logger.warning("Lote falló, se extrae uno por uno", extra={"recibos": len(grupo), "error": str(e)})
+        resultados = None
+
+    resultados_grupo = []
+    if resultados is not None and len(resultados) == len(grupo):
+        # El router no pasó por acá: se anota quién leyó cada uno para medir su precisión
+        for datos in resultados:
+            if isinstance(datos, dict):
+                datos["extractor"] = "gemini"
+    else:
+        # Gemini devolvió otra cantidad de objetos (no sabemos cuál es cuál) o falló: uno por
+        # uno, pasando por el router (si Gemini está caído, el OCR local puede cubrirlo)
+        resultados = []
+        for i, r in enumerate(grupo):
+            try:
+                resultados.append(await extraer_comprobante(tipo, r["contents"]))
+            except Exception as e:
+                if es_error_reintentable(e):
+                    # Los que faltan tampoco se piden
+                    resultados += _rechazados(grupo[i:], e)
+                    break
+                resultados.append(e)
+
+    for recibo, datos in zip(grupo, resultados):
+        if isinstance(datos, dict) and datos.get("reintentable"):
+            resultados_grupo.append(datos)
+            continue
+        if isinstance(datos, Exception) or not isinstance(datos, dict):
+            error = str(datos) if isinstance(datos, Exception) else "Respuesta inválida de Gemini"
+            resultados_grupo.append({"indice": recibo["indice"], "archivo": recibo["archivo"], "error": error})
+            continue
+        datos['ruta_imagen'] = recibo["ruta_imagen"]
+        cache_extraccion.guardar(cache_extraccion.clave(recibo["contents"], version), datos)
+        resultados_grupo.append({"indice": recibo["indice"], "archivo": recibo["archivo"], "datos": datos})
+    return resultados_grupo
+
+
+async def procesar_lote(tipo: str, archivos: list, user_id: int, guardar_bytes):
+    """Generador NDJSON: una línea por comprobante apenas esté listo y una final con el resumen.
+
+    `archivos` es [(nombre, bytes)] de `user_id` y `guardar_bytes(bytes, extension)` guarda el archivo
+    en uploads/ y devuelve su ruta; se llama en un hilo. Los aciertos de caché salen primero y sin tocar Gemini.
+    """
+    version = PROMPTS[tipo][1]
+    errores = 0
+    imagenes, pdfs = [], []
+
+    for indice, (nombre, contents) in enumerate(archivos):
+        ext = extension(nombre) or "jpg"
+        if contents[:5] != b"%PDF-":
+            contents, ext_procesada = await asyncio.to_thread(preprocesar_imagen, contents)
+            ext = ext_procesada or ext
+        datos = cache_extraccion.obtener(cache_extraccion.clave(contents, version))
+        if datos is not None:
+            datos = await reusar_extraccion(tipo, datos, contents, ext, user_id, guardar_bytes)
+            yield _linea(indice=indice, archivo=nombre, datos=validar(tipo, await en_db(completar_datos, tipo, datos, user_id)))
+            continue
+        recibo = {
+            "indice": indice,
+            "archivo": nombre,
+            "contents": contents,
+            "ruta_imagen": await asyncio.to_thread(guardar_bytes, contents, ext)
+        }
+        (pdfs if contents[:5] == b"%PDF-" else imagenes).append(recibo)
+
+    grupos = [imagenes[i:i + LOTE_RECIBOS_POR_LLAMADA] for i in range(0, len(imagenes), LOTE_RECIBOS_POR_LLAMADA)]
+    grupos += [[pdf] for pdf in pdfs]
+
+    pendientes = {asyncio.create_task(_extraer_grupo(tipo, g)): g for g in grupos}
+    try:
+        while pendientes:
+            terminadas, _ = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+            rechazo = None
+            for tarea in terminadas:
+                del pendientes[tarea]
+                for resultado in tarea.result():
+                    if "error" in resultado:
+                        errores += 1
+                        if resultado.get("reintentable"):
+                            rechazo = resultado
+                    else:
+                        await en_db(registrar_extraccion, user_id, tipo, resultado["datos"])
+                        resultado["datos"] = validar(tipo, await en_db(completar_datos, tipo, resultado["datos"], user_id))
+                    yield _linea(**resultado)
+            if rechazo is not None:
+                # Gemini pidió bajar el ritmo: los grupos que faltan no se mandan, la app los reintenta después
+                for tarea, grupo in pendientes.items():
+                    tarea.cancel()
+                    for recibo in grupo:
+                        errores += 1
+                        yield _linea(indice=recibo["indice"], archivo=recibo["archivo"], error=rechazo["error"],
+                                     reintentable=True, **({"reintentar_en": rechazo["reintentar_en"]}
+                                                          if "reintentar_en" in rechazo else {}))
+                pendientes = {}
+    finally:
+        # Si el cliente corta la conexión no seguimos gastando llamadas
+        for tarea in pendientes:
+            tarea.cancel()
+
+    yield _linea(fin=True, archivos=len(archivos), errores=errores)
@@ -0,0 +1,346 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from db import obtener_conexion, transaccion
+from observabilidad import logger
+
+# Maestro de proveedores/clientes por RUC o DNI, en dos partes:
+# - contribuyentes: el padrón reducido de SUNAT, público y compartido.
+# - contrapartes: lo que cada usuario confirmó (triggers de las migraciones 12 y 15).
+#   Es por usuario: la dirección y el teléfono de un cliente son datos de quien
+#   lo registró, y lo que escribe un usuario no cambia lo que ven los demás.
+# Con los dos se completan y corrigen los escaneos.
+MAESTRO_LRU_MAX = int(os.getenv("MAESTRO_LRU_MAX", "10000"))
+MAESTRO_LRU_TTL = float(os.getenv("MAESTRO_LRU_TTL", "600"))
+PADRON_FILAS_POR_LOTE = 20000
+
+SQL_TABLA_CONTRIBUYENTES = '''
+    CREATE TABLE IF NOT EXISTS contribuyentes (
+        nro_doc TEXT PRIMARY KEY,   -- RUC o DNI
+        razon_social TEXT,
+        direccion TEXT,
+        telefono TEXT,
+        estado TEXT,                -- ACTIVO, BAJA... (solo del padrón)
+        condicion TEXT,             -- HABIDO, NO HABIDO... (solo del padrón)
+        origen TEXT,                -- 'padron' ('confirmado' solo hasta la migración 12)
+        veces INTEGER DEFAULT 0,
+        actualizado REAL
+    ) WITHOUT ROWID
+'''
+
+SQL_TABLA_CONTRAPARTES = '''
+    CREATE TABLE IF NOT EXISTS contrapartes (
+        user_id INTEGER,
+        nro_doc TEXT,               -- RUC o DNI
+        razon_social TEXT,
+        direccion TEXT,
+        telefono TEXT,
+        veces INTEGER DEFAULT 0,    -- comprobantes confirmados con este documento
+        actualizado REAL,
+        PRIMARY KEY (user_id, nro_doc)
+    ) WITHOUT ROWID
+'''
+
+# tipo -> (tabla, documento, razón social, dirección, teléfono) en la tabla y en el JSON del escaneo
+FUENTES = {
+    "compra": ("compras_sire", ("proveedor_ruc", "proveedor_razon_social", "direccion_proveedor", "telefono_proveedor"),
+               ("proveedor_ruc", "proveedor_razon_social", "proveedor_direccion", "proveedor_telefono")),
+    "venta": ("ventas_sire", ("cliente_nro_doc", "cliente_razon_social", "direccion_cliente", "telefono_cliente"),
+              ("cliente_nro_doc", "cliente_razon_social", "cliente_direccion", "cliente_telefono")),
+}
+
+
+def _upsert_confirmado(tipo: str, f: str) -> str:
+    """Versión de la migración 6, con el maestro compartido entre usuarios; la
+    migración 12 borra sus triggers. Se conserva para que una base nueva pase
+    por las mismas migraciones que las existentes."""
+    tabla, (doc, razon, direccion, telefono), _ = FUENTES[tipo]
+    # En el trigger se lee la fila NEW; en la carga inicial, la tabla entera
+    origen_filas = "" if f else f"FROM {tabla}"
+    return f'''
+        INSERT INTO contribuyentes (nro_doc, razon_social, direccion, telefono, origen, veces, actualizado)
+        SELECT trim({f}{doc}), NULLIF(trim({f}{razon}), ''), NULLIF(trim({f}{direccion}), ''),
+               NULLIF(trim({f}{telefono}), ''), 'confirmado', 1, strftime('%s', 'now')
+        {origen_filas} WHERE trim(COALESCE({f}{doc}, '')) <> ''
+        ON CONFLICT (nro_doc) DO UPDATE SET
+            razon_social = CASE WHEN origen = 'padron' THEN razon_social
+                                ELSE COALESCE(excluded.razon_social, razon_social) END,
+            direccion = CASE WHEN origen = 'padron' AND direccion IS NOT NULL THEN direccion
+                             ELSE COALESCE(excluded.direccion, direccion) END,
+            telefono = COALESCE(excluded.telefono, telefono),
+            veces = veces + 1,
+            actualizado = excluded.actualizado
+    '''
+
+
+def _upsert_contraparte(tipo: str, f: str, veces: str = "1") -> str:
+    """Suma un comprobante confirmado a las contrapartes de su usuario.
+
+    `veces` es lo que se suma al contador si la contraparte ya existía: una
+    edición que no cambia el documento no es un comprobante más."""
+    tabla, (doc, razon, direccion, telefono), _ = FUENTES[tipo]
+    # En el trigger se lee la fila NEW; en la carga inicial, la tabla entera
+    origen_filas = "" if f else f"FROM {tabla}"
+    return f'''
+        INSERT INTO contrapartes (user_id, nro_doc, razon_social, direccion, telefono, veces, actualizado)
+        SELECT {f}user_id, trim({f}{doc}), NULLIF(trim({f}{razon}), ''), NULLIF(trim({f}{direccion}), ''),
+               NULLIF(trim({f}{telefono}), ''), 1, strftime('%s', 'now')
+        {origen_filas} WHERE trim(COALESCE({f}{doc}, '')) <> '' AND {f}user_id IS NOT NULL
+        ON CONFLICT (user_id, nro_doc) DO UPDATE SET
+            razon_social = COALESCE(excluded.razon_social, razon_social),
+            direccion = COALESCE(excluded.direccion, direccion),
+            telefono = COALESCE(excluded.telefono, telefono),
+            veces = veces + {veces},
+            actualizado = excluded.actualizado
+    '''
+
+
+def sql_migracion_maestro() -> list:
+    sentencias = [SQL_TABLA_CONTRIBUYENTES]
+    for tipo, (tabla, *_) in FUENTES.items():
+        sentencias.append(f"CREATE TRIGGER IF NOT EXISTS trg_maestro_{tabla}_ins AFTER INSERT ON {tabla} "
+                          f"BEGIN {_upsert_confirmado(tipo, 'NEW.')}; END")
+    for tipo, (tabla, *_) in FUENTES.items():
+        # Carga inicial con lo ya confirmado, en orden: el último dato gana
+        columna_id = "id_gasto" if tipo == "compra" else "id_transaccion"
+        sentencias.append(_upsert_confirmado(tipo, "").replace(
+            "ON CONFLICT", f"ORDER BY {columna_id} ON CONFLICT", 1))
+    return sentencias
+
+
+def sql_migracion_contrapartes() -> list:
+    """Separa lo confirmado por cada usuario del padrón compartido."""
+    sentencias = [SQL_TABLA_CONTRAPARTES]
+    for tipo, (tabla, *_) in FUENTES.items():
+        columna_id = "id_gasto" if tipo == "compra" else "id_transaccion"
+        sentencias += [
+            f"DROP TRIGGER IF EXISTS trg_maestro_{tabla}_ins",
+            f"CREATE TRIGGER IF NOT EXISTS trg_contrapartes_{tabla}_ins AFTER INSERT ON {tabla} "
+            f"BEGIN {_upsert_contraparte(tipo, 'NEW.')}; END",
+            # Carga inicial con lo ya confirmado, en orden: el último dato gana
+            _upsert_contraparte(tipo, "").replace("ON CONFLICT", f"ORDER BY {columna_id} ON CONFLICT", 1),
+        ]
+    sentencias += [
+        # En el maestro compartido queda solo el padrón, sin nada que haya escrito un usuario:
+        # los teléfonos, y las direcciones que el padrón no traía, salieron de comprobantes.
+        # No se distingue cuál dirección era de cuál: se borra toda la que coincida con una
+        # confirmada, y volver a cargar el padrón recupera las que sí eran de SUNAT.
+        "DELETE FROM contribuyentes WHERE origen <> 'padron' OR origen IS NULL",
+        '''UPDATE contribuyentes SET telefono = NULL, veces = 0,
+               direccion = CASE WHEN EXISTS (SELECT 1 FROM contrapartes c WHERE c.nro_doc = contribuyentes.nro_doc
+                                                                         AND c.direccion = contribuyentes.direccion)
+                                THEN NULL ELSE direccion END''',
+    ]
+    return sentencias
+
+
+def sql_migracion_contrapartes_edicion() -> list:
+    """Editar la contraparte de un comprobante guardado (PUT /actualizar-registro)
+    también actualiza el maestro del usuario, no solo confirmarlo."""
+    sentencias = []
+    for tipo, (tabla, columnas, _) in FUENTES.items():
+        doc = columnas[0]
+        # Solo si cambió alguno: reguardar un comprobante viejo sin tocar la
+        # contraparte no debe pisar con sus datos los más nuevos
+        cambio = " OR ".join(f"NEW.{c} IS NOT OLD.{c}" for c in columnas)
+        otro_doc = f"(trim(NEW.{doc}) IS NOT trim(OLD.{doc}) OR NEW.user_id IS NOT OLD.user_id)"
+        sentencias.append(
+            f"CREATE TRIGGER IF NOT EXISTS trg_contrapartes_{tabla}_upd "
+            f"AFTER UPDATE OF user_id, {', '.join(columnas)} ON {tabla} WHEN {cambio} BEGIN "
+            # Si cambió el documento, el comprobante pasa de una contraparte a otra
+            f"UPDATE contrapartes SET veces = veces - 1 "
+            f"WHERE user_id = OLD.user_id AND nro_doc = trim(OLD.{doc}) AND {otro_doc}; "
+            f"{_upsert_contraparte(tipo, 'NEW.', otro_doc)}; END"
+        )
+    return sentencias
+
+
+class CacheContribuyentes:
+    """LRU en memoria delante de las tablas, por (user_id, documento); guarda
+    también los "no encontrado" para no ir a SQLite en cada escaneo de un RUC
+    desconocido. Se usa desde los hilos del pool de SQLite, por eso el lock."""
+
+    def __init__(self, max_entradas: int, ttl: float):
+        self.max_entradas = max_entradas
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave: tuple):
+        """Devuelve (encontrado_en_cache, contribuyente o None)."""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                return False, None
+            creado, contribuyente = entrada
+            if time.time() - creado > self.ttl:
+                del self._entradas[clave]
+                return False, None
+            self._entradas.move_to_end(clave)
+            return True, contribuyente
+
+    def guardar(self, clave: tuple, contribuyente):
+        with self._lock:
+            self._entradas[clave] = (time.time(), contribuyente)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.max_entradas:
+                self._entradas.popitem(last=False)
+
+    def olvidar(self, clave: tuple):
+        with self._lock:
+            self._entradas.pop(clave, None)
+
+    def limpiar(self):
+        with self._lock:
+            self._entradas.clear()
+
+
+cache_contribuyentes = CacheContribuyentes(MAESTRO_LRU_MAX, MAESTRO_LRU_TTL)
+
+
+def buscar_contribuyente(nro_doc: str, user_id: int):
+    """El padrón (compartido) combinado con lo que confirmó este usuario: la
+    razón social y la dirección fiscal del padrón mandan; el teléfono y lo que
+    el padrón no trae salen de los comprobantes del propio usuario."""
+    clave = (user_id, nro_doc)
+    encontrado, contribuyente = cache_contribuyentes.obtener(clave)
+    if encontrado:
+        return contribuyente
+    conn = obtener_conexion()
+    padron = conn.execute(
+        "SELECT razon_social, direccion, estado, condicion FROM contribuyentes WHERE nro_doc = ? AND origen = 'padron'",
+        (nro_doc,)
+    ).fetchone()
+    propio = conn.execute(
+        "SELECT razon_social, direccion, telefono FROM contrapartes WHERE user_id = ? AND nro_doc = ?",
+        (user_id, nro_doc)
+    ).fetchone()
+    contribuyente = None
+    if padron or propio:
+        contribuyente = {
+            "nro_doc": nro_doc,
+            "razon_social": (padron and padron["razon_social"]) or (propio and propio["razon_social"]) or None,
+            "direccion": (padron and padron["direccion"]) or (propio and propio["direccion"]) or None,
+            "telefono": propio["telefono"] if propio else None,
+            "estado": padron["estado"] if padron else None,
+            "condicion": padron["condicion"] if padron else None,
+            "origen": "padron" if padron else "confirmado",
+        }
+    cache_contribuyentes.guardar(clave, contribuyente)
+    return contribuyente
+
+
+def olvidar_contraparte(tipo: str, datos: dict, user_id: int):
+    """Saca del LRU al contribuyente de un comprobante recién confirmado: el
+    trigger ya actualizó la tabla y el próximo escaneo debe ver el dato nuevo."""
+    campo_doc = FUENTES[tipo][2][0]
+    cache_contribuyentes.olvidar((user_id, str(datos.get(campo_doc) or "").strip()))
+
+
+def _comparable(texto: str) -> str:
+    # "ACME S.A.C." y "Acme SAC" son el mismo nombre; "ACME" y "ACME SAC" no
+    return re.sub(r"[^0-9A-Z]", "", texto.upper())
+
+
+def completar_datos(tipo: str, datos: dict, user_id: int) -> dict:
+    """Completa y corrige la contraparte de un escaneo con el maestro del usuario.
+
+    La razón social del maestro reemplaza a la leída de la foto (es la de SUNAT
+    o la que este usuario ya confirmó); si no coinciden, la leída queda en
+    `correcciones` para que la app muestre el cambio. Dirección y teléfono solo
+    se llenan si faltan. Si el contribuyente viene del padrón se agrega su
+    estado y condición.
+    """
+    _, _, (campo_doc, campo_razon, campo_direccion, campo_telefono) = FUENTES[tipo]
+    nro_doc = re.sub(r"\D", "", str(datos.get(campo_doc) or ""))
+    if not nro_doc:
+        return datos
+    datos[campo_doc] = nro_doc
+    contribuyente = buscar_contribuyente(nro_doc, user_id)
+    if contribuyente is None:
+        return datos
+
+    if contribuyente["razon_social"]:
+        leida = str(datos.get(campo_razon) or "").strip()
+        if leida and _comparable(leida) != _comparable(contribuyente["razon_social"]):
+            datos.setdefault("correcciones", {})[campo_razon] = leida
+        datos[campo_razon] = contribuyente["razon_social"]
+    for campo, columna in ((campo_direccion, "direccion"), (campo_telefono, "telefono")):
+        if not datos.get(campo) and contribuyente[columna]:
+            datos[campo] = contribuyente[columna]
+    if contribuyente["origen"] == "padron":
+        datos["contribuyente_estado"] = contribuyente["estado"]
+        datos["contribuyente_condicion"] = contribuyente["condicion"]
+    return datos
+
+
+def _direccion_padron(campos: list):
+    # Columnas 5..14 del padrón reducido; SUNAT pone "-" donde no hay dato
+    tipo_via, nombre_via, codigo_zona, tipo_zona, numero, interior, lote, dpto, manzana, km = (
+        "" if c.strip() == "-" else c.strip() for c in campos[5:15]
+    )
+    partes = [
+        ("", tipo_via), ("", nombre_via), ("NRO.", numero), ("INT.", interior), ("DPTO.", dpto),
+        ("MZA.", manzana), ("LOTE.", lote), ("KM.", km), ("", codigo_zona), ("", tipo_zona)
+    ]
+    return " ".join(f"{prefijo} {valor}".strip() for prefijo, valor in partes if valor) or None
+
+
+SQL_UPSERT_PADRON = '''
+    INSERT INTO contribuyentes (nro_doc, razon_social, direccion, estado, condicion, origen, veces, actualizado)
+    VALUES (?, ?, ?, ?, ?, 'padron', 0, ?)
+    ON CONFLICT (nro_doc) DO UPDATE SET
+        razon_social = excluded.razon_social,
+        direccion = excluded.direccion,
+        estado = excluded.estado,
+        condicion = excluded.condicion,
+        origen = 'padron',
+        actualizado = excluded.actualizado
+'''
+
+
+def cargar_padron(ruta: str, progreso=None) -> int:
+    """Carga el padrón reducido de SUNAT (padron_reducido_ruc.txt, separado por
+    '|', en latin-1). Lee por streaming y confirma cada PADRON_FILAS_POR_LOTE
+    filas, así no se necesita el archivo entero en memoria. Tras cada lote
+    llama a `progreso(total)` si se pasa, y lo deja en el log."""
+    total = 0
+    filas = []
+    ahora = time.time()
+
+    def confirmar():
+        with transaccion() as conn:
+            conn.executemany(SQL_UPSERT_PADRON, filas)
+
+    with open(ruta, encoding="latin-1", errors="replace") as archivo:
+        next(archivo, None)  # cabecera
+        for linea in archivo:
+            campos = linea.rstrip("\r\n").split("|")
+            if len(campos) < 15 or not campos[0].isdigit():
+                continue
+            filas.append((campos[0], campos[1].strip(), _direccion_padron(campos),
+                          campos[2].strip(), campos[3].strip(), ahora))
+            if len(filas) >= PADRON_FILAS_POR_LOTE:
+                confirmar()
+                total += len(filas)
+                filas = []
+                logger.info("Padrón", extra={"contribuyentes": total})
+                if progreso:
+                    progreso(total)
+    if filas:
+        confirmar()
+        total += len(filas)
+    cache_contribuyentes.limpiar()
+    return total
+
+
+if __name__ == "__main__":
+    import sys
+    from migraciones import aplicar_migraciones
+    if len(sys.argv) != 2:
+        raise SystemExit("Uso: python maestro.py padron_reducido_ruc.txt")
+    aplicar_migraciones()
+    total = cargar_padron(sys.argv[1], progreso=lambda n: print(f"... {n} contribuyentes"))
+    print(f"Padrón cargado: {total} contribuyentes")
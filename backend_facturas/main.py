@@ -1,223 +1,143 @@
-import io
+import asyncio
+import functools
 import json
+import math
 import sqlite3
 import os
 import time
-import shutil
-import uuid
-from datetime import datetime
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from datetime import date
+from fastapi import APIRouter, Depends, FastAPI, File, UploadFile, HTTPException, Form, Query, Header, Request
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
-from PIL import Image
+from starlette.middleware.gzip import GZipMiddleware
+from pydantic import BaseModel, model_validator
+from typing import List, Literal, Optional
+from starlette.background import BackgroundTask
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.routing import Match
 import uvicorn
-from google import genai
-from google.genai import types
-
-GOOGLE_API_KEY = ""
-
-client = genai.Client(api_key=GOOGLE_API_KEY)
-app = FastAPI()
-
-os.makedirs("uploads", exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
-
-os.makedirs("static/avatars", exist_ok=True) # Asegura que la carpeta exista
-app.mount("/static", StaticFiles(directory="static"), name="static")
-
-def iniciar_base_datos():
-    conn = sqlite3.connect("contabilidad.db")
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id_usuario INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            nombre_completo TEXT,
-            plan TEXT DEFAULT 'Basic',
-            fecha_registro TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS compras_sire (
-            id_gasto INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            periodo_tributario TEXT,
-            fecha_emision TEXT,
-            proveedor_ruc TEXT,
-            proveedor_razon_social TEXT,
-            tipo_comprobante TEXT,
-            serie TEXT,
-            numero TEXT,
-            cod_destino_credito TEXT,
-            base_imponible_1 REAL,
-            igv_1 REAL,
-            monto_total REAL,
-            clasificacion_bien_servicio TEXT,
-            ruta_imagen TEXT,
-            FOREIGN KEY(user_id) REFERENCES usuarios(id_usuario)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS ventas_sire (
-            id_transaccion INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            periodo_tributario TEXT,
-            fecha_emision TEXT,
-            tipo_comprobante TEXT,
-            serie_comprobante TEXT,
-            nro_comprobante TEXT,
-            cliente_tipo_doc TEXT,
-            cliente_nro_doc TEXT,
-            cliente_razon_social TEXT,
-            valor_exportacion REAL DEFAULT 0,
-            base_imponible_gravada REAL DEFAULT 0,
-            dscto_base_imponible REAL DEFAULT 0,
-            monto_igv REAL DEFAULT 0,
-            dscto_igv REAL DEFAULT 0,
-            importe_exonerado REAL DEFAULT 0,
-            importe_inafecto REAL DEFAULT 0,
-            isc REAL DEFAULT 0,
-            base_ivap REAL DEFAULT 0,
-            ivap REAL DEFAULT 0,
-            icbper REAL DEFAULT 0,
-            otros_tributos REAL DEFAULT 0,
-            total_cp REAL DEFAULT 0,
-            moneda TEXT DEFAULT 'PEN',
-            tipo_cambio REAL DEFAULT 1.0,
-            estado_sire INTEGER DEFAULT 2,
-            FOREIGN KEY(user_id) REFERENCES usuarios(id_usuario)
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS detalle_items (
-            id_item INTEGER PRIMARY KEY AUTOINCREMENT,
-            tipo_registro TEXT, -- 'compra' o 'venta'
-            id_padre INTEGER,   -- ID de la compra o venta
-            descripcion TEXT,
-            cantidad REAL,
-            precio_unitario REAL,
-            total REAL
-        )
-    ''')
-    cursor.execute("SELECT count(*) FROM usuarios")
-    if cursor.fetchone()[0] == 0:
-        cursor.execute('''
-            INSERT INTO usuarios (email, password, nombre_completo, plan) 
-            VALUES (?, ?, ?, ?)
-        ''', ('oscar@qonta.com', '123456', 'Oscar', 'Basic'))
-        
-    conn.commit()
-    conn.close()
-
-iniciar_base_datos()
-
-def verificar_columna_nickname():
-    conn = sqlite3.connect("contabilidad.db")
-    cursor = conn.cursor()
+from extraccion import cache_extraccion, GEMINI_TIMEOUT, VERSION_PROMPT_COMPRA, VERSION_PROMPT_VENTA
+from extractores import extraer_comprobante, registrar_extraccion, reusar_extraccion, comparar_confirmado, estadisticas_extractores
+from validacion import (
+    calcular_periodo, validar, validar_lote, guardar_validacion, obtener_validacion,
+    revalidar, resumen_validaciones
+)
+from imagenes import preprocesar_imagen
+from lote import expandir_archivo, procesar_lote, LOTE_MAX_ARCHIVOS, LOTE_MAX_BYTES
+from db import obtener_conexion, transaccion, en_db
+from migraciones import aplicar_migraciones
+import sire
+from resumenes import obtener_resumen
+from busqueda import buscar_documentos, BUSQUEDA_POR_PAGINA_MAX
+from duplicados import buscar_duplicado
+from maestro import completar_datos, olvidar_contraparte
+from almacenamiento import (
+    ArchivosEstaticos, guardar_imagen, guardar_upload, ruta_derivada, es_de_usuario, CACHE_CONTROL_STATIC,
+    DIR_UPLOADS, DIR_STATIC
+)
+from limpieza import arrancar_limpieza, detener_limpieza, obtener_uso
+from cola_trabajos import (
+    encolar_trabajo, trabajo_completado, obtener_trabajo, arrancar_workers, detener_workers, validar_webhook,
+    es_error_reintentable, espera_sugerida
+)
+from sincronizacion import cambios_desde
+from autenticacion import hashear, comprobar, emitir_token, usuario_actual, usuario_admin, exigir_dueno
+from observabilidad import (
+    configurar_logs, logger, medir, nuevo_trace_id, exportar_metricas, etapas_actuales, CABECERA_TRACE,
+    HTTP_DURACION, HTTP_EN_CURSO, UPLOAD_BYTES, preparar_metricas_multiproceso, cerrar_metricas
+)
+
+# Con SERVIDOR_WORKERS > 1 cada worker es un proceso aparte con su propia app
+SERVIDOR_HOST = os.getenv("SERVIDOR_HOST", "0.0.0.0")
+SERVIDOR_PUERTO = int(os.getenv("SERVIDOR_PUERTO", "8000"))
+SERVIDOR_WORKERS = int(os.getenv("SERVIDOR_WORKERS", "1"))
+# gzip: por debajo de ~1 KB no compensa; nivel 6 comprime casi como 9 con bastante menos CPU
+GZIP_MINIMO_BYTES = int(os.getenv("GZIP_MINIMO_BYTES", "1024"))
+GZIP_NIVEL = int(os.getenv("GZIP_NIVEL", "6"))
+# Retry-After de un escaneo que falló por Gemini saturado o caído, si Gemini no dice cuánto esperar
+ESCANEO_REINTENTAR_EN = float(os.getenv("ESCANEO_REINTENTAR_EN", "30"))
+
+router = APIRouter()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    os.makedirs(DIR_UPLOADS, exist_ok=True)
+    os.makedirs(f"{DIR_STATIC}/avatars", exist_ok=True)
+    # Una sola consulta a schema_version si la base ya está al día
+    await asyncio.to_thread(aplicar_migraciones)
+    arrancar_workers()
+    arrancar_limpieza()
+    yield
+    await detener_limpieza()
+    await detener_workers()
+    cerrar_metricas()
+
+def _plantilla_ruta(request: Request) -> str:
+    # La plantilla (/obtener-detalle/{tipo}/{id_registro}) y no el path: con ids
+    # en la etiqueta cada registro sería una serie nueva en Prometheus
+    # Las rutas propias viven en `router` (incluido sin prefijo); /docs, en la app
+    for ruta in (*router.routes, *request.app.router.routes):
+        if getattr(ruta, "path", None) is None:
+            continue
+        coincide, _ = ruta.matches(request.scope)
+        if coincide == Match.FULL:
+            return ruta.path
+    return "desconocida"
+
+async def observar_request(request: Request, call_next):
+    trace_id = nuevo_trace_id(request.headers.get(CABECERA_TRACE))
+    metodo, ruta = request.method, _plantilla_ruta(request)
+    tamano = request.headers.get("content-length")
+    if tamano and tamano.isdigit() and request.headers.get("content-type", "").startswith("multipart/"):
+        UPLOAD_BYTES.labels(ruta).observe(int(tamano))
+
+    estado = 500
+    inicio = time.perf_counter()
+    HTTP_EN_CURSO.labels(metodo, ruta).inc()
     try:
-        cursor.execute("SELECT nickname FROM usuarios LIMIT 1")
-    except sqlite3.OperationalError:
-        cursor.execute("ALTER TABLE usuarios ADD COLUMN nickname TEXT")
-        conn.commit()
-    conn.close()
-
-verificar_columna_nickname() # Ejecutar al inicio
-
-def verificar_columna_foto_perfil():
-    conn = sqlite3.connect("contabilidad.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT foto_perfil FROM usuarios LIMIT 1")
-    except sqlite3.OperationalError:
-        print("📸 Agregando columna 'foto_perfil' a la tabla usuarios...")
-        cursor.execute("ALTER TABLE usuarios ADD COLUMN foto_perfil TEXT DEFAULT 'default_avatar.png'")
-        conn.commit()
-    conn.close()
-
-verificar_columna_foto_perfil()
-
-def calcular_periodo(fecha_str):
-    try:
-        dt = datetime.strptime(fecha_str, "%d/%m/%Y")
-        return dt.strftime("%Y%m")
-    except:
-        return datetime.now().strftime("%Y%m")
-
-def guardar_imagen_disco(uploaded_file: UploadFile):
-    extension = uploaded_file.filename.split(".")[-1]
-    nombre_archivo = f"{uuid.uuid4()}.{extension}"
-    ruta_relativa = f"uploads/{nombre_archivo}"
-    with open(ruta_relativa, "wb") as buffer:
-        shutil.copyfileobj(uploaded_file.file, buffer)
-    uploaded_file.file.seek(0)
-    return ruta_relativa
+        response = await call_next(request)
+        estado = response.status_code
+        response.headers[CABECERA_TRACE] = trace_id
+        return response
+    finally:
+        duracion = time.perf_counter() - inicio
+        HTTP_EN_CURSO.labels(metodo, ruta).dec()
+        HTTP_DURACION.labels(metodo, ruta, str(estado)).observe(duracion)
+        if ruta != "/metrics":
+            logger.info("request", extra={
+                "metodo": metodo, "ruta": ruta, "path": request.url.path, "estado": estado,
+                "duracion_ms": round(duracion * 1000, 2), "etapas": etapas_actuales.get()
+            })
+
+@router.get("/metrics")
+async def metricas():
+    return Response(exportar_metricas(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+TABLAS_REGISTRO = {
+    # tipo en la URL: (tabla, columna id, tipo_registro en detalle_items)
+    "compras": ("compras_sire", "id_gasto", "compra"),
+    "ventas": ("ventas_sire", "id_transaccion", "venta")
+}
 
 class RegisterRequest(BaseModel):
     nombre: str
     email: str
     password: str
 
-def verificar_datos_empresa():
-    conn = sqlite3.connect("contabilidad.db")
-    cursor = conn.cursor()
-    cols = [
-        ("ruc_empresa", "TEXT"),
-        ("razon_social", "TEXT"),
-        ("direccion_fiscal", "TEXT"),
-        ("logo_empresa", "TEXT DEFAULT 'default_logo.png'")
-    ]
-    for col_name, col_type in cols:
-        try:
-            cursor.execute(f"SELECT {col_name} FROM usuarios LIMIT 1")
-        except sqlite3.OperationalError:
-            print(f"📦 Agregando columna '{col_name}'...")
-            cursor.execute(f"ALTER TABLE usuarios ADD COLUMN {col_name} {col_type}")
-    conn.commit()
-    conn.close()
-
-verificar_datos_empresa()
-
-def verificar_columnas_extra():
-    conn = sqlite3.connect("contabilidad.db")
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT direccion_proveedor FROM compras_sire LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Agregando columnas extra a compras...")
-        cursor.execute("ALTER TABLE compras_sire ADD COLUMN direccion_proveedor TEXT")
-        cursor.execute("ALTER TABLE compras_sire ADD COLUMN telefono_proveedor TEXT")
-
-    try:
-        cursor.execute("SELECT direccion_cliente FROM ventas_sire LIMIT 1")
-    except sqlite3.OperationalError:
-        print("Agregando columnas extra a ventas...")
-        cursor.execute("ALTER TABLE ventas_sire ADD COLUMN direccion_cliente TEXT")
-        cursor.execute("ALTER TABLE ventas_sire ADD COLUMN telefono_cliente TEXT")
-
-    conn.commit()
-    conn.close()
-
-verificar_columnas_extra()
+def _insertar_usuario(nombre, email, password_hash):
+    with transaccion() as conn:
+        cursor = conn.execute("INSERT INTO usuarios (nombre_completo, email, password) VALUES (?, ?, ?)",
+                              (nombre, email, password_hash))
+        return cursor.lastrowid
 
-@app.post("/register/")
+@router.post("/register/")
 async def register(usuario: RegisterRequest):
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-        cursor.execute("INSERT INTO usuarios (nombre_completo, email, password) VALUES (?, ?, ?)", 
-                       (usuario.nombre, usuario.email, usuario.password))
-        conn.commit()
-        user_id = cursor.lastrowid
-        conn.close()
-        return {"status": "ok", "user_id": user_id, "nombre": usuario.nombre}
+        password_hash = await hashear(usuario.password)
+        user_id = await en_db(_insertar_usuario, usuario.nombre, usuario.email, password_hash)
+        token, expira = emitir_token(user_id)
+        return {"status": "ok", "user_id": user_id, "nombre": usuario.nombre, "token": token, "expira": expira}
     except sqlite3.IntegrityError:
         return JSONResponse(content={"error": "El correo ya está registrado"}, status_code=400)
     except Exception as e:
@@ -227,20 +147,31 @@ class LoginRequest(BaseModel):
     email: str
     password: str
 
-@app.post("/login/")
+def _buscar_credenciales(email):
+    return obtener_conexion().execute(
+        "SELECT id_usuario, nombre_completo, email, plan, password FROM usuarios WHERE email = ?", (email,)
+    ).fetchone()
+
+def _actualizar_password(user_id, password_hash):
+    with transaccion() as conn:
+        conn.execute("UPDATE usuarios SET password = ? WHERE id_usuario = ?", (password_hash, user_id))
+
+@router.post("/login/")
 async def login(usuario: LoginRequest):
-    print(f"🔑 Login: {usuario.email}")
+    logger.info("Login", extra={"email": usuario.email})
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM usuarios WHERE email = ? AND password = ?", (usuario.email, usuario.password))
-        user = cursor.fetchone()
-        conn.close()
-        
-        if user:
+        user = await en_db(_buscar_credenciales, usuario.email)
+        correcta, rehashear = await comprobar(usuario.password, user['password'] if user else None)
+
+        if correcta:
+            # Contraseña en texto plano (cuentas viejas) o con otro costo: se guarda con el hash actual
+            if rehashear:
+                await en_db(_actualizar_password, user['id_usuario'], await hashear(usuario.password))
+            token, expira = emitir_token(user['id_usuario'])
             return {
                 "status": "ok",
+                "token": token,
+                "expira": expira,
                 "usuario": {
                     "id": user['id_usuario'],
                     "nombre": user['nombre_completo'],
@@ -253,214 +184,552 @@ async def login(usuario: LoginRequest):
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/escanear-compra/")
-async def escanear_compra(user_id: int = Form(...), file: UploadFile = File(...)):
-    print(f"📷 Compra User {user_id}: {file.filename}")
+def _error_extraccion(e: Exception) -> JSONResponse:
+    """Lo que la cola reintentaría (429, 5xx, timeout de Gemini) sale como
+    429/503/504 con Retry-After, para que la app espere y reintente; el resto, 500."""
+    if not es_error_reintentable(e):
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    if isinstance(e, asyncio.TimeoutError):
+        estado, mensaje = 504, f"Gemini no respondió en {GEMINI_TIMEOUT:.0f}s"
+    elif getattr(e, "code", None) == 429:
+        estado, mensaje = 429, "Gemini está saturado, reintenta en unos segundos"
+    else:
+        estado, mensaje = 503, "Gemini no está disponible, reintenta en unos segundos"
+    espera = espera_sugerida(e) or ESCANEO_REINTENTAR_EN
+    return JSONResponse(content={"error": mensaje}, status_code=estado, headers={"Retry-After": str(math.ceil(espera))})
+
+@router.post("/escanear-compra/")
+async def escanear_compra(user_id: int = Form(...), file: UploadFile = File(...),
+                          asincrono: bool = Form(False), webhook_url: Optional[str] = Form(None),
+                          usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
+    if asincrono and webhook_url:
+        try:
+            await validar_webhook(webhook_url)
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+    logger.info("Escaneo", extra={"tipo": "compra", "user_id": user_id, "archivo": file.filename})
     try:
-        ruta_imagen = guardar_imagen_disco(file)
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-
-        prompt = """Analiza esta FACTURA/BOLETA DE COMPRA. 
-        Extrae los datos, incluyendo dirección y teléfono si aparecen.
-        Devuelve JSON: {
-            "fecha_emision": "DD/MM/YYYY", 
-            "proveedor_ruc": "...", 
-            "proveedor_razon_social": "...",
-            "proveedor_direccion": "...",  
-            "proveedor_telefono": "...",
-            "tipo_comprobante": "Factura/Boleta", 
-            "serie": "...", 
-            "numero": "...", 
-            "monto_total": 0.0,
-            "items": [
-                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
-            ]
-        }"""
-
-        response = client.models.generate_content(
-            model='gemini-flash-latest', contents=[prompt, image],
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        datos = json.loads(response.text.strip())
+        with medir("lectura_upload"):
+            original = await file.read()
+        with medir("preprocesado"):
+            contents, extension = await asyncio.to_thread(preprocesar_imagen, original)
+        clave = cache_extraccion.clave(contents, VERSION_PROMPT_COMPRA)
+        datos = cache_extraccion.obtener(clave)
+        if datos is not None:
+            datos = await reusar_extraccion("compra", datos, contents, extension or file.filename.split(".")[-1], user_id,
+                                            functools.partial(guardar_imagen, user_id=user_id))
+            datos = validar("compra", await en_db(completar_datos, "compra", datos, user_id))
+            if asincrono:
+                id_trabajo = await trabajo_completado(user_id, "compra", datos, webhook_url)
+                return JSONResponse(content={"mensaje": "Escaneo en cola", "job_id": id_trabajo}, status_code=202)
+            return JSONResponse(content={"mensaje": "Escaneo Exitoso", "datos": datos})
+
+        with medir("disco"):
+            ruta_imagen = await asyncio.to_thread(guardar_imagen, contents, extension or file.filename.split(".")[-1], user_id)
+
+        # Modo trabajo: respondemos al toque y la extracción sigue en la cola
+        if asincrono:
+            id_trabajo = await encolar_trabajo(user_id, "compra", ruta_imagen, webhook_url)
+            return JSONResponse(content={"mensaje": "Escaneo en cola", "job_id": id_trabajo}, status_code=202)
+
+        datos = await extraer_comprobante("compra", contents)
 
         datos['ruta_imagen'] = ruta_imagen
-
+        cache_extraccion.guardar(clave, datos)
+        await en_db(registrar_extraccion, user_id, "compra", datos)
+        # RUC conocido: razón social, dirección y teléfono salen del maestro
+        datos = await en_db(completar_datos, "compra", datos, user_id)
+        # Fecha, serie y montos normalizados; lo dudoso la app lo muestra para revisar
+        validar("compra", datos)
 
         return JSONResponse(content={"mensaje": "Escaneo Exitoso", "datos": datos})
     except Exception as e:
-        return JSONResponse(content={"error": str(e)}, status_code=500)
-
-@app.post("/escanear-venta/")
-async def escanear_venta(user_id: int = Form(...), file: UploadFile = File(...)):
-    print(f"📷 Venta User {user_id}: {file.filename}")
+        return _error_extraccion(e)
+
+@router.post("/escanear-venta/")
+async def escanear_venta(user_id: int = Form(...), file: UploadFile = File(...),
+                          asincrono: bool = Form(False), webhook_url: Optional[str] = Form(None),
+                          usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
+    if asincrono and webhook_url:
+        try:
+            await validar_webhook(webhook_url)
+        except ValueError as e:
+            return JSONResponse(content={"error": str(e)}, status_code=400)
+    logger.info("Escaneo", extra={"tipo": "venta", "user_id": user_id, "archivo": file.filename})
     try:
+        with medir("lectura_upload"):
+            original = await file.read()
+        with medir("preprocesado"):
+            contents, extension = await asyncio.to_thread(preprocesar_imagen, original)
+        clave = cache_extraccion.clave(contents, VERSION_PROMPT_VENTA)
+        datos = cache_extraccion.obtener(clave)
+        if datos is not None:
+            datos = await reusar_extraccion("venta", datos, contents, extension or file.filename.split(".")[-1], user_id,
+                                            functools.partial(guardar_imagen, user_id=user_id))
+            datos = validar("venta", await en_db(completar_datos, "venta", datos, user_id))
+            if asincrono:
+                id_trabajo = await trabajo_completado(user_id, "venta", datos, webhook_url)
+                return JSONResponse(content={"mensaje": "Escaneo en cola", "job_id": id_trabajo}, status_code=202)
+            return JSONResponse(content={"mensaje": "Venta Escaneada", "datos": datos})
+
         # AHORA SÍ GUARDAMOS LA IMAGEN EN VENTA TAMBIÉN
-        ruta_imagen = guardar_imagen_disco(file)
-
-        contents = await file.read()
-        image = Image.open(io.BytesIO(contents))
-
-        prompt = """Analiza VENTA. Extrae datos del cliente.
-        Devuelve JSON: {
-            "fecha_emision": "DD/MM/YYYY", 
-            "tipo_comprobante": "Factura/Boleta", 
-            "serie": "...", 
-            "numero": "...", 
-            "cliente_nro_doc": "...", 
-            "cliente_razon_social": "...", 
-            "cliente_direccion": "...",
-            "cliente_telefono": "...",
-            "total_cp": 0.0, 
-            "moneda": "PEN",
-            "items": [
-                {"descripcion": "Producto", "cantidad": 1, "precio_unitario": 0.0, "total": 0.0}
-            ]
-        }"""
-
-        response = client.models.generate_content(
-            model='gemini-flash-latest', contents=[prompt, image],
-            config=types.GenerateContentConfig(response_mime_type='application/json')
-        )
-        datos = json.loads(response.text.strip())
-        datos['ruta_imagen'] = ruta_imagen
+        with medir("disco"):
+            ruta_imagen = await asyncio.to_thread(guardar_imagen, contents, extension or file.filename.split(".")[-1], user_id)
 
+        # Modo trabajo: respondemos al toque y la extracción sigue en la cola
+        if asincrono:
+            id_trabajo = await encolar_trabajo(user_id, "venta", ruta_imagen, webhook_url)
+            return JSONResponse(content={"mensaje": "Escaneo en cola", "job_id": id_trabajo}, status_code=202)
+
+        datos = await extraer_comprobante("venta", contents)
+        datos['ruta_imagen'] = ruta_imagen
+        cache_extraccion.guardar(clave, datos)
+        await en_db(registrar_extraccion, user_id, "venta", datos)
+        datos = validar("venta", await en_db(completar_datos, "venta", datos, user_id))
 
         return JSONResponse(content={"mensaje": "Venta Escaneada", "datos": datos})
+    except Exception as e:
+        return _error_extraccion(e)
+
+@router.post("/escanear-lote/")
+async def escanear_lote(user_id: int = Form(...), tipo: str = Form("compra"), files: List[UploadFile] = File(...),
+                        usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
+    logger.info("Lote", extra={"tipo": tipo, "user_id": user_id, "archivos": len(files)})
+    if tipo not in ("compra", "venta"):
+        return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
+    # Lo que ya sabemos que no entra se rechaza antes de leerlo
+    if sum(f.size or 0 for f in files) > LOTE_MAX_BYTES:
+        return JSONResponse(content={"error": f"El lote supera {LOTE_MAX_BYTES // (1024 * 1024)} MB"}, status_code=413)
+    try:
+        # Leemos todo antes de empezar a responder: los UploadFile se cierran al terminar el handler
+        archivos = []
+        restante = LOTE_MAX_BYTES
+        for f in files:
+            # Abrir un ZIP es CPU y memoria: fuera del event loop
+            expandidos = await asyncio.to_thread(expandir_archivo, f.filename, await f.read(), restante)
+            restante -= sum(len(contents) for _, contents in expandidos)
+            archivos.extend(expandidos)
+        if not archivos:
+            return JSONResponse(content={"error": "No se encontraron imágenes en el lote"}, status_code=400)
+        if len(archivos) > LOTE_MAX_ARCHIVOS:
+            return JSONResponse(content={"error": f"Máximo {LOTE_MAX_ARCHIVOS} comprobantes por lote"}, status_code=400)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=413)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.get("/obtener-registros/{tipo}")
-async def obtener_registros(tipo: str, user_id: int):
+    return StreamingResponse(procesar_lote(tipo, archivos, user_id, functools.partial(guardar_imagen, user_id=user_id)), media_type="application/x-ndjson")
+
+@router.get("/jobs/{id_trabajo}")
+async def estado_trabajo(id_trabajo: str, usuario: int = Depends(usuario_actual)):
+    trabajo = await en_db(obtener_trabajo, id_trabajo, usuario)
+    if not trabajo:
+        return JSONResponse(content={"error": "Trabajo no encontrado"}, status_code=404)
+    return trabajo
+
+@router.get("/cache-extraccion/")
+async def estadisticas_cache_extraccion(usuario: int = Depends(usuario_admin)):
+    return cache_extraccion.estadisticas()
+
+@router.get("/extractores/")
+async def estadisticas_extraccion(dias: float = Query(30, gt=0), usuario: int = Depends(usuario_admin)):
+    """Precisión por extractor (campos que el usuario no tuvo que corregir), sumando a todos
+    los usuarios: solo para AUTH_ADMINS. La latencia está en /metrics."""
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        conn.row_factory = sqlite3.Row 
-        cursor = conn.cursor()
-        
-        registros = []
-        if tipo == "compras":
-            cursor.execute("SELECT * FROM compras_sire WHERE user_id = ? ORDER BY id_gasto DESC", (user_id,))
-            rows = cursor.fetchall()
-            for r in rows:
-                registros.append({
-                    "id": r["id_gasto"],
-                    "titulo": r["proveedor_razon_social"] or "Proveedor Desconocido",
-                    "fecha": r["fecha_emision"],
-                    "monto": r["monto_total"],
-                    "categoria": r["clasificacion_bien_servicio"],
-                    "foto": r["ruta_imagen"]
-                })
-        else: # ventas
-            cursor.execute("SELECT * FROM ventas_sire WHERE user_id = ? ORDER BY id_transaccion DESC", (user_id,))
-            rows = cursor.fetchall()
-            for r in rows:
-                registros.append({
-                    "id": r["id_transaccion"],
-                    "titulo": r["cliente_razon_social"] or "Cliente Varios",
-                    "fecha": r["fecha_emision"],
-                    "monto": r["total_cp"],
-                    "categoria": r["tipo_comprobante"],
-                    "foto": None 
-                })
-        
-        conn.close()
-        return {"datos": registros}
+        return await en_db(estadisticas_extractores, dias)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/guardar-confirmado/")
-async def guardar_confirmado(payload: dict):
+@router.get("/validaciones/")
+async def estado_validaciones(usuario: int = Depends(usuario_actual)):
+    """Cuántos comprobantes del usuario quedaron ok, con advertencias o con errores."""
     try:
-        tipo = payload.get("tipo")
-        datos = payload.get("datos")
-        user_id = payload.get("user_id")
-        items = datos.get("items", [])
-
-        # Recuperamos la ruta de la imagen que pasamos desde el frontend
-        ruta_imagen = datos.get("ruta_imagen", "")
-
-        periodo = calcular_periodo(datos.get("fecha_emision", ""))
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-
-        id_generado = 0
-
-        if tipo == "venta":
-            cursor.execute('''
-                INSERT INTO ventas_sire (
-                    user_id, periodo_tributario, fecha_emision, 
-                    cliente_nro_doc, cliente_razon_social, direccion_cliente, telefono_cliente,
-                    total_cp, serie_comprobante, tipo_comprobante, ruta_imagen
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) -- Agregamos un placeholder más
-            ''', (
-                user_id, periodo, datos['fecha_emision'],
-                datos['cliente_nro_doc'], datos['cliente_razon_social'], datos.get('cliente_direccion'), datos.get('cliente_telefono'),
-                datos['monto_total'], datos['serie'], datos['tipo_comprobante'], ruta_imagen
-            ))
-            id_generado = cursor.lastrowid
-        else:
-            cursor.execute('''
-                INSERT INTO compras_sire (
-                    user_id, periodo_tributario, fecha_emision, 
-                    proveedor_ruc, proveedor_razon_social, direccion_proveedor, telefono_proveedor,
-                    monto_total, serie, tipo_comprobante, ruta_imagen
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) -- Agregamos un placeholder más
-            ''', (
-                user_id, periodo, datos['fecha_emision'],
-                datos['proveedor_ruc'], datos['proveedor_razon_social'], datos.get('proveedor_direccion'), datos.get('proveedor_telefono'),
-                datos['monto_total'], datos['serie'], datos['tipo_comprobante'], ruta_imagen
-            ))
-            id_generado = cursor.lastrowid
-
-        # GUARDAR ITEMS
-        for item in items:
-            cursor.execute('''
-                INSERT INTO detalle_items (tipo_registro, id_padre, descripcion, cantidad, precio_unitario, total)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (tipo, id_generado, item.get('descripcion'), item.get('cantidad', 1), item.get('precio_unitario', 0), item.get('total', 0)))
-
-        conn.commit()
-        conn.close()
+        return await en_db(resumen_validaciones, usuario)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.post("/revalidar/")
+async def revalidar_registros(corregir: bool = False, usuario: int = Depends(usuario_actual)):
+    """Revalida lo ya guardado del usuario; con corregir, devuelve a su periodo lo que quedó mal fechado."""
+    try:
+        # Lee y escribe de a lotes con sus propias conexiones: va en su hilo, no en el pool de la base
+        return await asyncio.to_thread(revalidar, None, usuario, corregir)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+REGISTROS_POR_PAGINA_MAX = 500
+
+# Solo las columnas que usa la lista, en el orden: id, titulo, fecha, monto, categoria, foto
+COLUMNAS_LISTA = {
+    "compras": "id_gasto, proveedor_razon_social, fecha_emision, monto_total, clasificacion_bien_servicio, ruta_imagen",
+    "ventas": "id_transaccion, cliente_razon_social, fecha_emision, total_cp, tipo_comprobante, ruta_imagen"
+}
+TITULO_POR_DEFECTO = {"compras": "Proveedor Desconocido", "ventas": "Cliente Varios"}
+
+def _listar_registros(tipo, user_id, limit=None, after=None, periodo=None, desde=None, hasta=None):
+    """Página de registros, del más nuevo al más antiguo.
+
+    Paginación por keyset: `after` es el último id de la página anterior, así
+    el costo no depende de cuántas páginas haya antes (no hay OFFSET).
+    """
+    tabla, columna_id, _ = TABLAS_REGISTRO[tipo]
+    condiciones = ["user_id = ?"]
+    params = [user_id]
+    if after is not None:
+        condiciones.append(f"{columna_id} < ?")
+        params.append(after)
+    if periodo:
+        condiciones.append("periodo_tributario = ?")
+        params.append(periodo)
+    if desde or hasta:
+        # fecha_emision es DD/MM/YYYY: se acota primero por periodo (indexado) y luego por día exacto
+        desde = desde or date.min
+        hasta = hasta or date.max
+        condiciones.append("periodo_tributario BETWEEN ? AND ?")
+        params += [desde.strftime("%Y%m"), hasta.strftime("%Y%m")]
+        condiciones.append("substr(fecha_emision, 7, 4) || substr(fecha_emision, 4, 2) || substr(fecha_emision, 1, 2) BETWEEN ? AND ?")
+        params += [desde.strftime("%Y%m%d"), hasta.strftime("%Y%m%d")]
+
+    sql = f"SELECT {COLUMNAS_LISTA[tipo]} FROM {tabla} WHERE {' AND '.join(condiciones)} ORDER BY {columna_id} DESC"
+    if limit is not None:
+        # Pedimos uno de más para saber si hay otra página sin hacer un COUNT
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    rows = obtener_conexion().execute(sql, params).fetchall()
+    siguiente = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        siguiente = rows[-1][0]
+
+    registros = [{
+        "id": r[0],
+        "titulo": r[1] or TITULO_POR_DEFECTO[tipo],
+        "fecha": r[2],
+        "monto": r[3],
+        "categoria": r[4],
+        "foto": ruta_derivada(r[5], "thumb")
+    } for r in rows]
+    return registros, siguiente
+
+@router.get("/obtener-registros/{tipo}")
+async def obtener_registros(tipo: str, user_id: int,
+                            limit: Optional[int] = Query(None, ge=1, le=REGISTROS_POR_PAGINA_MAX),
+                            after: Optional[int] = None, periodo: Optional[str] = None,
+                            desde: Optional[date] = None, hasta: Optional[date] = None,
+                            usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
+    if tipo not in TABLAS_REGISTRO:
+        return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
+    try:
+        registros, siguiente = await en_db(_listar_registros, tipo, user_id, limit, after, periodo, desde, hasta)
+        return {"datos": registros, "siguiente": siguiente}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.get("/sync")
+async def sincronizar(since: Optional[str] = None, usuario: int = Depends(usuario_actual)):
+    """Lo que cambió desde el token `since` (sin token: todo). La app guarda el
+    token que viene en la respuesta y lo manda en el próximo refresco."""
+    try:
+        return await en_db(cambios_desde, usuario, since)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.get("/buscar/")
+async def buscar(user_id: int, q: str, tipo: Optional[Literal["compra", "venta"]] = None,
+                 limit: int = Query(20, ge=1, le=BUSQUEDA_POR_PAGINA_MAX), offset: int = Query(0, ge=0),
+                 usuario: int = Depends(usuario_actual)):
+    """Busca por razón social, RUC/DNI o descripción de items (prefijos, sin tildes)."""
+    exigir_dueno(user_id, usuario)
+    try:
+        resultados, siguiente = await en_db(buscar_documentos, user_id, q, tipo, limit, offset)
+        return {"datos": resultados, "siguiente": siguiente}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+SQL_INSERTAR_CABECERA = {
+    "venta": '''
+        INSERT INTO ventas_sire (
+            user_id, periodo_tributario, fecha_emision,
+            cliente_nro_doc, cliente_razon_social, direccion_cliente, telefono_cliente,
+            total_cp, serie_comprobante, nro_comprobante, tipo_comprobante, ruta_imagen,
+            base_imponible_gravada, monto_igv, moneda
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''',
+    "compra": '''
+        INSERT INTO compras_sire (
+            user_id, periodo_tributario, fecha_emision,
+            proveedor_ruc, proveedor_razon_social, direccion_proveedor, telefono_proveedor,
+            monto_total, serie, numero, tipo_comprobante, ruta_imagen,
+            base_imponible_1, igv_1
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+}
+SQL_INSERTAR_ITEM = '''
+    INSERT INTO detalle_items (tipo_registro, id_padre, descripcion, cantidad, precio_unitario, total)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+SQL_ACTUALIZAR_CABECERA = {
+    "venta": '''
+        UPDATE ventas_sire SET
+            periodo_tributario = ?, fecha_emision = ?,
+            cliente_nro_doc = ?, cliente_razon_social = ?, direccion_cliente = ?, telefono_cliente = ?,
+            total_cp = ?, serie_comprobante = ?, nro_comprobante = ?, tipo_comprobante = ?, ruta_imagen = ?,
+            base_imponible_gravada = ?, monto_igv = ?, moneda = ?
+        WHERE id_transaccion = ? AND user_id = ?
+    ''',
+    "compra": '''
+        UPDATE compras_sire SET
+            periodo_tributario = ?, fecha_emision = ?,
+            proveedor_ruc = ?, proveedor_razon_social = ?, direccion_proveedor = ?, telefono_proveedor = ?,
+            monto_total = ?, serie = ?, numero = ?, tipo_comprobante = ?, ruta_imagen = ?,
+            base_imponible_1 = ?, igv_1 = ?
+        WHERE id_gasto = ? AND user_id = ?
+    '''
+}
+# Campo del JSON de escaneo -> columna guardada, para partir de lo que ya está al editar
+CAMPOS_EDICION = {
+    "compra": {
+        "fecha_emision": "fecha_emision", "proveedor_ruc": "proveedor_ruc",
+        "proveedor_razon_social": "proveedor_razon_social", "proveedor_direccion": "direccion_proveedor",
+        "proveedor_telefono": "telefono_proveedor", "monto_total": "monto_total", "serie": "serie",
+        "numero": "numero", "tipo_comprobante": "tipo_comprobante", "ruta_imagen": "ruta_imagen",
+        "base_imponible": "base_imponible_1", "igv": "igv_1",
+    },
+    "venta": {
+        "fecha_emision": "fecha_emision", "cliente_nro_doc": "cliente_nro_doc",
+        "cliente_razon_social": "cliente_razon_social", "cliente_direccion": "direccion_cliente",
+        "cliente_telefono": "telefono_cliente", "total_cp": "total_cp", "serie": "serie_comprobante",
+        "numero": "nro_comprobante", "tipo_comprobante": "tipo_comprobante", "ruta_imagen": "ruta_imagen",
+        "base_imponible": "base_imponible_gravada", "igv": "monto_igv", "moneda": "moneda",
+    },
+}
+
+def _fila_cabecera(tipo, user_id, datos):
+    """Fila a insertar; `datos` ya pasó por validar (fecha, serie/número y montos normalizados)."""
+    # Recuperamos la ruta de la imagen que pasamos desde el frontend
+    ruta_imagen = datos.get("ruta_imagen", "")
+    periodo = calcular_periodo(datos.get("fecha_emision"))
+    # En ventas Gemini devuelve total_cp; la app y el lote mandan monto_total
+    total = datos.get('monto_total') if datos.get('monto_total') is not None else datos.get('total_cp')
+    if tipo == "venta":
+        return (
+            user_id, periodo, datos['fecha_emision'],
+            datos.get('cliente_nro_doc'), datos.get('cliente_razon_social'), datos.get('cliente_direccion'), datos.get('cliente_telefono'),
+            total, datos['serie'], datos.get('numero'), datos.get('tipo_comprobante'), ruta_imagen,
+            datos.get('base_imponible') or 0, datos.get('igv') or 0, datos.get('moneda') or "PEN"
+        )
+    return (
+        user_id, periodo, datos['fecha_emision'],
+        datos.get('proveedor_ruc'), datos.get('proveedor_razon_social'), datos.get('proveedor_direccion'), datos.get('proveedor_telefono'),
+        total, datos['serie'], datos.get('numero'), datos.get('tipo_comprobante'), ruta_imagen,
+        datos.get('base_imponible'), datos.get('igv')
+    )
+
+def _filas_items(tipo, id_padre, items):
+    return [
+        (tipo, id_padre, item.get('descripcion'), item.get('cantidad', 1), item.get('precio_unitario', 0), item.get('total', 0))
+        for item in items
+    ]
+
+def _insertar_confirmado(tipo, user_id, datos):
+    tipo = "venta" if tipo == "venta" else "compra"
+    with transaccion() as conn:
+        cursor = conn.execute(SQL_INSERTAR_CABECERA[tipo], _fila_cabecera(tipo, user_id, datos))
+        id_generado = cursor.lastrowid
+        conn.executemany(SQL_INSERTAR_ITEM, _filas_items(tipo, id_generado, datos.get("items", [])))
+        if datos.get("validacion"):
+            guardar_validacion(conn, tipo, id_generado, user_id, datos["validacion"])
+        comparar_confirmado(conn, user_id, tipo, datos)
+    olvidar_contraparte(tipo, datos, user_id)
+    return id_generado
+
+@router.get("/verificar-duplicado/{tipo}")
+async def verificar_duplicado(tipo: Literal["compra", "venta"], user_id: int, serie: str,
+                              numero: Optional[str] = None, tipo_comprobante: Optional[str] = None,
+                              ruc: Optional[str] = None, usuario: int = Depends(usuario_actual)):
+    """Para llamar apenas vuelve el escaneo: avisa si ese comprobante ya está guardado."""
+    exigir_dueno(user_id, usuario)
+    try:
+        existente = await en_db(buscar_duplicado, user_id, tipo, ruc, tipo_comprobante, serie, numero)
+        return {"duplicado": existente is not None, "registro": existente}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.post("/guardar-confirmado/")
+async def guardar_confirmado(payload: dict, usuario: int = Depends(usuario_actual)):
+    exigir_dueno(payload.get("user_id"), usuario)
+    tipo = "venta" if payload.get("tipo") == "venta" else "compra"
+    datos = validar(tipo, payload.get("datos") or {})
+    if datos["validacion"]["estado"] == "error":
+        return JSONResponse(content={"error": "; ".join(datos["validacion"]["mensajes"]),
+                                     "validacion": datos["validacion"]}, status_code=422)
+    try:
+        await en_db(_insertar_confirmado, tipo, usuario, datos)
         return {"mensaje": "OK"}
+    except sqlite3.IntegrityError as e:
+        if "clave_comprobante" not in str(e):
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+        return JSONResponse(content={"error": "Este comprobante ya fue registrado"}, status_code=409)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+class ItemConfirmado(BaseModel):
+    descripcion: Optional[str] = None
+    cantidad: float = 1
+    precio_unitario: float = 0
+    total: float = 0
+
+class DocumentoConfirmado(BaseModel):
+    tipo: Literal["compra", "venta"]
+    fecha_emision: str
+    tipo_comprobante: str
+    serie: str
+    numero: Optional[str] = None
+    monto_total: Optional[float] = None
+    total_cp: Optional[float] = None
+    base_imponible: Optional[float] = None
+    igv: Optional[float] = None
+    moneda: Optional[str] = None
+    proveedor_ruc: Optional[str] = None
+    proveedor_razon_social: Optional[str] = None
+    proveedor_direccion: Optional[str] = None
+    proveedor_telefono: Optional[str] = None
+    cliente_nro_doc: Optional[str] = None
+    cliente_razon_social: Optional[str] = None
+    cliente_direccion: Optional[str] = None
+    cliente_telefono: Optional[str] = None
+    ruta_imagen: Optional[str] = ""
+    pagina: Optional[int] = None  # comprobante de un PDF de varias páginas (viene en la línea del lote)
+    items: List[ItemConfirmado] = []
+
+    @model_validator(mode="after")
+    def validar_por_tipo(self):
+        # En ventas Gemini devuelve total_cp; aceptamos cualquiera de los dos
+        if self.monto_total is None:
+            self.monto_total = self.total_cp
+        if self.monto_total is None:
+            raise ValueError("Falta monto_total")
+        if self.tipo == "compra" and not (self.proveedor_ruc and self.proveedor_razon_social):
+            raise ValueError("Una compra necesita proveedor_ruc y proveedor_razon_social")
+        if self.tipo == "venta" and not (self.cliente_nro_doc and self.cliente_razon_social):
+            raise ValueError("Una venta necesita cliente_nro_doc y cliente_razon_social")
+        return self
+
+class LoteConfirmado(BaseModel):
+    user_id: Optional[int] = None  # si viene, tiene que ser el del token
+    clave_idempotencia: Optional[str] = None
+    documentos: List[DocumentoConfirmado]
+
+def _insertar_lote(user_id, documentos, clave_idempotencia):
+    """Inserta todos los documentos y sus items en una sola transacción.
+
+    Si la clave de idempotencia ya se usó, devuelve la respuesta guardada y no
+    inserta nada: un reintento del cliente no duplica filas.
+    """
+    with transaccion() as conn:
+        # Lock de escritura desde el inicio: los ids AUTOINCREMENT del executemany salen consecutivos
+        conn.execute("BEGIN IMMEDIATE")
+        if clave_idempotencia:
+            row = conn.execute("SELECT respuesta FROM idempotencia WHERE user_id = ? AND clave = ?",
+                               (user_id, clave_idempotencia)).fetchone()
+            if row:
+                return json.loads(row[0])
+
+        ids = [None] * len(documentos)
+        items = []
+        for tipo in ("compra", "venta"):
+            posiciones = [i for i, d in enumerate(documentos) if d["tipo"] == tipo]
+            if not posiciones:
+                continue
+            conn.executemany(SQL_INSERTAR_CABECERA[tipo], [_fila_cabecera(tipo, user_id, documentos[i]) for i in posiciones])
+            primero = conn.execute("SELECT last_insert_rowid()").fetchone()[0] - len(posiciones) + 1
+            for desplazamiento, i in enumerate(posiciones):
+                ids[i] = primero + desplazamiento
+                items += _filas_items(tipo, ids[i], documentos[i]["items"])
+        conn.executemany(SQL_INSERTAR_ITEM, items)
+        for id_registro, documento in zip(ids, documentos):
+            guardar_validacion(conn, documento["tipo"], id_registro, user_id, documento["validacion"])
+            comparar_confirmado(conn, user_id, documento["tipo"], documento)
+
+        respuesta = {"mensaje": "OK", "ids": ids}
+        if clave_idempotencia:
+            conn.execute("INSERT INTO idempotencia (user_id, clave, respuesta, creado) VALUES (?, ?, ?, ?)",
+                         (user_id, clave_idempotencia, json.dumps(respuesta), time.time()))
+    for documento in documentos:
+        olvidar_contraparte(documento["tipo"], documento, user_id)
+    return respuesta
+
+@router.post("/guardar-confirmado-lote/")
+async def guardar_confirmado_lote(lote: LoteConfirmado, idempotency_key: Optional[str] = Header(None),
+                                  usuario: int = Depends(usuario_actual)):
+    exigir_dueno(lote.user_id, usuario)
+    try:
+        documentos = [d.model_dump() for d in lote.documentos]
+        errores = []
+        for tipo in ("compra", "venta"):
+            posiciones = [i for i, d in enumerate(documentos) if d["tipo"] == tipo]
+            for i, validacion in zip(posiciones, validar_lote(tipo, [documentos[i] for i in posiciones])):
+                documentos[i]["validacion"] = validacion
+                if validacion["estado"] == "error":
+                    errores.append({"indice": i, "mensajes": validacion["mensajes"]})
+        if errores:
+            return JSONResponse(content={"error": "Hay comprobantes con errores", "documentos": errores}, status_code=422)
+        clave = lote.clave_idempotencia or idempotency_key
+        return await en_db(_insertar_lote, usuario, documentos, clave)
+    except sqlite3.IntegrityError as e:
+        if "clave_comprobante" not in str(e):
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+        return JSONResponse(content={"error": "El lote trae un comprobante ya registrado o repetido"}, status_code=409)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 class PerfilUpdate(BaseModel):
-    user_id: int
+    user_id: Optional[int] = None
     nombre_completo: str
     nickname: str
 
 
-@app.post("/editar-perfil/")
-async def editar_perfil(datos: PerfilUpdate):
-    try:
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-        cursor.execute('''
+def _actualizar_perfil(user_id, nombre_completo, nickname):
+    with transaccion() as conn:
+        cursor = conn.execute('''
             UPDATE usuarios
             SET nombre_completo = ?, nickname = ?
             WHERE id_usuario = ?
-        ''', (datos.nombre_completo, datos.nickname, datos.user_id))
+        ''', (nombre_completo, nickname, user_id))
+        return cursor.rowcount
 
-        if cursor.rowcount == 0:
-            conn.close()
+@router.post("/editar-perfil/")
+async def editar_perfil(datos: PerfilUpdate, usuario: int = Depends(usuario_actual)):
+    exigir_dueno(datos.user_id, usuario)
+    try:
+        actualizados = await en_db(_actualizar_perfil, usuario, datos.nombre_completo, datos.nickname)
+
+        if actualizados == 0:
             return JSONResponse(content={"error": "Usuario no encontrado"}, status_code=404)
 
-        conn.commit()
-        conn.close()
         return {"status": "ok", "mensaje": "Perfil actualizado correctamente"}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.get("/usuario/{user_id}")
-async def obtener_usuario(user_id: int):
+def _buscar_usuario(user_id):
+    return obtener_conexion().execute(
+        "SELECT nombre_completo, nickname, email, plan, foto_perfil, ruc_empresa, razon_social, direccion_fiscal, logo_empresa FROM usuarios WHERE id_usuario = ?",
+        (user_id,)
+    ).fetchone()
+
+@router.get("/usuario/{user_id}")
+async def obtener_usuario(user_id: int, usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT nombre_completo, nickname, email, plan, foto_perfil, ruc_empresa, razon_social, direccion_fiscal, logo_empresa FROM usuarios WHERE id_usuario = ?", (user_id,))
-        user = cursor.fetchone()
-        conn.close()
+        user = await en_db(_buscar_usuario, user_id)
 
         if user:
             return {
@@ -479,143 +748,289 @@ async def obtener_usuario(user_id: int):
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/subir-avatar/")
-async def subir_avatar(user_id: int = Form(...), file: UploadFile = File(...)):
+def _actualizar_columna_usuario(columna, valor, user_id):
+    # `columna` viene del propio código (foto_perfil / logo_empresa), nunca del cliente
+    with transaccion() as conn:
+        conn.execute(f"UPDATE usuarios SET {columna} = ? WHERE id_usuario = ?", (valor, user_id))
+
+@router.post("/subir-avatar/")
+async def subir_avatar(user_id: int = Form(...), file: UploadFile = File(...), usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
     try:
         timestamp = int(time.time())
-        filename = f"avatar_{user_id}_{timestamp}.jpg"
-        file_location = f"static/avatars/{filename}"
+        relative_path = f"avatars/{user_id}/avatar_{timestamp}.jpg"
+        await guardar_upload(file, f"static/{relative_path}")
+        await en_db(_actualizar_columna_usuario, "foto_perfil", relative_path, user_id)
 
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
-
-        relative_path = f"avatars/{filename}"
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE usuarios SET foto_perfil = ? WHERE id_usuario = ?", (relative_path, user_id))
-        conn.commit()
-        conn.close()
-
-        print(f"Avatar actualizado para usuario {user_id}: {relative_path}")
+        logger.info("Avatar actualizado", extra={"user_id": user_id, "ruta": relative_path})
         return {"status": "ok", "avatar_path": relative_path}
 
     except Exception as e:
-        print(f"Error subiendo avatar: {e}")
+        logger.exception("Error subiendo avatar", extra={"user_id": user_id})
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 class EmpresaUpdate(BaseModel):
-    user_id: int
+    user_id: Optional[int] = None
     ruc: str
     razon_social: str
     direccion: str
 
-@app.post("/editar-empresa/")
-async def editar_empresa(datos: EmpresaUpdate):
-    try:
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-        cursor.execute('''
+def _actualizar_empresa(user_id, ruc, razon_social, direccion):
+    with transaccion() as conn:
+        conn.execute('''
             UPDATE usuarios
             SET ruc_empresa = ?, razon_social = ?, direccion_fiscal = ?
             WHERE id_usuario = ?
-        ''', (datos.ruc, datos.razon_social, datos.direccion, datos.user_id))
-        conn.commit()
-        conn.close()
+        ''', (ruc, razon_social, direccion, user_id))
+
+@router.post("/editar-empresa/")
+async def editar_empresa(datos: EmpresaUpdate, usuario: int = Depends(usuario_actual)):
+    exigir_dueno(datos.user_id, usuario)
+    try:
+        await en_db(_actualizar_empresa, usuario, datos.ruc, datos.razon_social, datos.direccion)
         return {"status": "ok"}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.post("/subir-logo-empresa/")
-async def subir_logo_empresa(user_id: int = Form(...), file: UploadFile = File(...)):
+@router.post("/subir-logo-empresa/")
+async def subir_logo_empresa(user_id: int = Form(...), file: UploadFile = File(...), usuario: int = Depends(usuario_actual)):
+    exigir_dueno(user_id, usuario)
     try:
         timestamp = int(time.time())
-        filename = f"logo_{user_id}_{timestamp}.png"
-        file_location = f"static/avatars/{filename}" # Usamos la misma carpeta static
-
-        with open(file_location, "wb+") as file_object:
-            shutil.copyfileobj(file.file, file_object)
-
-        relative_path = f"avatars/{filename}"
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-        cursor.execute("UPDATE usuarios SET logo_empresa = ? WHERE id_usuario = ?", (relative_path, user_id))
-        conn.commit()
-        conn.close()
+        relative_path = f"avatars/{user_id}/logo_{timestamp}.png" # Misma carpeta que el avatar
+        await guardar_upload(file, f"static/{relative_path}")
+        await en_db(_actualizar_columna_usuario, "logo_empresa", relative_path, user_id)
         return {"status": "ok", "logo_path": relative_path}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
 
-@app.get("/obtener-detalle/{tipo}/{id_registro}")
-async def obtener_detalle(tipo: str, id_registro: int):
+def _buscar_detalle(tipo, id_registro, user_id):
+    tabla, columna_id, tipo_singular = TABLAS_REGISTRO[tipo]
+    conn = obtener_conexion()
+    # Búsqueda por PK: el user_id solo descarta el registro si es de otro
+    row = conn.execute(f"SELECT * FROM {tabla} WHERE {columna_id} = ? AND user_id = ?", (id_registro, user_id)).fetchone()
+    if not row:
+        return None
+
+    datos = dict(row)
+    items_rows = conn.execute("SELECT * FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", (tipo_singular, id_registro)).fetchall()
+    datos['items'] = [dict(i) for i in items_rows]
+    datos['validacion'] = obtener_validacion(tipo_singular, id_registro)
+    if datos.get('ruta_imagen'):
+        datos['ruta_miniatura'] = ruta_derivada(datos['ruta_imagen'], "thumb")
+        datos['ruta_preview'] = ruta_derivada(datos['ruta_imagen'], "preview")
+    return datos
+
+@router.get("/obtener-detalle/{tipo}/{id_registro}")
+async def obtener_detalle(tipo: str, id_registro: int, usuario: int = Depends(usuario_actual)):
+    if tipo not in TABLAS_REGISTRO:
+        return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-
-        datos = {}
-        items = []
-
-        if tipo == "compras":
-            cursor.execute("SELECT * FROM compras_sire WHERE id_gasto = ?", (id_registro,))
-            row = cursor.fetchone()
-            if row:
-                datos = dict(row)
-        elif tipo == "ventas":
-            cursor.execute("SELECT * FROM ventas_sire WHERE id_transaccion = ?", (id_registro,))
-            row = cursor.fetchone()
-            if row:
-                datos = dict(row)
-
-        tipo_singular = "venta" if tipo == "ventas" else "compra"
-        cursor.execute("SELECT * FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", (tipo_singular, id_registro))
-
-        items_rows = cursor.fetchall()
-        for i in items_rows:
-            items.append(dict(i))
-
-        datos['items'] = items
-
-        conn.close()
+        datos = await en_db(_buscar_detalle, tipo, id_registro, usuario)
+        if datos is None:
+            return JSONResponse(content={"error": "Registro no encontrado"}, status_code=404)
         return datos
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
-@app.delete("/eliminar-registro/{tipo}/{id_registro}")
-async def eliminar_registro(tipo: str, id_registro: int):
+def _actualizar_registro(tipo, id_registro, user_id, cambios):
+    """Edita un comprobante guardado: lo que no viene en `cambios` queda como
+    estaba, y los items solo se reemplazan si vienen. Devuelve los datos
+    validados (sin escribir nada si la validación dio error) o None si el
+    registro no es del usuario."""
+    tabla, columna_id, tipo_singular = TABLAS_REGISTRO[tipo]
+    with transaccion() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(f"SELECT * FROM {tabla} WHERE {columna_id} = ? AND user_id = ?", (id_registro, user_id)).fetchone()
+        if not row:
+            return None
+        datos = {campo: row[columna] for campo, columna in CAMPOS_EDICION[tipo_singular].items()}
+        if not datos["base_imponible"] and not datos["igv"]:
+            # Ventas guardan 0 cuando el comprobante no traía base ni IGV
+            datos["base_imponible"] = datos["igv"] = None
+        datos["items"] = [dict(i) for i in conn.execute(
+            "SELECT descripcion, cantidad, precio_unitario, total FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?",
+            (tipo_singular, id_registro))]
+        ruta_imagen = datos["ruta_imagen"]
+        datos.update({campo: valor for campo, valor in cambios.items() if valor is not None})
+        datos["ruta_imagen"] = datos["ruta_imagen"] or ruta_imagen  # la app manda "" si no tenía la ruta
+        if cambios.get("monto_total") is not None:
+            datos["total_cp"] = None  # en ventas el total editado llega como monto_total
+        validar(tipo_singular, datos)
+        if datos["validacion"]["estado"] == "error":
+            return datos
+        # La clave de duplicado es una columna generada: al actualizar la misma fila no choca consigo misma
+        conn.execute(SQL_ACTUALIZAR_CABECERA[tipo_singular], (*_fila_cabecera(tipo_singular, user_id, datos)[1:], id_registro, user_id))
+        if cambios.get("items") is not None:
+            conn.execute("DELETE FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", (tipo_singular, id_registro))
+            conn.executemany(SQL_INSERTAR_ITEM, _filas_items(tipo_singular, id_registro, cambios["items"]))
+        guardar_validacion(conn, tipo_singular, id_registro, user_id, datos["validacion"])
+    olvidar_contraparte(tipo_singular, datos, user_id)
+    return datos
+
+@router.put("/actualizar-registro/{tipo}/{id_registro}")
+async def actualizar_registro(tipo: str, id_registro: int, payload: dict, usuario: int = Depends(usuario_actual)):
+    exigir_dueno(payload.get("user_id"), usuario)
+    if tipo not in TABLAS_REGISTRO:
+        return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
     try:
-        conn = sqlite3.connect("contabilidad.db")
-        cursor = conn.cursor()
-
-        tabla = ""
-        columna_id = ""
-        tipo_singular = ""
-
-        if tipo == "compras":
-            tabla = "compras_sire"
-            columna_id = "id_gasto"
-            tipo_singular = "compra"
-        elif tipo == "ventas":
-            tabla = "ventas_sire"
-            columna_id = "id_transaccion"
-            tipo_singular = "venta"
-        else:
-            return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
-
-        cursor.execute("DELETE FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", (tipo_singular, id_registro))
-
-        cursor.execute(f"DELETE FROM {tabla} WHERE {columna_id} = ?", (id_registro,))
+        datos = await en_db(_actualizar_registro, tipo, id_registro, usuario, payload.get("datos") or {})
+        if datos is None:
+            return JSONResponse(content={"error": "Registro no encontrado"}, status_code=404)
+        if datos["validacion"]["estado"] == "error":
+            return JSONResponse(content={"error": "; ".join(datos["validacion"]["mensajes"]),
+                                         "validacion": datos["validacion"]}, status_code=422)
+        return {"mensaje": "OK", "validacion": datos["validacion"]}
+    except sqlite3.IntegrityError as e:
+        if "clave_comprobante" not in str(e):
+            return JSONResponse(content={"error": str(e)}, status_code=500)
+        return JSONResponse(content={"error": "Ya hay otro comprobante registrado con esa serie y número"}, status_code=409)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
 
+def _borrar_registro(tipo, id_registro, user_id):
+    tabla, columna_id, tipo_singular = TABLAS_REGISTRO[tipo]
+    with transaccion() as conn:
+        cursor = conn.execute(f"DELETE FROM {tabla} WHERE {columna_id} = ? AND user_id = ?", (id_registro, user_id))
         if cursor.rowcount == 0:
-            conn.close()
+            return 0
+        conn.execute("DELETE FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", (tipo_singular, id_registro))
+        return cursor.rowcount
+
+@router.delete("/eliminar-registro/{tipo}/{id_registro}")
+async def eliminar_registro(tipo: str, id_registro: int, usuario: int = Depends(usuario_actual)):
+    if tipo not in TABLAS_REGISTRO:
+        return JSONResponse(content={"error": "Tipo inválido"}, status_code=400)
+    try:
+        if await en_db(_borrar_registro, tipo, id_registro, usuario) == 0:
             return JSONResponse(content={"error": "Registro no encontrado"}, status_code=404)
-
-        conn.commit()
-        conn.close()
         return {"status": "ok", "mensaje": "Registro eliminado"}
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
+@router.get("/resumen/{periodo}")
+async def resumen_periodo(periodo: str, user_id: int, usuario: int = Depends(usuario_actual)):
+    """Totales de compras, ventas e IGV del periodo (AAAAMM) para el dashboard."""
+    exigir_dueno(user_id, usuario)
+    if len(periodo) != 6 or not periodo.isdigit():
+        return JSONResponse(content={"error": "El periodo debe ser AAAAMM"}, status_code=400)
+    try:
+        return await en_db(obtener_resumen, user_id, periodo)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.get("/almacenamiento/{user_id}")
+async def uso_almacenamiento(user_id: int, usuario: int = Depends(usuario_actual)):
+    """Espacio que ocupa el usuario según la última pasada de la limpieza."""
+    exigir_dueno(user_id, usuario)
+    try:
+        uso = await en_db(obtener_uso, user_id)
+        return uso or {"archivos": 0, "bytes_comprobantes": 0, "bytes_perfil": 0, "actualizado": None}
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+@router.get("/exportar-sire/{tipo}/{periodo}")
+async def exportar_sire(tipo: str, periodo: str, user_id: int, formato: str = "txt",
+                        usuario: int = Depends(usuario_actual)):
+    """Registro de Compras/Ventas del periodo (AAAAMM, o AAAA para todo el año).
+
+    TXT y CSV se generan por bloques mientras se envían, así la memoria no
+    depende de cuántos comprobantes tenga el periodo.
+    """
+    exigir_dueno(user_id, usuario)
+    if tipo not in TABLAS_REGISTRO or formato not in ("txt", "csv", "xlsx"):
+        return JSONResponse(content={"error": "Tipo o formato inválido"}, status_code=400)
+    try:
+        sire.rango_periodo(periodo)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    empresa = await en_db(_buscar_usuario, user_id)
+    if not empresa:
+        return JSONResponse(content={"error": "Usuario no encontrado"}, status_code=404)
+    ruc = empresa['ruc_empresa'] or ""
+    razon_social = empresa['razon_social'] or empresa['nombre_completo'] or ""
+    nombre = sire.nombre_archivo(tipo, ruc, periodo, formato)
+    headers = {"Content-Disposition": f'attachment; filename="{nombre}"'}
+
+    if formato == "txt":
+        return StreamingResponse(sire.generar_txt(tipo, user_id, periodo, ruc, razon_social),
+                                 media_type="text/plain; charset=utf-8", headers=headers)
+    if formato == "csv":
+        return StreamingResponse(sire.generar_csv(tipo, user_id, periodo, ruc, razon_social),
+                                 media_type="text/csv; charset=utf-8", headers=headers)
+
+    if sire.openpyxl is None:
+        return JSONResponse(content={"error": "Exportar a XLSX requiere instalar openpyxl"}, status_code=501)
+    try:
+        ruta = await sire.generar_xlsx(tipo, user_id, periodo, ruc, razon_social)
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    return FileResponse(ruta, filename=nombre, background=BackgroundTask(os.remove, ruta),
+                        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+
+# check_dir=False: las carpetas las crea el lifespan, no la importación
+archivos_uploads = ArchivosEstaticos(directory=DIR_UPLOADS, check_dir=False)
+archivos_static = ArchivosEstaticos(directory=DIR_STATIC, cache_control=CACHE_CONTROL_STATIC, check_dir=False)
+
+async def _servir_archivo(archivos: ArchivosEstaticos, ruta: str, request: Request):
+    # StaticFiles sigue resolviendo ETag/304, Range y Cache-Control; acá solo se pasa por el token
+    try:
+        return await archivos.get_response(ruta, request.scope)
+    except StarletteHTTPException as e:
+        return JSONResponse(content={"error": e.detail}, status_code=e.status_code)
+
+@router.get("/uploads/{ruta:path}")
+async def archivo_comprobante(ruta: str, request: Request, usuario: int = Depends(usuario_actual)):
+    """Imagen de un comprobante o sus derivadas: solo la ve el dueño de la carpeta uploads/{usuario}/."""
+    if not es_de_usuario(f"{DIR_UPLOADS}/{ruta}", usuario):
+        return JSONResponse(content={"error": "No autorizado para este archivo"}, status_code=403)
+    return await _servir_archivo(archivos_uploads, ruta, request)
+
+@router.get("/static/{ruta:path}")
+async def archivo_perfil(ruta: str, request: Request, usuario: int = Depends(usuario_actual)):
+    """Avatar y logo: static/avatars/{usuario}/, solo para su dueño."""
+    if not es_de_usuario(ruta, usuario, base="avatars"):
+        return JSONResponse(content={"error": "No autorizado para este archivo"}, status_code=403)
+    return await _servir_archivo(archivos_static, ruta, request)
+
+# Respuestas que salen línea por línea: comprimidas, las líneas esperarían en el buffer de gzip
+RUTAS_SIN_GZIP = ("/escanear-lote/",)
+
+class GZipSalvoStreaming(GZipMiddleware):
+    """GZipMiddleware que deja pasar sin comprimir las rutas de RUTAS_SIN_GZIP.
+    starlette 0.50 (la de requirements.txt) no acepta exclude_content_types: se
+    decide por la ruta, antes de que el responder mire la respuesta."""
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in RUTAS_SIN_GZIP:
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+async def error_http(request: Request, exc: HTTPException):
+    # Mismo formato que el resto de errores de la API: {"error": ...}
+    return JSONResponse(content={"error": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+
+def crear_app() -> FastAPI:
+    """Factory de la app. Importar este módulo no toca la base ni el disco: el
+    esquema se prepara en el lifespan, así varios workers pueden arrancar juntos."""
+    configurar_logs()
+    app = FastAPI(lifespan=lifespan)
+    app.middleware("http")(observar_request)
+    app.add_exception_handler(HTTPException, error_http)
+    # Respuestas JSON comprimidas si el cliente acepta gzip (la app por 3G); el NDJSON
+    # del lote queda fuera para que cada línea llegue apenas se procesa su comprobante
+    app.add_middleware(GZipSalvoStreaming, minimum_size=GZIP_MINIMO_BYTES, compresslevel=GZIP_NIVEL)
+    app.include_router(router)
+    return app
+
+app = crear_app()
+
 if __name__ == "__main__":
-    print("Servidor Qonta Multi-usuario Listo...")
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    configurar_logs()
+    if SERVIDOR_WORKERS > 1:
+        preparar_metricas_multiproceso()
+    logger.info("Servidor Qonta Multi-usuario Listo...", extra={"workers": SERVIDOR_WORKERS})
+    uvicorn.run("main:crear_app", factory=True, host=SERVIDOR_HOST, port=SERVIDOR_PUERTO, workers=SERVIDOR_WORKERS)
\ No newline at end of file
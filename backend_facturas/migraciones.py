@@ -0,0 +1,318 @@
+import argparse
+import sqlite3
+import time
+from db import obtener_conexion, bloqueo_exclusivo, DB_PATH
+from resumenes import SQL_TABLA_RESUMEN, sql_triggers_resumen, sql_reconstruir
+from busqueda import SQL_TABLA_BUSQUEDA, sql_triggers_busqueda, sql_poblar_busqueda
+from duplicados import sql_migracion_duplicados, reportar_duplicados
+from maestro import sql_migracion_maestro, sql_migracion_contrapartes, sql_migracion_contrapartes_edicion
+from limpieza import SQL_TABLA_USO, SQL_INDICES_RUTA_IMAGEN, SQL_INDICE_IDEMPOTENCIA
+from cola_trabajos import SQL_TABLA_TRABAJOS, SQL_INDICE_TRABAJOS
+from extractores import SQL_TABLA_EXTRACCIONES, SQL_INDICE_EXTRACCIONES
+from validacion import sql_migracion_validaciones
+from sincronizacion import sql_migracion_cambios
+from observabilidad import logger, configurar_logs
+
+
+
+def agregar_columna(tabla: str, columna: str, tipo: str):
+    """Paso de migración para columnas que algunas bases ya pueden tener (agregadas
+    a mano o por el arranque viejo que probaba columnas): solo hace el ALTER si falta."""
+    def paso(conn):
+        if columna not in {row[1] for row in conn.execute(f"PRAGMA table_info({tabla})")}:
+            conn.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo}")
+    paso.__name__ = f"agregar_columna({tabla}.{columna})"
+    return paso
+
+
+# Esquema que antes creaba main.py al arrancar (iniciar_base_datos y los verificar_*).
+# Es la migración 0: en una base nueva la crea entera y en una anterior a
+# schema_version completa lo que le falte.
+ESQUEMA_BASE = [
+    '''CREATE TABLE IF NOT EXISTS usuarios (
+        id_usuario INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        nombre_completo TEXT,
+        plan TEXT DEFAULT 'Basic',
+        fecha_registro TEXT DEFAULT CURRENT_TIMESTAMP
+    )''',
+    '''CREATE TABLE IF NOT EXISTS compras_sire (
+        id_gasto INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        periodo_tributario TEXT,
+        fecha_emision TEXT,
+        proveedor_ruc TEXT,
+        proveedor_razon_social TEXT,
+        tipo_comprobante TEXT,
+        serie TEXT,
+        numero TEXT,
+        cod_destino_credito TEXT,
+        base_imponible_1 REAL,
+        igv_1 REAL,
+        monto_total REAL,
+        clasificacion_bien_servicio TEXT,
+        ruta_imagen TEXT,
+        FOREIGN KEY(user_id) REFERENCES usuarios(id_usuario)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS ventas_sire (
+        id_transaccion INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        periodo_tributario TEXT,
+        fecha_emision TEXT,
+        tipo_comprobante TEXT,
+        serie_comprobante TEXT,
+        nro_comprobante TEXT,
+        cliente_tipo_doc TEXT,
+        cliente_nro_doc TEXT,
+        cliente_razon_social TEXT,
+        valor_exportacion REAL DEFAULT 0,
+        base_imponible_gravada REAL DEFAULT 0,
+        dscto_base_imponible REAL DEFAULT 0,
+        monto_igv REAL DEFAULT 0,
+        dscto_igv REAL DEFAULT 0,
+        importe_exonerado REAL DEFAULT 0,
+        importe_inafecto REAL DEFAULT 0,
+        isc REAL DEFAULT 0,
+        base_ivap REAL DEFAULT 0,
+        ivap REAL DEFAULT 0,
+        icbper REAL DEFAULT 0,
+        otros_tributos REAL DEFAULT 0,
+        total_cp REAL DEFAULT 0,
+        moneda TEXT DEFAULT 'PEN',
+        tipo_cambio REAL DEFAULT 1.0,
+        estado_sire INTEGER DEFAULT 2,
+        FOREIGN KEY(user_id) REFERENCES usuarios(id_usuario)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS detalle_items (
+        id_item INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo_registro TEXT, -- 'compra' o 'venta'
+        id_padre INTEGER,   -- ID de la compra o venta
+        descripcion TEXT,
+        cantidad REAL,
+        precio_unitario REAL,
+        total REAL
+    )''',
+    agregar_columna("usuarios", "nickname", "TEXT"),
+    agregar_columna("usuarios", "foto_perfil", "TEXT DEFAULT 'default_avatar.png'"),
+    agregar_columna("usuarios", "ruc_empresa", "TEXT"),
+    agregar_columna("usuarios", "razon_social", "TEXT"),
+    agregar_columna("usuarios", "direccion_fiscal", "TEXT"),
+    agregar_columna("usuarios", "logo_empresa", "TEXT DEFAULT 'default_logo.png'"),
+    agregar_columna("compras_sire", "direccion_proveedor", "TEXT"),
+    agregar_columna("compras_sire", "telefono_proveedor", "TEXT"),
+    agregar_columna("ventas_sire", "direccion_cliente", "TEXT"),
+    agregar_columna("ventas_sire", "telefono_cliente", "TEXT"),
+    # Usuario de demo de una base recién creada
+    '''INSERT INTO usuarios (email, password, nombre_completo, plan)
+       SELECT 'oscar@qonta.com', '123456', 'Oscar', 'Basic' WHERE NOT EXISTS (SELECT 1 FROM usuarios)''',
+]
+
+# Migraciones versionadas: se aplican una sola vez, en orden y cada una en su transacción.
+# Nunca editar una ya publicada; agregar una nueva al final con el número siguiente.
+# Cada paso es SQL o una función que recibe la conexión.
+MIGRACIONES = [
+    (0, "esquema_base", ESQUEMA_BASE),
+    (1, "indices_consultas_por_usuario", [
+        "CREATE INDEX IF NOT EXISTS idx_compras_user_id ON compras_sire (user_id, id_gasto DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_compras_user_periodo ON compras_sire (user_id, periodo_tributario)",
+        "CREATE INDEX IF NOT EXISTS idx_ventas_user_id ON ventas_sire (user_id, id_transaccion DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_ventas_user_periodo ON ventas_sire (user_id, periodo_tributario)",
+        "CREATE INDEX IF NOT EXISTS idx_items_padre ON detalle_items (tipo_registro, id_padre)",
+    ]),
+    (2, "claves_idempotencia", [
+        '''CREATE TABLE IF NOT EXISTS idempotencia (
+            user_id INTEGER,
+            clave TEXT,
+            respuesta TEXT,
+            creado REAL,
+            PRIMARY KEY (user_id, clave)
+        )''',
+    ]),
+    # Totales por periodo mantenidos por triggers; se llena con los datos existentes
+    (3, "resumen_por_periodo", [SQL_TABLA_RESUMEN] + sql_triggers_resumen() + sql_reconstruir()),
+    # Búsqueda de texto completo (FTS5) sincronizada por triggers
+    (4, "busqueda_fts", [SQL_TABLA_BUSQUEDA] + sql_triggers_busqueda() + sql_poblar_busqueda()),
+    # Clave normalizada RUC|tipo|serie|número con índice único por usuario
+    (5, "comprobantes_unicos", sql_migracion_duplicados()),
+    # Maestro de proveedores/clientes por RUC/DNI, alimentado por los comprobantes confirmados
+    (6, "maestro_contribuyentes", sql_migracion_maestro()),
+    # Uso de disco por usuario, lo recalcula la limpieza de archivos
+    (7, "uso_almacenamiento", [SQL_TABLA_USO]),
+    # guardar-confirmado siempre insertó ruta_imagen en ventas, pero nadie creaba la columna;
+    # la cola de escaneos creaba su tabla al arrancar
+    (8, "ventas_ruta_imagen_y_cola", [
+        agregar_columna("ventas_sire", "ruta_imagen", "TEXT"),
+        SQL_TABLA_TRABAJOS,
+        SQL_INDICE_TRABAJOS,
+    ]),
+    # Qué extractor leyó cada escaneo, para medir su precisión contra lo confirmado
+    (9, "extracciones", [SQL_TABLA_EXTRACCIONES, SQL_INDICE_EXTRACCIONES]),
+    # Resultado de validar cada comprobante guardado (python validacion.py lo recalcula)
+    (10, "validaciones", sql_migracion_validaciones()),
+    # Log de cambios con lápidas para el sync incremental de la app
+    (11, "cambios_sync", sql_migracion_cambios()),
+    # El maestro armado con lo confirmado pasa a ser por usuario; el compartido queda solo con el padrón
+    (12, "contrapartes_por_usuario", sql_migracion_contrapartes()),
+    # La limpieza de archivos chequea por índice si alguna fila usa cada imagen candidata
+    (13, "indices_ruta_imagen", SQL_INDICES_RUTA_IMAGEN),
+    # Las claves de idempotencia vencidas se purgan en la limpieza periódica
+    (14, "idempotencia_creado", [SQL_INDICE_IDEMPOTENCIA]),
+    # Editar la contraparte de un comprobante guardado también llega al maestro del usuario
+    (15, "contrapartes_al_editar", sql_migracion_contrapartes_edicion()),
+]
+ULTIMA_VERSION = MIGRACIONES[-1][0]
+
+# Consultas calientes y el índice que cada una debe usar (ver verificar_planes)
+CONSULTAS_INDEXADAS = [
+    ("SELECT * FROM compras_sire WHERE user_id = ? ORDER BY id_gasto DESC", (1,), "idx_compras_user_id"),
+    ("SELECT * FROM ventas_sire WHERE user_id = ? ORDER BY id_transaccion DESC", (1,), "idx_ventas_user_id"),
+    ("SELECT id_gasto FROM compras_sire WHERE user_id = ? AND id_gasto < ? ORDER BY id_gasto DESC LIMIT ?", (1, 100, 51), "idx_compras_user_id"),
+    ("SELECT id_transaccion FROM ventas_sire WHERE user_id = ? AND id_transaccion < ? ORDER BY id_transaccion DESC LIMIT ?", (1, 100, 51), "idx_ventas_user_id"),
+    ("SELECT * FROM compras_sire WHERE user_id = ? AND periodo_tributario = ?", (1, "202501"), "idx_compras_user_periodo"),
+    ("SELECT * FROM ventas_sire WHERE user_id = ? AND periodo_tributario = ?", (1, "202501"), "idx_ventas_user_periodo"),
+    ("SELECT * FROM compras_sire WHERE user_id = ? AND periodo_tributario BETWEEN ? AND ? ORDER BY periodo_tributario, id_gasto",
+     (1, "202501", "202512"), "idx_compras_user_periodo"),
+    ("SELECT * FROM ventas_sire WHERE user_id = ? AND periodo_tributario BETWEEN ? AND ? ORDER BY periodo_tributario, id_transaccion",
+     (1, "202501", "202512"), "idx_ventas_user_periodo"),
+    ("SELECT * FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", ("compra", 1), "idx_items_padre"),
+    ("SELECT * FROM resumen_periodo WHERE user_id = ? AND periodo_tributario = ?", (1, "202501"), "PRIMARY KEY"),
+    ("SELECT id_gasto FROM compras_sire WHERE user_id = ? AND clave_comprobante = ? AND duplicado_de IS NULL",
+     (1, "20100070970|01|F001|1"), "idx_compras_sire_clave_unica"),
+    ("SELECT id_transaccion FROM ventas_sire WHERE user_id = ? AND clave_comprobante = ? AND duplicado_de IS NULL",
+     (1, "|01|F001|1"), "idx_ventas_sire_clave_unica"),
+    ("DELETE FROM detalle_items WHERE tipo_registro = ? AND id_padre = ?", ("compra", 1), "idx_items_padre"),
+    ("SELECT razon_social, direccion, telefono FROM contrapartes WHERE user_id = ? AND nro_doc = ?",
+     (1, "20100070970"), "PRIMARY KEY"),
+    ("SELECT seq, tipo, id_registro, borrado FROM cambios WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+     (1, 0, 500), "idx_cambios_usuario"),
+    ("SELECT 1 FROM compras_sire WHERE ruta_imagen > ?1 || '.' AND ruta_imagen < ?1 || '/'",
+     ("uploads/1/abc",), "idx_compras_sire_ruta_imagen"),
+    ("SELECT 1 FROM trabajos_escaneo WHERE ruta_imagen > ?1 || '.' AND ruta_imagen < ?1 || '/'",
+     ("uploads/1/abc",), "idx_trabajos_escaneo_ruta_imagen"),
+    ("DELETE FROM idempotencia WHERE creado < ?", (0,), "idx_idempotencia_creado"),
+]
+
+
+def _crear_tabla_versiones(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            nombre TEXT,
+            aplicada_en REAL
+        )
+    ''')
+
+
+def version_actual(conn) -> int:
+    """Última migración aplicada; -1 en una base nueva o anterior a schema_version."""
+    try:
+        return conn.execute("SELECT COALESCE(MAX(version), -1) FROM schema_version").fetchone()[0]
+    except sqlite3.OperationalError:
+        return -1
+
+
+def _aplicar(conn, hasta: int) -> list:
+    _crear_tabla_versiones(conn)
+    actual = version_actual(conn)
+    aplicadas = []
+    for version, nombre, pasos in MIGRACIONES:
+        if version <= actual or version > hasta:
+            continue
+        logger.info("Aplicando migración", extra={"version": version, "nombre": nombre})
+        # BEGIN explícito: sqlite3 no abre transacción sola antes de un DDL
+        conn.execute("BEGIN")
+        try:
+            for paso in pasos:
+                if isinstance(paso, str):
+                    conn.execute(paso)
+                else:
+                    paso(conn)
+            conn.execute("INSERT INTO schema_version (version, nombre, aplicada_en) VALUES (?, ?, ?)",
+                         (version, nombre, time.time()))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        aplicadas.append(version)
+    return aplicadas
+
+
+def aplicar_migraciones(hasta: int = None) -> list:
+    """Lleva la base a la última versión (o a `hasta`). Devuelve las versiones aplicadas.
+
+    Con la base al día es una sola consulta. Si hay pendientes se toma un lock
+    entre procesos y se vuelve a mirar: con varios workers arrancando juntos,
+    solo el primero migra.
+    """
+    hasta = ULTIMA_VERSION if hasta is None else hasta
+    conn = obtener_conexion()
+    if version_actual(conn) >= hasta:
+        return []
+    with bloqueo_exclusivo(f"{DB_PATH}.lock"):
+        return _aplicar(conn, hasta)
+
+
+def estado_migraciones() -> list:
+    conn = obtener_conexion()
+    actual = version_actual(conn)
+    fechas = {}
+    if actual >= 0:
+        fechas = {row[0]: row[1] for row in conn.execute("SELECT version, aplicada_en FROM schema_version")}
+    # Las bases que ya venían del arranque viejo tienen el esquema base sin fila en schema_version
+    return [{"version": version, "nombre": nombre, "aplicada": version <= actual, "aplicada_en": fechas.get(version)}
+            for version, nombre, _ in MIGRACIONES]
+
+
+def verificar_planes() -> list:
+    """Corre EXPLAIN QUERY PLAN sobre las consultas calientes.
+
+    Devuelve una lista de problemas (vacía si todo usa su índice) para que un
+    cambio de esquema no las devuelva a un full scan sin que nadie se entere.
+    """
+    conn = obtener_conexion()
+    problemas = []
+    for sql, params, indice in CONSULTAS_INDEXADAS:
+        plan = " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        if indice not in plan or "USE TEMP B-TREE" in plan:
+            problemas.append(f"{sql}\n    -> {plan}")
+    return problemas
+
+
+def _verificar() -> int:
+    problemas = verificar_planes()
+    for p in problemas:
+        print(f"❌ {p}")
+    print("Planes OK" if not problemas else f"{len(problemas)} consulta(s) sin índice")
+    duplicados = reportar_duplicados()
+    for d in duplicados:
+        print(f"⚠️ {d['tipo']} {d['id']} (usuario {d['user_id']}) repite a {d['duplicado_de']}: {d['clave']}")
+    if duplicados:
+        print(f"{len(duplicados)} comprobante(s) duplicado(s) para revisar")
+    return 1 if problemas or duplicados else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migraciones del esquema de contabilidad.db")
+    comandos = parser.add_subparsers(dest="comando")
+    comandos.add_parser("estado", help="Versión actual y migraciones aplicadas o pendientes")
+    p = comandos.add_parser("aplicar", help="Aplicar las migraciones pendientes")
+    p.add_argument("--hasta", type=int, help="Aplicar solo hasta esta versión")
+    comandos.add_parser("verificar", help="Aplicar y revisar planes de consulta y duplicados (por defecto)")
+    args = parser.parse_args()
+    configurar_logs()
+
+    if args.comando == "estado":
+        for m in estado_migraciones():
+            if m["aplicada_en"]:
+                cuando = time.strftime("%Y-%m-%d %H:%M", time.localtime(m["aplicada_en"]))
+            else:
+                cuando = "previa a schema_version" if m["aplicada"] else "pendiente"
+            print(f"{m['version']:>3}  {m['nombre']:<32} {cuando}")
+        print(f"Versión actual: {version_actual(obtener_conexion())} de {ULTIMA_VERSION}")
+    elif args.comando == "aplicar":
+        aplicadas = aplicar_migraciones(args.hasta)
+        print(f"Aplicadas: {', '.join(map(str, aplicadas))}" if aplicadas else "Nada que aplicar")
+    else:
+        aplicar_migraciones()
+        raise SystemExit(_verificar())
@@ -0,0 +1,135 @@
+import contextvars
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Métricas Prometheus (expuestas en /metrics), trace id por request y logs JSON.
+LOG_NIVEL = os.getenv("LOG_NIVEL", "INFO").upper()
+CABECERA_TRACE = "X-Trace-Id"
+
+# Buckets pensados para una API que va de milisegundos (SQLite) a decenas de segundos (Gemini)
+BUCKETS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 60)
+BUCKETS_BYTES = (10_000, 100_000, 500_000, 1_000_000, 2_500_000, 5_000_000, 10_000_000, 25_000_000)
+
+HTTP_DURACION = Histogram("qonta_http_duracion_segundos", "Latencia por ruta",
+                          ["metodo", "ruta", "estado"], buckets=BUCKETS_SEGUNDOS)
+HTTP_EN_CURSO = Gauge("qonta_http_en_curso", "Requests en curso", ["metodo", "ruta"], multiprocess_mode="livesum")
+UPLOAD_BYTES = Histogram("qonta_upload_bytes", "Tamaño del cuerpo de los uploads", ["ruta"], buckets=BUCKETS_BYTES)
+ETAPA_DURACION = Histogram("qonta_etapa_duracion_segundos", "Duración de cada etapa de un escaneo",
+                           ["etapa"], buckets=BUCKETS_SEGUNDOS)
+DB_DURACION = Histogram("qonta_db_duracion_segundos", "Duración de cada operación en el pool de SQLite",
+                        ["operacion"], buckets=BUCKETS_SEGUNDOS)
+GEMINI_DURACION = Histogram("qonta_gemini_duracion_segundos", "Duración de las llamadas a Gemini",
+                            ["resultado"], buckets=BUCKETS_SEGUNDOS)
+GEMINI_TOKENS = Counter("qonta_gemini_tokens_total", "Tokens consumidos en Gemini", ["tipo"])
+GEMINI_ERRORES = Counter("qonta_gemini_errores_total", "Errores de Gemini", ["motivo"])
+EXTRACCION_DURACION = Histogram("qonta_extraccion_duracion_segundos", "Duración de cada extractor",
+                                ["extractor", "resultado"], buckets=BUCKETS_SEGUNDOS)
+EXTRACCION_RUTA = Counter("qonta_extraccion_total", "Escaneos resueltos por extractor y motivo", ["extractor", "motivo"])
+EXTRACCION_CAMPOS = Counter("qonta_extraccion_campos_total", "Campos extraídos frente a lo que confirmó el usuario",
+                            ["extractor", "campo", "resultado"])
+
+trace_id_actual = contextvars.ContextVar("trace_id", default=None)
+# Tiempos por etapa del request en curso; el log de acceso los incluye
+etapas_actuales = contextvars.ContextVar("etapas", default=None)
+
+logger = logging.getLogger("qonta")
+
+_CAMPOS_ESTANDAR = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class FormatoJSON(logging.Formatter):
+    """Una línea JSON por evento; los `extra=` del log van como campos propios."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        evento = {
+            "ts": round(record.created, 3),
+            "nivel": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        trace_id = trace_id_actual.get()
+        if trace_id:
+            evento["trace_id"] = trace_id
+        evento.update({k: v for k, v in vars(record).items() if k not in _CAMPOS_ESTANDAR})
+        if record.exc_info:
+            evento["excepcion"] = self.formatException(record.exc_info)
+        return json.dumps(evento, ensure_ascii=False, default=str)
+
+
+def configurar_logs():
+    raiz = logging.getLogger()
+    if any(isinstance(h.formatter, FormatoJSON) for h in raiz.handlers):
+        return
+    manejador = logging.StreamHandler()
+    manejador.setFormatter(FormatoJSON())
+    raiz.addHandler(manejador)
+    raiz.setLevel(LOG_NIVEL)
+    # Cada request de httpx (webhooks) ya queda en el log de acceso o en el error
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+def nuevo_trace_id(entrante: str = None) -> str:
+    # Se respeta el id que mande el cliente (o un proxy) para poder seguirlo de punta a punta
+    trace_id = entrante if entrante and len(entrante) <= 64 else uuid.uuid4().hex
+    trace_id_actual.set(trace_id)
+    etapas_actuales.set({})
+    return trace_id
+
+
+@contextmanager
+def medir(etapa: str):
+    """Mide una etapa: la suma al histograma y a los tiempos del request actual."""
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        duracion = time.perf_counter() - inicio
+        ETAPA_DURACION.labels(etapa).observe(duracion)
+        etapas = etapas_actuales.get()
+        if etapas is not None:
+            etapas[etapa] = round(etapas.get(etapa, 0) + duracion * 1000, 2)
+
+
+def _multiproceso() -> bool:
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+
+def preparar_metricas_multiproceso():
+    """Llamar antes de lanzar varios workers: cada uno escribe sus métricas en
+    archivos de PROMETHEUS_MULTIPROC_DIR y /metrics suma los de todos. La
+    variable se lee al importar prometheus_client, por eso va en el proceso padre."""
+    carpeta = os.environ.get("PROMETHEUS_MULTIPROC_DIR") or tempfile.mkdtemp(prefix="qonta_metricas_")
+    os.makedirs(carpeta, exist_ok=True)
+    for nombre in os.listdir(carpeta):
+        if nombre.endswith(".db"):
+            os.remove(os.path.join(carpeta, nombre))  # de una corrida anterior
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = carpeta
+
+
+def exportar_metricas() -> bytes:
+    if not _multiproceso():
+        return generate_latest()
+    registro = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registro)
+    return generate_latest(registro)
+
+
+def cerrar_metricas():
+    # Los gauges "livesum" del worker que se va dejan de sumar
+    if _multiproceso():
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def registrar_uso_gemini(response):
+    uso = getattr(response, "usage_metadata", None)
+    if uso is None:
+        return
+    for tipo, valor in (("prompt", uso.prompt_token_count), ("respuesta", uso.candidates_token_count)):
+        if valor:
+            GEMINI_TOKENS.labels(tipo).inc(valor)
@@ -0,0 +1,136 @@
+from db import obtener_conexion, transaccion
+
+# Totales por usuario, periodo y tipo para el dashboard. Los montos van en
+# céntimos enteros: con sumas y restas incrementales un REAL acumula error.
+# Los triggers (migración 3) los mantienen al día en la misma transacción que
+# el INSERT/DELETE del comprobante, así que nunca quedan desfasados.
+
+# Expresiones por fila; "{f}" es el prefijo NEW./OLD. en los triggers y vacío al reconstruir.
+# Si no se registró base/IGV se desglosa del total al 18%, igual que en el export SIRE.
+_TOTAL_COMPRA = "COALESCE({f}monto_total, 0)"
+_SIN_DESGLOSE_COMPRA = "{f}base_imponible_1 IS NULL OR {f}igv_1 IS NULL"
+_TOTAL_VENTA = "COALESCE({f}total_cp, 0)"
+_SIN_DESGLOSE_VENTA = (
+    "COALESCE({f}base_imponible_gravada, 0) = 0 AND COALESCE({f}monto_igv, 0) = 0"
+    " AND COALESCE({f}importe_exonerado, 0) = 0 AND COALESCE({f}importe_inafecto, 0) = 0"
+    " AND COALESCE({f}valor_exportacion, 0) = 0"
+)
+
+
+def _centimos(expr: str) -> str:
+    return f"CAST(ROUND(({expr}) * 100) AS INTEGER)"
+
+
+def _montos(total: str, sin_desglose: str, base: str, igv: str):
+    base_estimada = f"ROUND({total} / 1.18, 2)"
+    return (
+        _centimos(total),
+        _centimos(f"CASE WHEN {sin_desglose} THEN {base_estimada} ELSE COALESCE({base}, 0) END"),
+        _centimos(f"CASE WHEN {sin_desglose} THEN {total} - {base_estimada} ELSE COALESCE({igv}, 0) END"),
+    )
+
+
+# tipo -> (tabla, expresiones de total, base e IGV en céntimos)
+FUENTES = {
+    "compra": ("compras_sire",) + _montos(_TOTAL_COMPRA, _SIN_DESGLOSE_COMPRA, "{f}base_imponible_1", "{f}igv_1"),
+    "venta": ("ventas_sire",) + _montos(_TOTAL_VENTA, _SIN_DESGLOSE_VENTA, "{f}base_imponible_gravada", "{f}monto_igv"),
+}
+
+SQL_TABLA_RESUMEN = '''
+    CREATE TABLE IF NOT EXISTS resumen_periodo (
+        user_id INTEGER NOT NULL,
+        periodo_tributario TEXT NOT NULL,
+        tipo TEXT NOT NULL,          -- 'compra' o 'venta'
+        cantidad INTEGER NOT NULL DEFAULT 0,
+        total_centimos INTEGER NOT NULL DEFAULT 0,
+        base_centimos INTEGER NOT NULL DEFAULT 0,
+        igv_centimos INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, periodo_tributario, tipo)
+    ) WITHOUT ROWID
+'''
+
+
+def _sumar(tipo: str, fila: str, signo: str) -> str:
+    """UPSERT que suma (signo '+') o resta (signo '-') la fila NEW/OLD al resumen."""
+    _, total, base, igv = (x.format(f=f"{fila}.") for x in FUENTES[tipo])
+    sql = f'''
+        INSERT INTO resumen_periodo (user_id, periodo_tributario, tipo, cantidad, total_centimos, base_centimos, igv_centimos)
+        SELECT {fila}.user_id, COALESCE({fila}.periodo_tributario, ''), '{tipo}', {signo}1, {signo}{total}, {signo}{base}, {signo}{igv}
+        WHERE {fila}.user_id IS NOT NULL
+        ON CONFLICT (user_id, periodo_tributario, tipo) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            total_centimos = total_centimos + excluded.total_centimos,
+            base_centimos = base_centimos + excluded.base_centimos,
+            igv_centimos = igv_centimos + excluded.igv_centimos;
+    '''
+    if signo == "-":
+        sql += f'''
+        DELETE FROM resumen_periodo
+        WHERE user_id = {fila}.user_id AND periodo_tributario = COALESCE({fila}.periodo_tributario, '')
+          AND tipo = '{tipo}' AND cantidad <= 0;
+    '''
+    return sql
+
+
+def sql_triggers_resumen() -> list:
+    sentencias = []
+    for tipo, (tabla, *_) in FUENTES.items():
+        sentencias += [
+            f"CREATE TRIGGER IF NOT EXISTS trg_resumen_{tabla}_ins AFTER INSERT ON {tabla} BEGIN {_sumar(tipo, 'NEW', '+')} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_resumen_{tabla}_del AFTER DELETE ON {tabla} BEGIN {_sumar(tipo, 'OLD', '-')} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_resumen_{tabla}_upd AFTER UPDATE ON {tabla} "
+            f"BEGIN {_sumar(tipo, 'OLD', '-')} {_sumar(tipo, 'NEW', '+')} END",
+        ]
+    return sentencias
+
+
+def sql_reconstruir(filtro_usuario: bool = False) -> list:
+    """DELETE + INSERT ... SELECT que recalculan el resumen desde las tablas base."""
+    # Filas sin user_id (datos viejos) no tienen a quién sumarse
+    donde = "= ?" if filtro_usuario else "IS NOT NULL"
+    sentencias = [f"DELETE FROM resumen_periodo WHERE user_id {donde}"]
+    for tipo, (tabla, total, base, igv) in FUENTES.items():
+        sentencias.append(f'''
+            INSERT INTO resumen_periodo (user_id, periodo_tributario, tipo, cantidad, total_centimos, base_centimos, igv_centimos)
+            SELECT user_id, COALESCE(periodo_tributario, ''), '{tipo}', COUNT(*),
+                   SUM({total.format(f="")}), SUM({base.format(f="")}), SUM({igv.format(f="")})
+            FROM {tabla} WHERE user_id {donde}
+            GROUP BY user_id, COALESCE(periodo_tributario, '')
+        ''')
+    return sentencias
+
+
+def reconstruir_resumenes(user_id: int = None):
+    """Recalcula el resumen completo (o de un usuario) en una transacción."""
+    parametros = (user_id,) if user_id is not None else ()
+    with transaccion() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for sql in sql_reconstruir(user_id is not None):
+            conn.execute(sql, parametros)
+
+
+def obtener_resumen(user_id: int, periodo: str) -> dict:
+    rows = obtener_conexion().execute('''
+        SELECT tipo, cantidad, total_centimos, base_centimos, igv_centimos
+        FROM resumen_periodo WHERE user_id = ? AND periodo_tributario = ?
+    ''', (user_id, periodo)).fetchall()
+    resumen = {"periodo": periodo}
+    for tipo, clave in (("compra", "compras"), ("venta", "ventas")):
+        row = next((r for r in rows if r["tipo"] == tipo), None)
+        resumen[clave] = {
+            "cantidad": row["cantidad"] if row else 0,
+            "monto_total": (row["total_centimos"] if row else 0) / 100,
+            "base_imponible": (row["base_centimos"] if row else 0) / 100,
+            "igv": (row["igv_centimos"] if row else 0) / 100,
+        }
+    # IGV de ventas menos crédito fiscal de compras
+    resumen["igv_por_pagar"] = round(resumen["ventas"]["igv"] - resumen["compras"]["igv"], 2)
+    return resumen
+
+
+if __name__ == "__main__":
+    import sys
+    from migraciones import aplicar_migraciones
+    aplicar_migraciones()
+    reconstruir_resumenes(int(sys.argv[1]) if len(sys.argv) > 1 else None)
+    print("Resúmenes reconstruidos")
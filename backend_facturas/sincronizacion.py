@@ -0,0 +1,166 @@
+import os
+import time
+from almacenamiento import ruta_derivada
+from db import transaccion
+
+# Sincronización incremental para la app: en vez de bajar la lista completa en
+# cada refresco, la app manda el token de su última sincronización y recibe
+# solo lo que cambió desde entonces.
+#
+# Los triggers (migración 11) dejan en `cambios` una fila por comprobante con
+# su último cambio: insertar, editar o tocar sus items la reemplaza por una
+# con `seq` nuevo, y borrarlo la deja como lápida (borrado = 1). El token es
+# ese `seq`: sale de AUTOINCREMENT dentro de la transacción que escribe, y
+# como SQLite serializa las escrituras, crece en el mismo orden en que se
+# confirman. Un timestamp no sirve de cursor: dos workers pueden escribir en
+# el mismo milisegundo, o con relojes corridos.
+SYNC_MAX_CAMBIOS = int(os.getenv("SYNC_MAX_CAMBIOS", "500"))
+# Las lápidas más viejas se purgan; un token anterior obliga a bajar todo de nuevo
+SYNC_RETENCION_DIAS = float(os.getenv("SYNC_RETENCION_DIAS", "90"))
+
+SQL_TABLA_CAMBIOS = '''
+    CREATE TABLE IF NOT EXISTS cambios (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        tipo TEXT,              -- 'compra' o 'venta'
+        id_registro INTEGER,
+        user_id INTEGER,
+        borrado INTEGER,        -- 1: lápida de un comprobante eliminado
+        actualizado REAL,
+        UNIQUE (tipo, id_registro)
+    )
+'''
+SQL_INDICE_CAMBIOS = "CREATE INDEX IF NOT EXISTS idx_cambios_usuario ON cambios (user_id, seq)"
+# Hasta qué seq se purgaron lápidas: un token menor ya no sabe qué se borró
+SQL_TABLA_HORIZONTE = '''
+    CREATE TABLE IF NOT EXISTS cambios_horizonte (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        seq INTEGER NOT NULL
+    )
+'''
+
+# tipo -> (tabla, columna id, clave en la respuesta)
+FUENTES = {
+    "compra": ("compras_sire", "id_gasto", "compras"),
+    "venta": ("ventas_sire", "id_transaccion", "ventas"),
+}
+
+# julianday en segundos epoch: unixepoch('subsec') recién llega en SQLite 3.42
+_AHORA = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+def _registrar(tipo: str, id_registro: str, user_id: str, borrado: int) -> str:
+    return (f"INSERT OR REPLACE INTO cambios (tipo, id_registro, user_id, borrado, actualizado) "
+            f"VALUES ('{tipo}', {id_registro}, {user_id}, {borrado}, {_AHORA});")
+
+
+def _registrar_padre(f: str) -> str:
+    """Un item cambió: su comprobante pasa al final del log (si todavía existe)."""
+    return " ".join(
+        f"INSERT OR REPLACE INTO cambios (tipo, id_registro, user_id, borrado, actualizado) "
+        f"SELECT '{tipo}', {columna_id}, user_id, 0, {_AHORA} FROM {tabla} "
+        f"WHERE {f}tipo_registro = '{tipo}' AND {columna_id} = {f}id_padre;"
+        for tipo, (tabla, columna_id, _) in FUENTES.items()
+    )
+
+
+def sql_migracion_cambios() -> list:
+    sentencias = [SQL_TABLA_CAMBIOS, SQL_INDICE_CAMBIOS, SQL_TABLA_HORIZONTE]
+    for tipo, (tabla, columna_id, _) in FUENTES.items():
+        sentencias += [
+            f"CREATE TRIGGER IF NOT EXISTS trg_cambios_{tabla}_ins AFTER INSERT ON {tabla} "
+            f"BEGIN {_registrar(tipo, f'NEW.{columna_id}', 'NEW.user_id', 0)} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_cambios_{tabla}_upd AFTER UPDATE ON {tabla} "
+            f"BEGIN {_registrar(tipo, f'NEW.{columna_id}', 'NEW.user_id', 0)} END",
+            f"CREATE TRIGGER IF NOT EXISTS trg_cambios_{tabla}_del AFTER DELETE ON {tabla} "
+            f"BEGIN {_registrar(tipo, f'OLD.{columna_id}', 'OLD.user_id', 1)} END",
+            # Lo ya guardado entra al log, así el primer sync de la app lo baja completo
+            f"INSERT OR IGNORE INTO cambios (tipo, id_registro, user_id, borrado, actualizado) "
+            f"SELECT '{tipo}', {columna_id}, user_id, 0, {_AHORA} FROM {tabla} ORDER BY {columna_id}",
+        ]
+    sentencias += [
+        f"CREATE TRIGGER IF NOT EXISTS trg_cambios_items_ins AFTER INSERT ON detalle_items "
+        f"BEGIN {_registrar_padre('NEW.')} END",
+        f"CREATE TRIGGER IF NOT EXISTS trg_cambios_items_upd AFTER UPDATE ON detalle_items "
+        f"BEGIN {_registrar_padre('NEW.')} END",
+        # Si el comprobante ya se borró, el SELECT no encuentra nada y queda su lápida
+        f"CREATE TRIGGER IF NOT EXISTS trg_cambios_items_del AFTER DELETE ON detalle_items "
+        f"BEGIN {_registrar_padre('OLD.')} END",
+    ]
+    return sentencias
+
+
+def _leer_token(token) -> int:
+    try:
+        seq = int(token)
+    except ValueError:
+        raise ValueError("Token de sincronización inválido")
+    if seq < 0:
+        raise ValueError("Token de sincronización inválido")
+    return seq
+
+
+def cambios_desde(user_id: int, token=None, limite: int = SYNC_MAX_CAMBIOS) -> dict:
+    """Comprobantes del usuario que cambiaron después de `token`.
+
+    Devuelve los comprobantes completos (cabecera e items, como obtener-detalle),
+    los ids eliminados y el token para la próxima vez. `completo` indica que
+    la app debe vaciar su caché antes de aplicar (primer sync, o un token más
+    viejo que las lápidas guardadas); `pendientes`, que hay más cambios y
+    conviene volver a llamar enseguida con el token nuevo.
+    """
+    desde = _leer_token(token) if token else 0
+    respuesta = {"completo": False, "pendientes": False, "eliminados": {}}
+    with transaccion() as conn:
+        # Una sola lectura consistente: el log y los comprobantes del mismo instante
+        conn.execute("BEGIN")
+        horizonte = conn.execute("SELECT seq FROM cambios_horizonte WHERE id = 1").fetchone()
+        if not token or (horizonte and desde < horizonte[0]):
+            respuesta["completo"] = True
+            desde = 0
+        filas = conn.execute(
+            "SELECT seq, tipo, id_registro, borrado FROM cambios WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+            (user_id, desde, limite)
+        ).fetchall()
+        respuesta["pendientes"] = len(filas) == limite
+        if filas:
+            respuesta["token"] = str(filas[-1]["seq"])
+        elif respuesta["completo"]:
+            # Sin nada propio: el token es el seq actual, así el próximo sync no recorre lo ajeno
+            respuesta["token"] = str(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM cambios").fetchone()[0])
+        else:
+            respuesta["token"] = str(desde)
+
+        for tipo, (tabla, columna_id, clave) in FUENTES.items():
+            vivos = [f["id_registro"] for f in filas if f["tipo"] == tipo and not f["borrado"]]
+            respuesta["eliminados"][clave] = [f["id_registro"] for f in filas if f["tipo"] == tipo and f["borrado"]]
+            registros = {}
+            if vivos:
+                marcas = ",".join("?" * len(vivos))
+                for row in conn.execute(f"SELECT * FROM {tabla} WHERE {columna_id} IN ({marcas}) AND user_id = ?",
+                                        (*vivos, user_id)):
+                    datos = dict(row)
+                    datos["items"] = []
+                    if datos.get("ruta_imagen"):
+                        datos["ruta_miniatura"] = ruta_derivada(datos["ruta_imagen"], "thumb")
+                        datos["ruta_preview"] = ruta_derivada(datos["ruta_imagen"], "preview")
+                    registros[datos[columna_id]] = datos
+                for item in conn.execute(f"SELECT * FROM detalle_items WHERE tipo_registro = ? AND id_padre IN ({marcas})",
+                                         (tipo, *vivos)):
+                    if item["id_padre"] in registros:
+                        registros[item["id_padre"]]["items"].append(dict(item))
+            # En el orden del log, el más reciente al final
+            respuesta[clave] = [registros[i] for i in vivos if i in registros]
+    return respuesta
+
+
+def purgar_lapidas() -> int:
+    """Borra las lápidas viejas y corre el horizonte hasta la última purgada."""
+    with transaccion() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        limite = time.time() - SYNC_RETENCION_DIAS * 86400
+        ultima = conn.execute("SELECT MAX(seq) FROM cambios WHERE borrado = 1 AND actualizado < ?", (limite,)).fetchone()[0]
+        if ultima is None:
+            return 0
+        conn.execute("INSERT INTO cambios_horizonte (id, seq) VALUES (1, ?) "
+                     "ON CONFLICT (id) DO UPDATE SET seq = max(seq, excluded.seq)", (ultima,))
+        return conn.execute("DELETE FROM cambios WHERE borrado = 1 AND seq <= ?", (ultima,)).rowcount
@@ -0,0 +1,176 @@
+import csv
+import io
+import os
+import tempfile
+from db import abrir_conexion_dedicada, en_db
+
+try:
+    import openpyxl
+except ImportError:  # XLSX es opcional: sin openpyxl solo se exporta TXT/CSV
+    openpyxl = None
+
+FILAS_POR_BLOQUE = 500
+
+CODIGO_COMPROBANTE = {"FACTURA": "01", "BOLETA": "03", "NOTA DE CREDITO": "07", "NOTA DE DEBITO": "08"}
+# Código de libro usado en el nombre del archivo: RVIE (ventas) y RCE (compras)
+CODIGO_LIBRO = {"ventas": "140400", "compras": "080400"}
+
+CAMPOS = {
+    "ventas": [
+        "ruc", "razon_social", "periodo", "car_sunat", "fecha_emision", "fecha_vencimiento",
+        "tipo_cp", "serie_cp", "nro_cp_inicial", "nro_cp_final", "tipo_doc_identidad", "nro_doc_identidad",
+        "razon_social_cliente", "valor_exportacion", "base_imponible_gravada", "dscto_base_imponible",
+        "igv", "dscto_igv", "importe_exonerado", "importe_inafecto", "isc", "base_ivap", "ivap",
+        "icbper", "otros_tributos", "total_cp", "moneda", "tipo_cambio"
+    ],
+    "compras": [
+        "ruc", "razon_social", "periodo", "car_sunat", "fecha_emision", "fecha_vencimiento",
+        "tipo_cp", "serie_cp", "anio", "nro_cp_inicial", "nro_cp_final", "tipo_doc_identidad",
+        "nro_doc_identidad", "razon_social_proveedor", "base_imponible_1", "igv_1",
+        "valor_no_gravado", "total_cp", "moneda", "tipo_cambio"
+    ]
+}
+
+SQL_EXPORTAR = {
+    "ventas": '''
+        SELECT periodo_tributario, fecha_emision, tipo_comprobante, serie_comprobante, nro_comprobante, cliente_tipo_doc,
+               cliente_nro_doc, cliente_razon_social, valor_exportacion, base_imponible_gravada,
+               dscto_base_imponible, monto_igv, dscto_igv, importe_exonerado, importe_inafecto, isc,
+               base_ivap, ivap, icbper, otros_tributos, total_cp, moneda, tipo_cambio
+        FROM ventas_sire
+        WHERE user_id = ? AND periodo_tributario BETWEEN ? AND ?
+        ORDER BY periodo_tributario, id_transaccion
+    ''',
+    "compras": '''
+        SELECT periodo_tributario, fecha_emision, tipo_comprobante, serie, numero, proveedor_ruc, proveedor_razon_social,
+               base_imponible_1, igv_1, monto_total
+        FROM compras_sire
+        WHERE user_id = ? AND periodo_tributario BETWEEN ? AND ?
+        ORDER BY periodo_tributario, id_gasto
+    '''
+}
+
+
+def rango_periodo(periodo: str):
+    """'202503' -> un mes; '2025' -> el año completo (export de cierre)."""
+    if len(periodo) == 4 and periodo.isdigit():
+        return f"{periodo}01", f"{periodo}12"
+    if len(periodo) == 6 and periodo.isdigit():
+        return periodo, periodo
+    raise ValueError("El periodo debe ser AAAAMM o AAAA")
+
+
+def nombre_archivo(tipo: str, ruc: str, periodo: str, extension: str) -> str:
+    # Formato de nombre del PLE/SIRE; un export anual va con mes 00
+    return f"LE{ruc or '00000000000'}{periodo.ljust(6, '0')}00{CODIGO_LIBRO[tipo]}021112.{extension}"
+
+
+def _codigo_comprobante(tipo_comprobante) -> str:
+    return CODIGO_COMPROBANTE.get((tipo_comprobante or "").strip().upper(), tipo_comprobante or "")
+
+
+def _tipo_documento(nro_doc) -> str:
+    nro_doc = (nro_doc or "").strip()
+    if len(nro_doc) == 11:
+        return "6"  # RUC
+    if len(nro_doc) == 8:
+        return "1"  # DNI
+    return "0"
+
+
+def _separar_serie(serie, numero):
+    # La app guarda "F001-123" en serie cuando el número no viene aparte
+    if not numero and serie and "-" in serie:
+        serie, numero = serie.split("-", 1)
+    return serie or "", numero or ""
+
+
+def _desglosar(total, base, igv):
+    """Si no se registró base/IGV se desglosa del total al 18%."""
+    total = total or 0
+    if base is None or igv is None:
+        base = round(total / 1.18, 2)
+        igv = round(total - base, 2)
+    return base, igv
+
+
+def _fila(tipo, r, ruc, razon_social):
+    periodo_fila = f"{r['periodo_tributario']}00"
+    if tipo == "ventas":
+        serie, numero = _separar_serie(r["serie_comprobante"], r["nro_comprobante"])
+        base, igv = r["base_imponible_gravada"], r["monto_igv"]
+        # Las columnas tienen DEFAULT 0: si todo está en cero y no es exonerada/inafecta/exportación, se desglosa
+        if not (base or igv or r["importe_exonerado"] or r["importe_inafecto"] or r["valor_exportacion"]):
+            base, igv = _desglosar(r["total_cp"], None, None)
+        return [
+            ruc, razon_social, periodo_fila, "", r["fecha_emision"], "",
+            _codigo_comprobante(r["tipo_comprobante"]), serie, numero, "",
+            r["cliente_tipo_doc"] or _tipo_documento(r["cliente_nro_doc"]), r["cliente_nro_doc"] or "",
+            r["cliente_razon_social"] or "", r["valor_exportacion"] or 0, base, r["dscto_base_imponible"] or 0,
+            igv, r["dscto_igv"] or 0, r["importe_exonerado"] or 0, r["importe_inafecto"] or 0, r["isc"] or 0,
+            r["base_ivap"] or 0, r["ivap"] or 0, r["icbper"] or 0, r["otros_tributos"] or 0,
+            r["total_cp"] or 0, r["moneda"] or "PEN", f"{r['tipo_cambio'] or 1.0:.3f}"
+        ]
+    serie, numero = _separar_serie(r["serie"], r["numero"])
+    base, igv = _desglosar(r["monto_total"], r["base_imponible_1"], r["igv_1"])
+    return [
+        ruc, razon_social, periodo_fila, "", r["fecha_emision"], "",
+        _codigo_comprobante(r["tipo_comprobante"]), serie, "", numero, "",
+        _tipo_documento(r["proveedor_ruc"]), r["proveedor_ruc"] or "", r["proveedor_razon_social"] or "",
+        base, igv, 0, r["monto_total"] or 0, "PEN", "1.000"
+    ]
+
+
+def _formatear(valor) -> str:
+    if isinstance(valor, float):
+        return f"{valor:.2f}"
+    return str(valor).replace("|", " ")
+
+
+async def _bloques_de_filas(tipo: str, user_id: int, periodo: str, ruc: str, razon_social: str):
+    """Lee las filas por bloques con un cursor propio; la memoria no crece con el periodo."""
+    desde, hasta = rango_periodo(periodo)
+    conn = abrir_conexion_dedicada()
+    try:
+        cursor = await en_db(conn.execute, SQL_EXPORTAR[tipo], (user_id, desde, hasta))
+        while True:
+            rows = await en_db(cursor.fetchmany, FILAS_POR_BLOQUE)
+            if not rows:
+                break
+            yield [_fila(tipo, r, ruc, razon_social) for r in rows]
+    finally:
+        conn.close()
+
+
+async def generar_txt(tipo, user_id, periodo, ruc, razon_social):
+    async for filas in _bloques_de_filas(tipo, user_id, periodo, ruc, razon_social):
+        yield "".join("|".join(_formatear(v) for v in fila) + "|\r\n" for fila in filas).encode("utf-8")
+
+
+async def generar_csv(tipo, user_id, periodo, ruc, razon_social):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write("\ufeff")  # BOM para que Excel abra bien las tildes
+    escritor.writerow(CAMPOS[tipo])
+    async for filas in _bloques_de_filas(tipo, user_id, periodo, ruc, razon_social):
+        escritor.writerows(filas)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def generar_xlsx(tipo, user_id, periodo, ruc, razon_social) -> str:
+    """XLSX no se puede mandar por partes: se escribe en modo write_only (memoria
+    acotada) a un archivo temporal y se devuelve su ruta."""
+    libro = openpyxl.Workbook(write_only=True)
+    hoja = libro.create_sheet(title=tipo.capitalize())
+    hoja.append(CAMPOS[tipo])
+    async for filas in _bloques_de_filas(tipo, user_id, periodo, ruc, razon_social):
+        for fila in filas:
+            hoja.append(fila)
+    fd, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    await en_db(libro.save, ruta)
+    return ruta
@@ -0,0 +1,74 @@
+import os
+import sys
+import pytest
+
+# Los módulos del backend se importan como en main.py, desde su carpeta
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+import db
+import migraciones
+
+
+@pytest.fixture
+def base_temporal(tmp_path, monkeypatch):
+    """Una base vacía en tmp_path para este test; la conexión del hilo se abre contra ella."""
+    ruta = str(tmp_path / "contabilidad.db")
+    monkeypatch.setattr(db, "DB_PATH", ruta)
+    monkeypatch.setattr(migraciones, "DB_PATH", ruta)
+    monkeypatch.setattr(db._local, "conn", None, raising=False)
+    yield ruta
+    if db._local.conn is not None:
+        db._local.conn.close()
+
+
+@pytest.fixture
+def base_migrada(base_temporal):
+    """Base temporal con el esquema completo; devuelve la conexión del hilo del test."""
+    migraciones.aplicar_migraciones()
+    return db.obtener_conexion()
+
+
+def comprobante(tipo: str = "compra", **cambios) -> dict:
+    """Un comprobante válido con los nombres del JSON de escaneo; `cambios` pisa campos."""
+    documento = {
+        "fecha_emision": "15/03/2025", "tipo_comprobante": "Factura", "serie": "F001", "numero": "123",
+        "monto_total": 118.0, "base_imponible": 100.0, "igv": 18.0,
+        "items": [{"descripcion": "cemento", "cantidad": 2, "precio_unitario": 59.0, "total": 118.0}],
+    }
+    if tipo == "compra":
+        documento.update(proveedor_ruc="20100070970", proveedor_razon_social="Proveedor SAC")
+    else:
+        documento.update(cliente_nro_doc="20100070970", cliente_razon_social="Cliente SAC", moneda="PEN")
+    documento.update(cambios)
+    return documento
+
+
+def guardar(tipo: str = "compra", user_id: int = 1, **cambios) -> int:
+    """Inserta un comprobante por el mismo camino que /guardar-confirmado/ y devuelve su id."""
+    import main
+    from validacion import validar
+    return main._insertar_confirmado(tipo, user_id, validar(tipo, comprobante(tipo, **cambios)))
+
+
+@pytest.fixture
+def cliente(base_temporal, tmp_path, monkeypatch):
+    """La app contra la base temporal, con un usuario registrado: (client, user_id, cabeceras)."""
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi.testclient import TestClient
+    import autenticacion
+    import main
+
+    # uploads/ y static/ se crean en el directorio actual
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(autenticacion, "_secreto", b"secreto-de-prueba")
+    # Los hilos del pool guardan su conexión: uno nuevo para que abran la base de este test
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="sqlite-test")
+    monkeypatch.setattr(db, "_executor", executor)
+    try:
+        with TestClient(main.app) as client:
+            usuario = client.post("/register/", json={"nombre": "Prueba", "email": "prueba@example.com",
+                                                      "password": "clave"}).json()
+            yield client, usuario["user_id"], {"Authorization": f"Bearer {usuario['token']}"}
+    finally:
+        executor.shutdown(wait=True)
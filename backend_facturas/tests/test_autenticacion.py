@@ -0,0 +1,42 @@
+import pytest
+import autenticacion
+from autenticacion import emitir_token, verificar_token
+from almacenamiento import es_de_usuario
+
+
+@pytest.fixture(autouse=True)
+def secreto(monkeypatch):
+    monkeypatch.setattr(autenticacion, "_secreto", b"secreto-de-prueba")
+
+
+def _partes():
+    token, _ = emitir_token(7)
+    return token.split(".")
+
+
+def test_token_valido():
+    token, expira = emitir_token(7)
+    assert verificar_token(token) == (7, expira)
+
+
+@pytest.mark.parametrize("alterar", [
+    lambda c, p, f: f"{c}.{p}.ñandú",             # firma con caracteres fuera de ASCII
+    lambda c, p, f: f"{c}.{p}ñ.{f}",              # carga fuera de ASCII
+    lambda c, p, f: f"{c}.{p}.{f[:-1]}{'B' if f[-1] == 'A' else 'A'}",  # firma alterada
+    lambda c, p, f: f"eyJhbGciOiJub25lIn0.{p}.",  # alg none
+    lambda c, p, f: f"{c}.{p}",                   # sin firma
+])
+def test_tokens_invalidos_no_lanzan(alterar):
+    assert verificar_token(alterar(*_partes())) is None
+
+
+@pytest.mark.parametrize("ruta, base, esperado", [
+    ("uploads/7/2025/03/a.jpg", "uploads", True),
+    ("uploads/70/2025/03/a.jpg", "uploads", False),   # otro usuario con el mismo prefijo
+    ("uploads/7/../8/2025/03/a.jpg", "uploads", False),
+    ("avatars/7/avatar_1.jpg", "avatars", True),
+    ("avatars/8/avatar_1.jpg", "avatars", False),
+    ("", "uploads", False),
+])
+def test_archivos_solo_del_dueno(ruta, base, esperado):
+    assert es_de_usuario(ruta, 7, base=base) is esperado
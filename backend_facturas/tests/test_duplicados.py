@@ -0,0 +1,70 @@
+import pytest
+from conftest import comprobante
+from db import obtener_conexion
+from duplicados import reportar_duplicados
+from migraciones import aplicar_migraciones
+
+
+@pytest.mark.parametrize("segundo", [
+    {},
+    {"serie": "F001-00123", "numero": None},    # serie y número pegados, con ceros
+    {"serie": "f001", "numero": "0123"},
+    {"tipo_comprobante": "01"},
+    {"monto_total": 120.0, "base_imponible": None, "igv": None, "items": []},  # otros montos, mismo comprobante
+])
+def test_guardar_dos_veces_devuelve_409(cliente, segundo):
+    client, user_id, cabeceras = cliente
+    primero = client.post("/guardar-confirmado/", headers=cabeceras,
+                          json={"user_id": user_id, "tipo": "compra", "datos": comprobante()})
+    assert primero.status_code == 200
+    repetido = client.post("/guardar-confirmado/", headers=cabeceras,
+                           json={"user_id": user_id, "tipo": "compra", "datos": comprobante(**segundo)})
+    assert repetido.status_code == 409
+    assert len(client.get(f"/obtener-registros/compras?user_id={user_id}", headers=cabeceras).json()["datos"]) == 1
+
+
+def test_otro_numero_o_proveedor_no_es_duplicado(cliente):
+    client, user_id, cabeceras = cliente
+    for datos in (comprobante(), comprobante(numero="124"), comprobante(proveedor_ruc="10467793549")):
+        r = client.post("/guardar-confirmado/", headers=cabeceras,
+                        json={"user_id": user_id, "tipo": "compra", "datos": datos})
+        assert r.status_code == 200
+
+
+def test_lote_con_comprobante_ya_guardado_devuelve_409(cliente):
+    client, user_id, cabeceras = cliente
+    client.post("/guardar-confirmado/", headers=cabeceras,
+                json={"user_id": user_id, "tipo": "compra", "datos": comprobante()})
+    r = client.post("/guardar-confirmado-lote/", headers=cabeceras, json={"documentos": [
+        dict(comprobante(numero="200"), tipo="compra"), dict(comprobante(), tipo="compra")]})
+    assert r.status_code == 409
+    # Nada del lote quedó guardado
+    assert len(client.get(f"/obtener-registros/compras?user_id={user_id}", headers=cabeceras).json()["datos"]) == 1
+
+
+def test_migracion_marca_duplicados_existentes(base_temporal):
+    # Base anterior a la migración 5, con repetidos que el índice único no admitiría
+    aplicar_migraciones(hasta=4)
+    conn = obtener_conexion()
+    compras = [
+        (1, "20100070970", "Factura", "F001", "123"),
+        (1, "20100070970", "Factura", "F001-00123", None),  # el mismo, guardado con otro formato
+        (1, "20100070970", "01", "F001", "0123"),           # y otra vez
+        (1, "20100070970", "Factura", "F001", "124"),
+        (2, "20100070970", "Factura", "F001", "123"),       # otro usuario: no es duplicado
+        (1, None, "Factura", "F001", "123"),                # sin RUC no hay clave
+    ]
+    conn.executemany("INSERT INTO compras_sire (user_id, periodo_tributario, fecha_emision, proveedor_ruc, "
+                     "tipo_comprobante, serie, numero, monto_total) VALUES (?, '202503', '15/03/2025', ?, ?, ?, ?, 118)",
+                     compras)
+    conn.executemany("INSERT INTO ventas_sire (user_id, periodo_tributario, fecha_emision, cliente_nro_doc, "
+                     "tipo_comprobante, serie_comprobante, nro_comprobante, total_cp) "
+                     "VALUES (1, '202503', '15/03/2025', ?, 'Boleta', 'B001', '7', 50)",
+                     [("12345678",), ("87654321",)])  # en ventas la serie ya identifica: otro cliente no importa
+    conn.commit()
+
+    assert 5 in aplicar_migraciones()
+    marcados = {(d["tipo"], d["id"]): d["duplicado_de"] for d in reportar_duplicados()}
+    assert marcados == {("compra", 2): 1, ("compra", 3): 1, ("venta", 2): 1}
+    # Los originales siguen bajo el índice único
+    assert conn.execute("SELECT COUNT(*) FROM compras_sire WHERE duplicado_de IS NULL").fetchone()[0] == 4
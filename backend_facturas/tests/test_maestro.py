@@ -0,0 +1,46 @@
+import main
+from conftest import guardar
+
+
+def _contraparte(conn, nro_doc, user_id=1):
+    row = conn.execute("SELECT razon_social, direccion, telefono, veces FROM contrapartes WHERE user_id = ? AND nro_doc = ?",
+                       (user_id, nro_doc)).fetchone()
+    return tuple(row) if row else None
+
+
+def test_confirmar_crea_la_contraparte(base_migrada):
+    guardar(numero="1", proveedor_direccion="Av. Lima 123")
+    guardar(numero="2", proveedor_telefono="999888777")
+    assert _contraparte(base_migrada, "20100070970") == ("Proveedor SAC", "Av. Lima 123", "999888777", 2)
+
+
+def test_editar_razon_social_y_direccion_llega_al_maestro(base_migrada):
+    id_gasto = guardar(numero="1")
+    main._actualizar_registro("compras", id_gasto, 1, {"proveedor_razon_social": "Proveedor Corregido SAC",
+                                                        "proveedor_direccion": "Jr. Cusco 456"})
+    # Misma contraparte: se corrige, no cuenta como otro comprobante
+    assert _contraparte(base_migrada, "20100070970") == ("Proveedor Corregido SAC", "Jr. Cusco 456", None, 1)
+
+
+def test_editar_el_ruc_mueve_el_comprobante(base_migrada):
+    id_gasto = guardar(numero="1")
+    guardar(numero="2")
+    main._actualizar_registro("compras", id_gasto, 1, {"proveedor_ruc": "10467793549",
+                                                        "proveedor_razon_social": "Juan Perez"})
+    assert _contraparte(base_migrada, "20100070970") == ("Proveedor SAC", None, None, 1)
+    assert _contraparte(base_migrada, "10467793549") == ("Juan Perez", None, None, 1)
+
+
+def test_editar_otros_campos_no_pisa_datos_mas_nuevos(base_migrada):
+    viejo = guardar(numero="1", proveedor_direccion="Dirección vieja")
+    guardar(numero="2", proveedor_direccion="Dirección nueva")
+    main._actualizar_registro("compras", viejo, 1, {"monto_total": 236.0, "base_imponible": 200.0, "igv": 36.0,
+                                                    "items": []})
+    assert _contraparte(base_migrada, "20100070970") == ("Proveedor SAC", "Dirección nueva", None, 2)
+
+
+def test_editar_venta(base_migrada):
+    id_venta = guardar("venta", numero="1")
+    main._actualizar_registro("ventas", id_venta, 1, {"cliente_razon_social": "Cliente Nuevo SAC",
+                                                      "cliente_telefono": "014445555"})
+    assert _contraparte(base_migrada, "20100070970") == ("Cliente Nuevo SAC", None, "014445555", 1)
@@ -0,0 +1,57 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from conftest import BACKEND
+from migraciones import ULTIMA_VERSION
+from observabilidad import preparar_metricas_multiproceso, exportar_metricas
+
+WORKERS = 4
+
+# Lo que hace cada worker de uvicorn al arrancar: migrar bajo el lock y dejar
+# métricas en PROMETHEUS_MULTIPROC_DIR. Arrancan todos juntos con la señal.
+SCRIPT_WORKER = '''
+import json, os, sys, time
+from migraciones import aplicar_migraciones
+from observabilidad import EXTRACCION_RUTA
+while not os.path.exists(sys.argv[1]):
+    time.sleep(0.01)
+aplicadas = aplicar_migraciones()
+EXTRACCION_RUTA.labels("prueba", "arranque").inc()
+print("APLICADAS " + json.dumps(aplicadas))
+'''
+
+
+def _lanzar_workers(ruta_db: str, senal: str) -> list:
+    entorno = dict(os.environ, DB_PATH=ruta_db)
+    procesos = [subprocess.Popen([sys.executable, "-c", SCRIPT_WORKER, senal], cwd=BACKEND, env=entorno,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                for _ in range(WORKERS)]
+    open(senal, "w").close()
+    aplicadas = []
+    for proceso in procesos:
+        salida, errores = proceso.communicate(timeout=60)
+        assert proceso.returncode == 0, errores
+        linea = next(l for l in salida.splitlines() if l.startswith("APLICADAS "))
+        aplicadas.append(json.loads(linea[len("APLICADAS "):]))
+    return aplicadas
+
+
+def test_workers_migran_una_sola_vez_y_suman_metricas(tmp_path, monkeypatch):
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path / "metricas"))
+    preparar_metricas_multiproceso()
+    ruta_db = str(tmp_path / "contabilidad.db")
+
+    aplicadas = _lanzar_workers(ruta_db, str(tmp_path / "arrancar"))
+
+    # Uno solo migró todo; los demás encontraron la base al día después del lock
+    assert sorted(v for lista in aplicadas for v in lista) == list(range(ULTIMA_VERSION + 1))
+    assert sum(1 for lista in aplicadas if lista) == 1
+    with sqlite3.connect(ruta_db) as conn:
+        versiones = [v for (v,) in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versiones == list(range(ULTIMA_VERSION + 1))
+
+    # /metrics de cualquier worker suma lo de todos
+    metricas = exportar_metricas().decode()
+    assert f'qonta_extraccion_total{{extractor="prueba",motivo="arranque"}} {float(WORKERS)}' in metricas
@@ -0,0 +1,19 @@
+from migraciones import aplicar_migraciones, verificar_planes, CONSULTAS_INDEXADAS, ULTIMA_VERSION
+from db import obtener_conexion
+
+
+def test_migraciones_llegan_a_la_ultima_version(base_temporal):
+    aplicadas = aplicar_migraciones()
+    assert aplicadas == list(range(ULTIMA_VERSION + 1))
+    # Con la base al día no hay nada que aplicar
+    assert aplicar_migraciones() == []
+
+
+def test_consultas_calientes_no_recorren_tablas(base_temporal):
+    aplicar_migraciones()
+    conn = obtener_conexion()
+    for sql, params, indice in CONSULTAS_INDEXADAS:
+        plan = " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+        assert "SCAN" not in plan, f"{sql}\n    -> {plan}"
+        assert indice in plan, f"{sql}\n    -> {plan}"
+    assert verificar_planes() == []
@@ -0,0 +1,86 @@
+import pytest
+from conftest import guardar
+
+FECHAS = ["28/02/2025", "01/03/2025", "15/03/2025", "31/03/2025", "01/04/2025", "15/04/2025", "10/05/2025"]
+
+
+@pytest.fixture
+def registros(cliente):
+    """Siete compras del usuario del cliente (ids crecientes en el orden de FECHAS) y una de otro usuario."""
+    client, user_id, cabeceras = cliente
+    ids = [guardar(user_id=user_id, numero=str(n), fecha_emision=fecha) for n, fecha in enumerate(FECHAS, start=1)]
+    guardar(user_id=user_id + 100, numero="1")
+
+    def listar(**params):
+        r = client.get("/obtener-registros/compras", headers=cabeceras, params={"user_id": user_id, **params})
+        assert r.status_code == 200, r.text
+        return r.json()
+    return ids, listar
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 6, 7, 8])
+def test_paginas_continuas(registros, limit):
+    ids, listar = registros
+    vistos, after = [], None
+    while True:
+        pagina = listar(limit=limit, **({"after": after} if after is not None else {}))
+        assert len(pagina["datos"]) <= limit
+        vistos += [r["id"] for r in pagina["datos"]]
+        after = pagina["siguiente"]
+        if after is None:
+            break
+        # El cursor es el último id entregado
+        assert after == vistos[-1]
+    # Sin huecos ni repetidos, del más nuevo al más antiguo
+    assert vistos == ids[::-1]
+
+
+def test_sin_limit_devuelve_todo(registros):
+    ids, listar = registros
+    pagina = listar()
+    assert [r["id"] for r in pagina["datos"]] == ids[::-1] and pagina["siguiente"] is None
+
+
+def test_pagina_exacta_no_anuncia_otra(registros):
+    ids, listar = registros
+    # Con limit+1 se sabe que no hay más sin una página vacía de sobra
+    assert listar(limit=len(ids))["siguiente"] is None
+    assert listar(limit=len(ids) - 1)["siguiente"] == ids[1]
+    assert listar(limit=3, after=ids[3])["siguiente"] is None
+
+
+@pytest.mark.parametrize("periodo, fechas", [
+    ("202502", ["28/02/2025"]),
+    ("202503", ["01/03/2025", "15/03/2025", "31/03/2025"]),
+    ("202506", []),
+])
+def test_filtro_por_periodo(registros, periodo, fechas):
+    _, listar = registros
+    assert [r["fecha"] for r in listar(periodo=periodo)["datos"]] == fechas[::-1]
+
+
+@pytest.mark.parametrize("params, fechas", [
+    ({"desde": "2025-03-01", "hasta": "2025-03-31"}, ["01/03/2025", "15/03/2025", "31/03/2025"]),
+    ({"desde": "2025-03-02", "hasta": "2025-04-01"}, ["15/03/2025", "31/03/2025", "01/04/2025"]),
+    ({"desde": "2025-04-01"}, ["01/04/2025", "15/04/2025", "10/05/2025"]),
+    ({"hasta": "2025-03-01"}, ["28/02/2025", "01/03/2025"]),
+    ({"desde": "2025-03-16", "hasta": "2025-03-30"}, []),
+])
+def test_filtro_desde_hasta(registros, params, fechas):
+    _, listar = registros
+    assert [r["fecha"] for r in listar(**params)["datos"]] == fechas[::-1]
+
+
+def test_filtros_se_combinan_con_la_paginacion(registros):
+    _, listar = registros
+    primera = listar(limit=2, desde="2025-03-01", hasta="2025-04-30")
+    assert [r["fecha"] for r in primera["datos"]] == ["15/04/2025", "01/04/2025"]
+    segunda = listar(limit=2, after=primera["siguiente"], desde="2025-03-01", hasta="2025-04-30")
+    assert [r["fecha"] for r in segunda["datos"]] == ["31/03/2025", "15/03/2025"]
+    assert listar(limit=2, after=segunda["siguiente"], periodo="202503")["datos"][0]["fecha"] == "01/03/2025"
+
+
+def test_registros_de_otro_usuario(cliente):
+    client, user_id, cabeceras = cliente
+    r = client.get("/obtener-registros/compras", headers=cabeceras, params={"user_id": user_id + 100})
+    assert r.status_code == 403
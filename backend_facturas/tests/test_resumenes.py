@@ -0,0 +1,65 @@
+import main
+from conftest import guardar
+from resumenes import reconstruir_resumenes
+
+
+def _resumen(conn) -> list:
+    return [tuple(r) for r in conn.execute("SELECT * FROM resumen_periodo ORDER BY user_id, periodo_tributario, tipo")]
+
+
+def _igual_a_reconstruido(conn) -> list:
+    """Lo que dejaron los triggers tiene que ser lo mismo que recalcular todo desde cero."""
+    incremental = _resumen(conn)
+    reconstruir_resumenes()
+    assert _resumen(conn) == incremental
+    return incremental
+
+
+def test_insertar_suma_al_periodo(base_migrada):
+    guardar(numero="1")
+    guardar(numero="2", monto_total=50.0, base_imponible=None, igv=None, items=[])  # IGV desglosado del total
+    guardar(numero="3", fecha_emision="02/04/2025")
+    guardar("venta", numero="1", serie="F001", monto_total=236.0, base_imponible=200.0, igv=36.0, items=[])
+    guardar(user_id=2, numero="1")
+    resumen = _igual_a_reconstruido(base_migrada)
+    assert (1, "202503", "compra", 2, 16800, 14237, 2563) in resumen
+    assert (1, "202504", "compra", 1, 11800, 10000, 1800) in resumen
+    assert (1, "202503", "venta", 1, 23600, 20000, 3600) in resumen
+    assert (2, "202503", "compra", 1, 11800, 10000, 1800) in resumen
+
+
+def test_editar_mueve_montos_y_periodo(base_migrada):
+    primero = guardar(numero="1")
+    segundo = guardar(numero="2")
+    venta = guardar("venta", numero="1")
+
+    main._actualizar_registro("compras", primero, 1, {"monto_total": 236.0, "base_imponible": 200.0, "igv": 36.0})
+    _igual_a_reconstruido(base_migrada)
+
+    # Cambiar la fecha cambia el periodo: sale de marzo y entra en febrero
+    main._actualizar_registro("compras", segundo, 1, {"fecha_emision": "28/02/2025"})
+    main._actualizar_registro("ventas", venta, 1, {"fecha_emision": "01/05/2025", "monto_total": 59.0,
+                                                   "base_imponible": 50.0, "igv": 9.0})
+    resumen = _igual_a_reconstruido(base_migrada)
+    assert [(r[1], r[2], r[3]) for r in resumen] == [("202502", "compra", 1), ("202503", "compra", 1),
+                                                     ("202505", "venta", 1)]
+
+    # Una edición rechazada por validación no toca el resumen
+    main._actualizar_registro("compras", primero, 1, {"fecha_emision": "31/02/2025"})
+    assert _igual_a_reconstruido(base_migrada) == resumen
+
+
+def test_borrar_resta_y_quita_periodos_vacios(base_migrada):
+    primero = guardar(numero="1")
+    guardar(numero="2")
+    abril = guardar(numero="3", fecha_emision="02/04/2025")
+    venta = guardar("venta", numero="1")
+
+    assert main._borrar_registro("compras", primero, 1) == 1
+    _igual_a_reconstruido(base_migrada)
+
+    main._borrar_registro("compras", abril, 1)
+    main._borrar_registro("ventas", venta, 1)
+    resumen = _igual_a_reconstruido(base_migrada)
+    # Sin comprobantes, el periodo desaparece en vez de quedar en cero
+    assert [(r[1], r[2], r[3]) for r in resumen] == [("202503", "compra", 1)]
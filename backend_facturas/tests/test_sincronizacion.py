@@ -0,0 +1,93 @@
+import main
+from conftest import comprobante, guardar
+from sincronizacion import cambios_desde, purgar_lapidas, SYNC_MAX_CAMBIOS
+from validacion import validar
+
+
+def _ids(respuesta: dict) -> list:
+    return [r["id_gasto"] for r in respuesta["compras"]]
+
+
+def test_primer_sync_es_completo(base_migrada):
+    ids = [guardar(numero=str(n)) for n in range(1, 4)]
+    guardar(user_id=2, numero="1")  # de otro usuario: no aparece
+    respuesta = cambios_desde(1)
+    assert respuesta["completo"] is True and respuesta["pendientes"] is False
+    assert _ids(respuesta) == ids
+    assert [i["descripcion"] for i in respuesta["compras"][0]["items"]] == ["cemento"]
+
+
+def test_tokens_crecen_con_cada_escritura(base_migrada):
+    conn = base_migrada
+    primero, segundo = guardar(numero="1"), guardar(numero="2")
+    tokens = [int(cambios_desde(1)["token"])]
+
+    conn.execute("UPDATE compras_sire SET proveedor_razon_social = 'Otro SAC' WHERE id_gasto = ?", (primero,))
+    conn.commit()
+    respuesta = cambios_desde(1, str(tokens[-1]))
+    assert _ids(respuesta) == [primero] and respuesta["completo"] is False
+    tokens.append(int(respuesta["token"]))
+
+    # Tocar un item mueve a su comprobante al final del log
+    conn.execute("UPDATE detalle_items SET descripcion = 'arena' WHERE tipo_registro = 'compra' AND id_padre = ?",
+                 (segundo,))
+    conn.commit()
+    respuesta = cambios_desde(1, str(tokens[-1]))
+    assert _ids(respuesta) == [segundo]
+    tokens.append(int(respuesta["token"]))
+
+    assert tokens == sorted(set(tokens))
+    # Sin cambios nuevos el token no se mueve
+    assert cambios_desde(1, str(tokens[-1])) == {
+        "completo": False, "pendientes": False, "token": str(tokens[-1]),
+        "eliminados": {"compras": [], "ventas": []}, "compras": [], "ventas": []}
+
+
+def test_borrar_deja_lapida(base_migrada):
+    conn = base_migrada
+    borrado, vivo = guardar(numero="1"), guardar(numero="2")
+    token = cambios_desde(1)["token"]
+
+    conn.execute("DELETE FROM compras_sire WHERE id_gasto = ?", (borrado,))
+    conn.execute("DELETE FROM detalle_items WHERE tipo_registro = 'compra' AND id_padre = ?", (borrado,))
+    conn.commit()
+
+    respuesta = cambios_desde(1, token)
+    assert respuesta["eliminados"]["compras"] == [borrado]
+    assert respuesta["compras"] == []
+    # La lápida queda una sola vez, aunque después se borren sus items
+    filas = conn.execute("SELECT borrado FROM cambios WHERE tipo = 'compra' AND id_registro = ?", (borrado,))
+    assert [tuple(f) for f in filas] == [(1,)]
+    assert _ids(cambios_desde(1)) == [vivo]
+
+
+def test_token_anterior_al_horizonte_pide_todo(base_migrada):
+    conn = base_migrada
+    borrado, vivo = guardar(numero="1"), guardar(numero="2")
+    viejo = cambios_desde(1)["token"]
+    conn.execute("DELETE FROM compras_sire WHERE id_gasto = ?", (borrado,))
+    # La lápida ya pasó la retención
+    conn.execute("UPDATE cambios SET actualizado = 0 WHERE borrado = 1")
+    conn.commit()
+    nuevo = cambios_desde(1, viejo)["token"]
+
+    assert purgar_lapidas() == 1
+    respuesta = cambios_desde(1, viejo)
+    assert respuesta["completo"] is True
+    assert _ids(respuesta) == [vivo] and respuesta["eliminados"]["compras"] == []
+    # Un token posterior a la purga sigue siendo incremental
+    assert cambios_desde(1, nuevo)["completo"] is False
+
+
+def test_respuesta_tope_sync_max_cambios(base_migrada):
+    filas = [main._fila_cabecera("compra", 1, validar("compra", comprobante(numero=str(n))))
+             for n in range(1, SYNC_MAX_CAMBIOS + 2)]
+    with base_migrada:
+        base_migrada.executemany(main.SQL_INSERTAR_CABECERA["compra"], filas)
+
+    primera = cambios_desde(1)
+    assert len(primera["compras"]) == SYNC_MAX_CAMBIOS and primera["pendientes"] is True
+    segunda = cambios_desde(1, primera["token"])
+    assert len(segunda["compras"]) == 1 and segunda["pendientes"] is False
+    assert segunda["completo"] is False
+    assert _ids(primera) + _ids(segunda) == list(range(1, SYNC_MAX_CAMBIOS + 2))
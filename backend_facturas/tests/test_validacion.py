@@ -0,0 +1,125 @@
+from datetime import date
+import pytest
+from validacion import calcular_periodo, digito_ruc, ruc_valido, validar_lote
+
+HOY = date(2025, 4, 1)
+
+
+def _compra(**cambios) -> dict:
+    documento = {
+        "fecha_emision": "15/03/2025", "tipo_comprobante": "Factura", "serie": "F001", "numero": "123",
+        "proveedor_ruc": "20100070970", "proveedor_razon_social": "Proveedor SAC",
+        "monto_total": 118.0, "base_imponible": 100.0, "igv": 18.0,
+        "items": [{"descripcion": "cemento", "cantidad": 2, "precio_unitario": 59.0, "total": 118.0}],
+    }
+    documento.update(cambios)
+    return documento
+
+
+def _campos(documento: dict) -> dict:
+    return validar_lote("compra", [documento], HOY)[0]["campos"]
+
+
+@pytest.mark.parametrize("ruc, esperado", [
+    ("20100070970", True),
+    ("20100070971", False),   # dígito verificador
+    ("10467793549", True),
+    ("10467793540", False),
+    ("30100070970", False),   # prefijo que no existe
+    ("2010007097", False),    # 10 dígitos
+    ("2010007097A", False),
+    ("", False),
+    (None, False),
+])
+def test_ruc_modulo_11(ruc, esperado):
+    assert ruc_valido(ruc) is esperado
+
+
+@pytest.mark.parametrize("base, digito", [
+    ("2010007097", 0),  # resto 10 -> 0
+    ("1046779354", 9),
+])
+def test_digito_ruc(base, digito):
+    assert digito_ruc(base) == digito
+
+
+@pytest.mark.parametrize("tipo_comprobante, serie, marca", [
+    ("Factura", "F001", "ok"),
+    ("Factura", "FC01", "ok"),
+    ("Factura", "0001", "ok"),      # serie física
+    ("Factura", "B001", "invalido"),
+    ("Boleta", "B001", "ok"),
+    ("Boleta", "F001", "invalido"),
+    ("Nota de Credito", "F001", "ok"),
+    ("Nota de Credito", "B001", "ok"),
+    ("Nota de Debito", "X001", "invalido"),
+    ("Factura", "F01", "invalido"),
+    ("Factura", "", "faltante"),
+])
+def test_serie_por_tipo(tipo_comprobante, serie, marca):
+    assert _campos(_compra(tipo_comprobante=tipo_comprobante, serie=serie))["serie"] == marca
+
+
+@pytest.mark.parametrize("total, base, igv, marca", [
+    (118.0, 100.0, 18.0, "ok"),
+    (118.04, 100.0, 18.04, "ok"),    # dentro de TOLERANCIA_MONTO
+    (120.0, 100.0, 18.0, "dudoso"),  # base + IGV no da el total
+    (110.0, 100.0, 10.0, "dudoso"),  # otra tasa
+    (118.0, 100.0, None, "faltante"),
+    (118.0, None, 18.0, "faltante"),
+])
+def test_base_mas_igv(total, base, igv, marca):
+    assert _campos(_compra(monto_total=total, base_imponible=base, igv=igv, items=[]))["igv"] == marca
+
+
+@pytest.mark.parametrize("items, marca", [
+    ([{"cantidad": 2, "precio_unitario": 59.0, "total": 118.0}], "ok"),
+    ([{"cantidad": 1, "precio_unitario": 100.0, "total": 100.0},
+      {"cantidad": 1, "precio_unitario": 18.0, "total": 18.0}], "ok"),
+    ([{"cantidad": 1, "precio_unitario": 100.0, "total": 100.0}], "dudoso"),  # la suma no da el total
+    ([{"cantidad": 2, "precio_unitario": 50.0, "total": 118.0}], "dudoso"),   # la línea no cuadra
+    ([{"total": 118.0}], "ok"),                                               # sin cantidad ni precio
+    ([], "faltante"),
+])
+def test_suma_de_items(items, marca):
+    assert _campos(_compra(items=items))["items"] == marca
+
+
+@pytest.mark.parametrize("fecha, periodo", [
+    ("15/03/2025", "202503"),
+    ("2025-03-15", "202503"),
+    ("15/03/25", "202503"),
+    ("5 de marzo de 2025", "202503"),
+    (date(2024, 12, 31), "202412"),
+])
+def test_calcular_periodo(fecha, periodo):
+    assert calcular_periodo(fecha) == periodo
+
+
+@pytest.mark.parametrize("fecha", ["", None, "31/02/2025", "ayer", "2025/13/01"])
+def test_calcular_periodo_rechaza_fechas_invalidas(fecha):
+    with pytest.raises(ValueError):
+        calcular_periodo(fecha)
+
+
+@pytest.mark.parametrize("cambios", [
+    {"proveedor_ruc": "20100070971"},
+    {"serie": "B001"},
+    {"monto_total": None, "items": []},
+    {"fecha_emision": "31/02/2025"},
+])
+def test_guardar_confirmado_rechaza_con_422(cliente, cambios):
+    client, user_id, cabeceras = cliente
+    r = client.post("/guardar-confirmado/", headers=cabeceras,
+                    json={"user_id": user_id, "tipo": "compra", "datos": _compra(**cambios)})
+    assert r.status_code == 422
+    assert r.json()["validacion"]["estado"] == "error"
+    assert client.get(f"/obtener-registros/compras?user_id={user_id}", headers=cabeceras).json()["datos"] == []
+
+
+def test_guardar_confirmado_acepta_comprobante_valido(cliente):
+    client, user_id, cabeceras = cliente
+    r = client.post("/guardar-confirmado/", headers=cabeceras,
+                    json={"user_id": user_id, "tipo": "compra", "datos": _compra()})
+    assert r.status_code == 200
+    assert len(client.get(f"/obtener-registros/compras?user_id={user_id}", headers=cabeceras).json()["datos"]) == 1
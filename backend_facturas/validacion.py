@@ -0,0 +1,455 @@
+import json
+import re
+import time
+import unicodedata
+from datetime import date, datetime, timedelta
+from db import obtener_conexion, transaccion
+from sire import CODIGO_COMPROBANTE
+
+# Validación y normalización de comprobantes, del escaneo al guardado y sobre lo
+# ya guardado. Las reglas trabajan por columnas sobre un lote de comprobantes:
+# un escaneo es un lote de uno y la revalidación masiva pasa de a
+# VALIDACION_FILAS_POR_LOTE filas por consulta.
+#
+# Cada campo queda con una marca: ok, dudoso, invalido o faltante. Un campo
+# obligatorio invalido o faltante deja el comprobante en "error" (no se guarda);
+# cualquier dudoso lo deja en "advertencia" (se guarda, para revisar).
+VALIDACION_FILAS_POR_LOTE = 500
+TASA_IGV = 0.18
+# Diferencia aceptada al cuadrar montos: redondeos por línea de los comprobantes
+TOLERANCIA_MONTO = 0.05
+
+PESOS_RUC = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+
+# Nombre con el que se guarda cada tipo; se aceptan el código SUNAT y variantes
+NOMBRE_COMPROBANTE = {"FACTURA": "Factura", "BOLETA": "Boleta",
+                      "NOTA DE CREDITO": "Nota de Credito", "NOTA DE DEBITO": "Nota de Debito"}
+ALIAS_COMPROBANTE = {
+    **{codigo: NOMBRE_COMPROBANTE[nombre] for nombre, codigo in CODIGO_COMPROBANTE.items()},
+    "FACTURA ELECTRONICA": "Factura", "BOLETA DE VENTA": "Boleta", "BOLETA DE VENTA ELECTRONICA": "Boleta",
+    "BOLETA ELECTRONICA": "Boleta", "NOTA CREDITO": "Nota de Credito", "NOTA DEBITO": "Nota de Debito",
+}
+# Serie electrónica por tipo (F001, B001, FC01...) o serie física de 4 dígitos
+RE_SERIE = {
+    "Factura": re.compile(r"^(F[A-Z0-9]{3}|\d{4})$"),
+    "Boleta": re.compile(r"^(B[A-Z0-9]{3}|\d{4})$"),
+    "Nota de Credito": re.compile(r"^([FB][A-Z0-9]{3}|\d{4})$"),
+    "Nota de Debito": re.compile(r"^([FB][A-Z0-9]{3}|\d{4})$"),
+}
+RE_SERIE_GENERICA = re.compile(r"^([A-Z][A-Z0-9]{3}|\d{4})$")
+RE_NUMERO = re.compile(r"^\d{1,8}$")
+
+MESES = {"ENE": 1, "FEB": 2, "MAR": 3, "ABR": 4, "MAY": 5, "JUN": 6,
+         "JUL": 7, "AGO": 8, "SET": 9, "SEP": 9, "OCT": 10, "NOV": 11, "DIC": 12}
+RE_FECHA_DMA = re.compile(r"^(\d{1,2})[/.-](\d{1,2})[/.-](\d{2}|\d{4})$")
+RE_FECHA_AMD = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})")
+RE_FECHA_TEXTO = re.compile(r"^(\d{1,2})(?:\s+DE\s+|[\s/-]+)([A-Z]{3})[A-Z]*(?:\s+DE\s+|[\s/-]+)(\d{4})$")
+
+MONEDAS = {"PEN": "PEN", "S/": "PEN", "S/.": "PEN", "SOLES": "PEN", "SOL": "PEN",
+           "USD": "USD", "US$": "USD", "$": "USD", "DOLARES": "USD", "EUR": "EUR", "€": "EUR", "EUROS": "EUR"}
+
+# Campos cuya falla impide guardar
+OBLIGATORIOS = ("fecha_emision", "documento", "serie", "numero", "total")
+
+SQL_TABLA_VALIDACIONES = '''
+    CREATE TABLE IF NOT EXISTS validaciones (
+        tipo TEXT,              -- 'compra' o 'venta'
+        id_registro INTEGER,
+        user_id INTEGER,
+        estado TEXT,            -- ok, advertencia, error
+        campos TEXT,            -- JSON campo -> ok/dudoso/invalido/faltante
+        mensajes TEXT,          -- JSON con el detalle legible
+        validado REAL,
+        PRIMARY KEY (tipo, id_registro)
+    ) WITHOUT ROWID
+'''
+
+# tipo -> (tabla, columna id, documento, razón social, total, serie, número, base, IGV)
+FUENTES = {
+    "compra": ("compras_sire", "id_gasto", "proveedor_ruc", "proveedor_razon_social", "monto_total",
+               "serie", "numero", "base_imponible_1", "igv_1"),
+    "venta": ("ventas_sire", "id_transaccion", "cliente_nro_doc", "cliente_razon_social", "total_cp",
+              "serie_comprobante", "nro_comprobante", "base_imponible_gravada", "monto_igv"),
+}
+
+
+def sql_migracion_validaciones() -> list:
+    sentencias = [SQL_TABLA_VALIDACIONES,
+                  "CREATE INDEX IF NOT EXISTS idx_validaciones_usuario ON validaciones (user_id, estado)"]
+    for tipo, (tabla, columna_id, *_) in FUENTES.items():
+        # Borrar un comprobante se lleva su validación
+        sentencias.append(f"CREATE TRIGGER IF NOT EXISTS trg_validaciones_{tabla}_del AFTER DELETE ON {tabla} "
+                          f"BEGIN DELETE FROM validaciones WHERE tipo = '{tipo}' AND id_registro = OLD.{columna_id}; END")
+    return sentencias
+
+
+# --- Normalización de valores sueltos ---------------------------------------
+
+def _sin_tildes(texto: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFD", texto) if unicodedata.category(c) != "Mn")
+
+
+def digito_ruc(base: str) -> int:
+    """Dígito verificador (módulo 11) para los 10 primeros dígitos de un RUC."""
+    resto = 11 - sum(int(d) * p for d, p in zip(base, PESOS_RUC)) % 11
+    return {10: 0, 11: 1}.get(resto, resto)
+
+
+def ruc_valido(ruc) -> bool:
+    return bool(ruc) and len(ruc) == 11 and ruc.isdigit() and ruc[:2] in ("10", "15", "17", "20") \
+        and int(ruc[10]) == digito_ruc(ruc[:10])
+
+
+def normalizar_fecha(valor):
+    """date o None. Acepta DD/MM/AAAA (y con - o .), AAAA-MM-DD, DD/MM/AA y '5 de marzo de 2025'."""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, date):
+        return valor
+    texto = _sin_tildes(str(valor or "")).strip().upper()
+    try:
+        m = RE_FECHA_DMA.match(texto)
+        if m:
+            dia, mes, anio = int(m.group(1)), int(m.group(2)), int(m.group(3))
+            return date(anio + 2000 if anio < 100 else anio, mes, dia)
+        m = RE_FECHA_AMD.match(texto)
+        if m:
+            return date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+        m = RE_FECHA_TEXTO.match(texto)
+        if m and m.group(2) in MESES:
+            return date(int(m.group(3)), MESES[m.group(2)], int(m.group(1)))
+    except ValueError:
+        pass  # 31/02/2025 y similares
+    return None
+
+
+def normalizar_monto(valor):
+    """float con 2 decimales o None. '1,234.50', '1.234,50', 'S/ 118' -> 1234.5, 1234.5, 118.0."""
+    if valor is None or isinstance(valor, bool):
+        return None
+    if isinstance(valor, (int, float)):
+        return round(float(valor), 2)
+    texto = re.sub(r"[^\d,.\-]", "", str(valor))
+    if not re.search(r"\d", texto):
+        return None
+    if "," in texto and "." in texto:
+        # El separador que aparece último es el decimal
+        miles = "," if texto.rfind(",") < texto.rfind(".") else "."
+        texto = texto.replace(miles, "").replace(",", ".")
+    elif "," in texto:
+        texto = texto.replace(",", ".") if re.search(r",\d{1,2}$", texto) else texto.replace(",", "")
+    elif texto.count(".") > 1:
+        texto = texto.replace(".", "")
+    try:
+        return round(float(texto), 2)
+    except ValueError:
+        return None
+
+
+def normalizar_moneda(moneda, *montos_crudos):
+    """Código ISO: del campo moneda o, si no viene, del símbolo pegado a algún monto."""
+    for candidato in (moneda, *montos_crudos):
+        if isinstance(candidato, str):
+            texto = _sin_tildes(candidato).strip().upper()
+            if texto in MONEDAS:
+                return MONEDAS[texto]
+            for simbolo in ("US$", "S/", "€"):
+                if simbolo in texto:
+                    return MONEDAS[simbolo]
+    return None
+
+
+def normalizar_tipo_comprobante(valor, serie: str):
+    texto = re.sub(r"\s+", " ", _sin_tildes(str(valor or "")).strip().upper())
+    if texto in NOMBRE_COMPROBANTE:
+        return NOMBRE_COMPROBANTE[texto]
+    if texto in ALIAS_COMPROBANTE:
+        return ALIAS_COMPROBANTE[texto]
+    if not texto:
+        # Sin tipo, la letra de la serie lo dice
+        return {"F": "Factura", "B": "Boleta"}.get(serie[:1])
+    return str(valor).strip()
+
+
+def separar_serie_numero(serie, numero):
+    """('F001-00123', None) -> ('F001', '123'). El número queda sin ceros a la izquierda."""
+    serie = re.sub(r"\s+", "", str(serie or "")).upper()
+    numero = re.sub(r"\s+", "", str(numero or ""))
+    if "-" in serie:
+        serie, _, pegado = serie.partition("-")
+        numero = numero or pegado
+    if numero.isdigit():
+        numero = str(int(numero))
+    return serie, numero
+
+
+def calcular_periodo(fecha) -> str:
+    """AAAAMM de la fecha de emisión. Una fecha que no se entiende es un error,
+    no el mes actual: el comprobante caería en otro periodo tributario."""
+    normalizada = normalizar_fecha(fecha)
+    if normalizada is None:
+        raise ValueError(f"Fecha de emisión inválida: {fecha!r}")
+    return normalizada.strftime("%Y%m")
+
+
+# --- Reglas por columna -------------------------------------------------------
+
+def _marcas_fecha(fechas: list, hoy: date) -> list:
+    limite = hoy + timedelta(days=1)  # un día de margen por zona horaria
+    return ["faltante" if crudo in (None, "") else "invalido" if f is None or f > limite else "ok"
+            for crudo, f in fechas]
+
+
+def _marcas_documento(tipo: str, documentos: list, tipos_cp: list) -> list:
+    marcas = []
+    for doc, tipo_cp in zip(documentos, tipos_cp):
+        if not doc:
+            # Una boleta de venta puede no identificar al cliente
+            marcas.append("ok" if tipo == "venta" and tipo_cp == "Boleta" else "faltante")
+        elif tipo == "compra" or tipo_cp != "Boleta":
+            marcas.append("ok" if ruc_valido(doc) else "invalido")
+        else:
+            marcas.append("ok" if (len(doc) == 8 and doc.isdigit()) or ruc_valido(doc) else "invalido")
+    return marcas
+
+
+def _marcas_serie(series: list, tipos_cp: list) -> list:
+    return ["faltante" if not s else
+            "ok" if RE_SERIE.get(t, RE_SERIE_GENERICA).match(s) else "invalido"
+            for s, t in zip(series, tipos_cp)]
+
+
+def _cuadra(a, b) -> bool:
+    return abs(a - b) <= TOLERANCIA_MONTO
+
+
+def _marcas_igv(totales: list, bases: list, igvs: list) -> list:
+    marcas = []
+    for total, base, igv in zip(totales, bases, igvs):
+        if total is None or base is None or igv is None:
+            marcas.append("faltante")
+        else:
+            # Otra tasa (exonerados, restaurantes) o tributos extra: se guarda, pero a revisar
+            marcas.append("ok" if _cuadra(base + igv, total) and _cuadra(base * TASA_IGV, igv) else "dudoso")
+    return marcas
+
+
+def _marcas_items(totales: list, sumas: list, lineas_ok: list) -> list:
+    return ["faltante" if suma is None else
+            "ok" if total is not None and _cuadra(suma, total) and linea_ok else "dudoso"
+            for total, suma, linea_ok in zip(totales, sumas, lineas_ok)]
+
+
+MENSAJES = {
+    ("fecha_emision", "invalido"): "Fecha de emisión inválida o futura",
+    ("fecha_emision", "faltante"): "Falta la fecha de emisión",
+    ("documento", "invalido"): "El RUC/DNI no es válido (dígito verificador o longitud)",
+    ("documento", "faltante"): "Falta el RUC/DNI",
+    ("serie", "invalido"): "La serie no corresponde al tipo de comprobante",
+    ("serie", "faltante"): "Falta la serie",
+    ("numero", "invalido"): "El número debe tener de 1 a 8 dígitos",
+    ("numero", "faltante"): "Falta el número",
+    ("total", "invalido"): "El total debe ser mayor que cero",
+    ("total", "faltante"): "Falta el total",
+    ("tipo_comprobante", "dudoso"): "Tipo de comprobante no reconocido",
+    ("tipo_comprobante", "faltante"): "Falta el tipo de comprobante",
+    ("razon_social", "faltante"): "Falta la razón social",
+    ("moneda", "dudoso"): "Moneda no reconocida",
+    ("igv", "dudoso"): "Base + IGV (18%) no cuadra con el total",
+    ("items", "dudoso"): "La suma de los items no cuadra con el total",
+}
+
+
+def _resumen(campos: dict) -> dict:
+    if any(campos[c] in ("invalido", "faltante") for c in OBLIGATORIOS):
+        estado = "error"
+    elif any(m in ("dudoso", "invalido") for m in campos.values()):
+        estado = "advertencia"
+    else:
+        estado = "ok"
+    # "faltante" en campos opcionales (items, IGV) es lo normal en una boleta: no se avisa
+    mensajes = [MENSAJES[(c, m)] for c, m in campos.items()
+                if (c, m) in MENSAJES and (m != "faltante" or c in OBLIGATORIOS)]
+    return {"estado": estado, "campos": campos, "mensajes": mensajes}
+
+
+def validar_lote(tipo: str, documentos: list, hoy: date = None) -> list:
+    """Normaliza en el lugar una lista de comprobantes (dicts con los nombres del
+    JSON de escaneo) y devuelve la validación de cada uno."""
+    hoy = hoy or date.today()
+    clave_doc = "proveedor_ruc" if tipo == "compra" else "cliente_nro_doc"
+    clave_razon = "proveedor_razon_social" if tipo == "compra" else "cliente_razon_social"
+
+    # Normalización, columna por columna
+    series, numeros = zip(*(separar_serie_numero(d.get("serie"), d.get("numero")) for d in documentos)) \
+        if documentos else ((), ())
+    crudos_total = [d.get("monto_total") if d.get("monto_total") is not None else d.get("total_cp") for d in documentos]
+    totales = [normalizar_monto(v) for v in crudos_total]
+    bases = [normalizar_monto(d.get("base_imponible")) for d in documentos]
+    igvs = [normalizar_monto(d.get("igv")) for d in documentos]
+    fechas = [(d.get("fecha_emision"), normalizar_fecha(d.get("fecha_emision"))) for d in documentos]
+    docs = [re.sub(r"[\s.-]", "", str(d.get(clave_doc) or "")) for d in documentos]
+    tipos_cp = [normalizar_tipo_comprobante(d.get("tipo_comprobante"), s) for d, s in zip(documentos, series)]
+    monedas = [normalizar_moneda(d.get("moneda"), crudo) for d, crudo in zip(documentos, crudos_total)]
+
+    sumas, lineas_ok = [], []
+    for d in documentos:
+        items = d.get("items") or []
+        for item in items:
+            for campo in ("cantidad", "precio_unitario", "total"):
+                if campo in item:
+                    item[campo] = normalizar_monto(item[campo])
+        sumas.append(round(sum(i.get("total") or 0 for i in items), 2) if items else None)
+        lineas_ok.append(all(None in (i.get("cantidad"), i.get("precio_unitario"), i.get("total"))
+                             or _cuadra(i["cantidad"] * i["precio_unitario"], i["total"]) for i in items))
+
+    # Marcas por columna
+    marcas = {
+        "fecha_emision": _marcas_fecha(fechas, hoy),
+        "documento": _marcas_documento(tipo, docs, tipos_cp),
+        "razon_social": ["ok" if (d.get(clave_razon) or "").strip() else "faltante" for d in documentos],
+        "tipo_comprobante": ["faltante" if not t else "ok" if t in RE_SERIE else "dudoso" for t in tipos_cp],
+        "serie": _marcas_serie(series, tipos_cp),
+        "numero": ["faltante" if not n else "ok" if RE_NUMERO.match(n) else "invalido" for n in numeros],
+        "total": ["faltante" if t is None else "ok" if t > 0 else "invalido" for t in totales],
+        "moneda": ["dudoso" if m is None and d.get("moneda") else "ok" for d, m in zip(documentos, monedas)],
+        "igv": _marcas_igv(totales, bases, igvs),
+        "items": _marcas_items(totales, sumas, lineas_ok),
+    }
+
+    resultados = []
+    for i, d in enumerate(documentos):
+        fecha = fechas[i][1]
+        if fecha is not None:
+            d["fecha_emision"] = fecha.strftime("%d/%m/%Y")
+        d[clave_doc] = docs[i] or None
+        d["serie"], d["numero"] = series[i], numeros[i]
+        if tipos_cp[i]:
+            d["tipo_comprobante"] = tipos_cp[i]
+        d["monto_total"] = totales[i]
+        if tipo == "venta":
+            d["total_cp"] = totales[i]
+        d["base_imponible"], d["igv"] = bases[i], igvs[i]
+        d["moneda"] = monedas[i] or "PEN"
+        resultados.append(_resumen({campo: columna[i] for campo, columna in marcas.items()}))
+    return resultados
+
+
+def validar(tipo: str, datos: dict) -> dict:
+    """Un comprobante: lo normaliza y le agrega `validacion`."""
+    datos["validacion"] = validar_lote(tipo, [datos])[0]
+    return datos
+
+
+def guardar_validacion(conn, tipo: str, id_registro: int, user_id: int, validacion: dict):
+    conn.execute('''
+        INSERT OR REPLACE INTO validaciones (tipo, id_registro, user_id, estado, campos, mensajes, validado)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (tipo, id_registro, user_id, validacion["estado"], json.dumps(validacion["campos"]),
+          json.dumps(validacion["mensajes"], ensure_ascii=False), time.time()))
+
+
+def obtener_validacion(tipo: str, id_registro: int):
+    row = obtener_conexion().execute(
+        "SELECT estado, campos, mensajes, validado FROM validaciones WHERE tipo = ? AND id_registro = ?",
+        (tipo, id_registro)
+    ).fetchone()
+    if not row:
+        return None
+    return {"estado": row["estado"], "campos": json.loads(row["campos"]),
+            "mensajes": json.loads(row["mensajes"]), "validado": row["validado"]}
+
+
+# --- Revalidación masiva ----------------------------------------------------
+
+def _como_documento(tipo: str, row, suma_items) -> dict:
+    """Fila guardada -> dict con los nombres del JSON de escaneo."""
+    _, _, doc, razon, total, serie, numero, base, igv = FUENTES[tipo]
+    documento = {
+        "fecha_emision": row["fecha_emision"],
+        "proveedor_ruc" if tipo == "compra" else "cliente_nro_doc": row[doc],
+        "proveedor_razon_social" if tipo == "compra" else "cliente_razon_social": row[razon],
+        "tipo_comprobante": row["tipo_comprobante"],
+        "serie": row[serie], "numero": row[numero],
+        "monto_total": row[total],
+        "base_imponible": row[base], "igv": row[igv],
+        "moneda": row["moneda"] if tipo == "venta" else None,
+        # Solo hace falta el total de los items para cuadrar
+        "items": [{"total": suma_items}] if suma_items is not None else [],
+    }
+    if tipo == "venta" and not (row[base] or row[igv]):
+        # En ventas base/IGV tienen DEFAULT 0: en cero es "no registrado"
+        documento["base_imponible"] = documento["igv"] = None
+    return documento
+
+
+def revalidar(tipo: str = None, user_id: int = None, corregir: bool = False) -> dict:
+    """Vuelve a validar lo guardado, de a VALIDACION_FILAS_POR_LOTE filas por consulta.
+
+    Con `corregir`, además reescribe la fecha normalizada y el periodo: los
+    comprobantes que cayeron en el mes actual por una fecha mal leída vuelven
+    a su periodo (los triggers mueven también el resumen).
+    """
+    conteo = {"ok": 0, "advertencia": 0, "error": 0, "periodos_corregidos": 0}
+    hoy = date.today()
+    for tipo_actual in ([tipo] if tipo else list(FUENTES)):
+        tabla, columna_id, *_ = FUENTES[tipo_actual]
+        ultimo = 0
+        while True:
+            condiciones, params = [f"{columna_id} > ?"], [ultimo]
+            if user_id is not None:
+                condiciones.append("user_id = ?")
+                params.append(user_id)
+            rows = obtener_conexion().execute(
+                f"SELECT * FROM {tabla} WHERE {' AND '.join(condiciones)} ORDER BY {columna_id} LIMIT ?",
+                (*params, VALIDACION_FILAS_POR_LOTE)
+            ).fetchall()
+            if not rows:
+                break
+            ultimo = rows[-1][columna_id]
+            ids = [r[columna_id] for r in rows]
+            sumas = dict(obtener_conexion().execute(
+                f"SELECT id_padre, round(SUM(total), 2) FROM detalle_items WHERE tipo_registro = ? "
+                f"AND id_padre IN ({','.join('?' * len(ids))}) GROUP BY id_padre",
+                (tipo_actual, *ids)
+            ).fetchall())
+            documentos = [_como_documento(tipo_actual, r, sumas.get(r[columna_id])) for r in rows]
+            validaciones = validar_lote(tipo_actual, documentos, hoy)
+
+            with transaccion() as conn:
+                for row, documento, validacion in zip(rows, documentos, validaciones):
+                    guardar_validacion(conn, tipo_actual, row[columna_id], row["user_id"], validacion)
+                    conteo[validacion["estado"]] += 1
+                    if corregir and validacion["campos"]["fecha_emision"] == "ok":
+                        periodo = calcular_periodo(documento["fecha_emision"])
+                        if (documento["fecha_emision"], periodo) != (row["fecha_emision"], row["periodo_tributario"]):
+                            conn.execute(f"UPDATE {tabla} SET fecha_emision = ?, periodo_tributario = ? WHERE {columna_id} = ?",
+                                         (documento["fecha_emision"], periodo, row[columna_id]))
+                            conteo["periodos_corregidos"] += 1
+    return conteo
+
+
+def resumen_validaciones(user_id: int) -> dict:
+    """Cuántos comprobantes del usuario hay en cada estado y cuáles tienen error."""
+    conn = obtener_conexion()
+    estados = {f"{tipo}_{estado}": n for tipo, estado, n in conn.execute(
+        "SELECT tipo, estado, COUNT(*) FROM validaciones WHERE user_id = ? GROUP BY tipo, estado", (user_id,))}
+    errores = [{"tipo": tipo, "id": id_registro, "mensajes": json.loads(mensajes)} for tipo, id_registro, mensajes in conn.execute(
+        "SELECT tipo, id_registro, mensajes FROM validaciones WHERE user_id = ? AND estado = 'error' LIMIT 100", (user_id,))]
+    return {"estados": estados, "errores": errores}
+
+
+if __name__ == "__main__":
+    import argparse
+    from migraciones import aplicar_migraciones
+    parser = argparse.ArgumentParser(description="Revalida los comprobantes guardados")
+    parser.add_argument("--tipo", choices=list(FUENTES))
+    parser.add_argument("--usuario", type=int)
+    parser.add_argument("--corregir", action="store_true", help="reescribe fecha y periodo normalizados")
+    args = parser.parse_args()
+    aplicar_migraciones()
+    inicio = time.perf_counter()
+    conteo = revalidar(args.tipo, args.usuario, args.corregir)
+    print(f"{sum(conteo[e] for e in ('ok', 'advertencia', 'error'))} comprobante(s) en {time.perf_counter() - inicio:.1f}s: "
+          f"{conteo['ok']} ok, {conteo['advertencia']} con advertencias, {conteo['error']} con errores; "
+          f"{conteo['periodos_corregidos']} periodo(s) corregido(s)")